@@ -0,0 +1,217 @@
+"""Measure the latency and memory of building and sending notifications.
+
+Events are built against the memory storage backend and sent with a stubbed
+mailer, for every combination of batch size, hooks count, kind of filters
+(exact or regexp) and group size (``0`` means that hooks list email addresses).
+With ``0`` hooks, no bucket or collection has ``kinto-emailer`` metadata, and
+the overhead of the plugin on writes is measured. Scenarios run with plain
+text templates (``format``) and with HTML templates too (``html``, requires
+Jinja).
+Caches are warmed up before measuring, like on a busy server. The reported
+latencies are the best of ``--repeat`` runs, for one event.
+
+::
+
+    $ python benchmarks/bench_notifications.py --save baseline.json
+    $ python benchmarks/bench_notifications.py --compare baseline.json
+
+With ``--compare``, the exit code is ``1`` if a scenario is slower (or uses more
+memory) than the baseline by more than ``--threshold``.
+"""
+
+import argparse
+import itertools
+import json
+import platform
+import sys
+import time
+import tracemalloc
+from types import SimpleNamespace
+
+from kinto.core.storage.memory import Storage
+from pyramid.registry import Registry
+from pyramid_mailer.interfaces import IMailer
+
+from kinto_emailer import build_notification, group_emails, resolved_hooks, send_notification
+
+
+METRICS = ("build_ms", "send_ms", "peak_kib")
+
+
+class ResourceChanged:
+    """Mimic ``kinto.core.events.ResourceChanged``."""
+
+    def __init__(self, payload, impacted_objects, request):
+        self.payload = payload
+        self.impacted_objects = impacted_objects
+        self.request = request
+
+
+class StubMailer:
+    def __init__(self):
+        self.sent = 0
+
+    def send_immediately(self, message, fail_silently=False):
+        # Like SMTP mailers, serialize the message.
+        message.to_message().as_bytes()
+        self.sent += 1
+
+
+def make_registry(hooks_count, regexps, group_size, html=False):
+    storage = Storage()
+    storage.create("bucket", "", {"id": "b"})
+    members = ["account:user%s@example.com" % i for i in range(group_size)]
+    storage.create("group", "/buckets/b", {"id": "g", "members": members})
+    recipients = ["/buckets/b/groups/g"] if group_size else ["me@example.com"]
+    # Only the first hook matches the events.
+    hooks = [
+        {
+            "action": "create",
+            "collection_id": ("^c-%s$" if regexps else "c-%s") % i,
+            "sender": "kinto@example.com",
+            "subject": "Record {id} created",
+            "template": "Record {id} was created in {bucket_id}/{collection_id}.",
+            "recipients": recipients,
+        }
+        for i in range(hooks_count)
+    ]
+    if html:
+        for hook in hooks:
+            hook["html_template"] = (
+                "<p>Record <b>{{ id }}</b> was created in {{ bucket_id }}/{{ collection_id }}.</p>"
+            )
+    collection = {"id": "c-0", "kinto-emailer": {"hooks": hooks}} if hooks else {"id": "c-0"}
+    storage.create("collection", "/buckets/b", collection)
+
+    registry = Registry()
+    registry.storage = storage
+    registry.settings = {"project_name": "Kinto"}
+    registry.registerUtility(StubMailer(), IMailer)
+    return registry
+
+
+def make_event(registry, batch_size):
+    request = SimpleNamespace(
+        registry=registry,
+        bound_data={},
+        client_addr="127.0.0.1",
+        user_agent="bench",
+        route_url=lambda name: "http://localhost:8888/v1/",
+    )
+    payload = {
+        "action": "create",
+        "resource_name": "record",
+        "bucket_id": "b",
+        "collection_id": "c-0",
+        "uri": "/buckets/b/collections/c-0/records",
+    }
+    impacted = [{"new": {"id": "r%s" % i, "last_modified": i}} for i in range(batch_size)]
+    return ResourceChanged(payload, impacted, request)
+
+
+def run_scenario(batch_size, hooks_count, regexps, group_size, repeat, html=False):
+    registry = make_registry(hooks_count, regexps, group_size, html)
+    # Forget the hooks and groups of the previous scenario's storage.
+    resolved_hooks.clear()
+    group_emails.clear()
+
+    # Warm up caches (compiled hooks, groups members).
+    event = make_event(registry, batch_size)
+    build_notification(event)
+    send_notification(event)
+    expected = batch_size if hooks_count else 0
+    assert registry.getUtility(IMailer).sent == expected, "Messages were not sent"
+
+    build_times, send_times = [], []
+    for _ in range(repeat):
+        event = make_event(registry, batch_size)
+        start = time.perf_counter()
+        build_notification(event)
+        built = time.perf_counter()
+        send_notification(event)
+        build_times.append(built - start)
+        send_times.append(time.perf_counter() - built)
+
+    # Memory is measured apart, since tracing slows everything down.
+    event = make_event(registry, batch_size)
+    tracemalloc.start()
+    try:
+        build_notification(event)
+        send_notification(event)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return {
+        "build_ms": min(build_times) * 1000,
+        "send_ms": min(send_times) * 1000,
+        "peak_kib": peak / 1024,
+    }
+
+
+def scenario_name(batch_size, hooks_count, regexps, group_size, html=False):
+    filters = "regexp" if regexps else "exact"
+    name = "batch=%s hooks=%s filters=%s group=%s" % (batch_size, hooks_count, filters, group_size)
+    return name + " html" if html else name
+
+
+def compare(results, baseline, threshold):
+    """Print the variation of each metric, and return the list of regressions."""
+    regressions = []
+    print("\n%-50s %10s %10s %10s" % ("scenario (vs. baseline)", *METRICS))
+    for name, result in results.items():
+        before = baseline.get(name)
+        if before is None:
+            continue
+        deltas = [(result[m] - before[m]) / before[m] if before[m] else 0 for m in METRICS]
+        print("%-50s %+9.0f%% %+9.0f%% %+9.0f%%" % (name, *(d * 100 for d in deltas)))
+        regressions += ["%s %s" % (name, m) for m, d in zip(METRICS, deltas) if d > threshold]
+    return regressions
+
+
+def parse_sizes(value):
+    return [int(v) for v in value.split(",")]
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--batch-sizes", type=parse_sizes, default=[1, 10, 100, 1000])
+    parser.add_argument("--hooks", type=parse_sizes, default=[0, 1, 10, 100])
+    parser.add_argument("--group-sizes", type=parse_sizes, default=[0, 10, 100])
+    parser.add_argument("--templates", type=lambda v: v.split(","), default=["format", "html"])
+    parser.add_argument("--repeat", type=int, default=10, help="Runs per scenario")
+    parser.add_argument("--save", help="Save the results in this JSON file")
+    parser.add_argument("--compare", help="Compare the results with this JSON file")
+    parser.add_argument("--threshold", type=float, default=0.25, help="Tolerated slowdown")
+    args = parser.parse_args(args)
+
+    results = {}
+    print("%-50s %10s %10s %10s" % ("scenario", *METRICS))
+    htmls = [template == "html" for template in args.templates]
+    grid = itertools.product(args.batch_sizes, args.hooks, (False, True), args.group_sizes, htmls)
+    for batch_size, hooks_count, regexps, group_size, html in grid:
+        if hooks_count == 0 and (regexps or group_size or html):
+            # Filters, groups and templates are irrelevant without hooks.
+            continue
+        name = scenario_name(batch_size, hooks_count, regexps, group_size, html)
+        result = run_scenario(batch_size, hooks_count, regexps, group_size, args.repeat, html)
+        results[name] = result
+        print("%-50s %10.3f %10.3f %10.1f" % (name, *(result[m] for m in METRICS)))
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump({"python": platform.python_version(), "results": results}, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)["results"]
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print("\nRegressions above %.0f%%:" % (args.threshold * 100))
+            print("\n".join("  " + r for r in regressions))
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,50 @@
+"""Compare the hooks routing index with a linear scan of every hook.
+
+::
+
+    $ python benchmarks/bench_routing.py
+"""
+
+import timeit
+
+from kinto_emailer.hooks import HookIndex
+
+
+def make_hooks(count):
+    # Every hook targets a specific collection, a few ones rely on regexps.
+    hooks = []
+    for i in range(count):
+        hook = {"template": "Changed {id}.", "recipients": ["me@you.com"]}
+        if i % 10 == 0:
+            hook["collection_id"] = "^cid-%s$" % i
+        else:
+            hook["collection_id"] = "cid-%s" % i
+            hook["action"] = "update"
+        hooks.append(hook)
+    return hooks
+
+
+def main():
+    context = {"collection_id": "cid-7", "action": "update", "resource_name": "record"}
+    print("%8s %14s %14s %8s" % ("hooks", "linear (µs)", "index (µs)", "speedup"))
+    for count in (10, 100, 1000):
+        index = HookIndex(make_hooks(count))
+
+        def linear():
+            return [hook for hook in index.hooks if hook.matches(context)]
+
+        def indexed():
+            return list(index.match(context))
+
+        assert linear() == indexed()
+        number = 200000 // count
+        linear_time = min(timeit.repeat(linear, number=number, repeat=5)) / number * 1e6
+        indexed_time = min(timeit.repeat(indexed, number=number, repeat=5)) / number * 1e6
+        print(
+            "%8s %14.2f %14.2f %7.1fx"
+            % (count, linear_time, indexed_time, linear_time / indexed_time)
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,94 +1,234 @@
+import atexit
+import contextlib
+import copy
+import itertools
 import logging
 import re
+import time
+from collections import Counter, namedtuple
+from email.utils import parseaddr
 
 from kinto.core.errors import raise_invalid
 from kinto.core.events import AfterResourceChanged, ResourceChanged
-from kinto.core.storage import exceptions as storage_exceptions
+from kinto.core.metrics import NoOpMetricsService
 from pyramid.settings import asbool
 from pyramid_mailer import get_mailer
+from pyramid_mailer.interfaces import IMailer
 from pyramid_mailer.message import Message
 
+from kinto_emailer import ratelimit
+from kinto_emailer.asyncsmtp import AsyncDelivery
+from kinto_emailer.cache import LRUCache
+from kinto_emailer.context import EventContext, ObjectContext
+from kinto_emailer.deadletter import DeadLetters
+from kinto_emailer.delivery import BackgroundDelivery
+from kinto_emailer.hooks import EMAIL_REGEXP, GROUP_REGEXP, compile_hooks, compiled_hooks
+from kinto_emailer.loader import StorageLoader
+from kinto_emailer.mailers import mailer_from_settings, single_connection
+from kinto_emailer.outbox import Outbox
+from kinto_emailer.retry import RetryPolicy, deliver
+from kinto_emailer.spool import Spool
+
 
 logger = logging.getLogger(__name__)
 
+# Email addresses of groups members, by group URI.
+group_emails = LRUCache(maxsize=1000, ttl=60)
 
-EMAIL_REGEXP = re.compile(r"^(.*<[^@<>\s]+@[^@<>\s]+>)|([^@<>\s]+@[^@<>\s]+)$")
-GROUP_REGEXP = re.compile(r"^/buckets/[^/]+/groups/[^/]+$")
+# Hooks of the records events, by (bucket_id, collection_id).
+resolved_hooks = LRUCache(maxsize=1000, ttl=60)
 
+# A message to be rendered once the transaction is committed.
+PendingMessage = namedtuple("PendingMessage", ["hook", "context", "recipients"])
 
-def qualname(obj):
-    """
-    >>> str(msg.__class__)
-    "<class 'pyramid_mailer.message.Message'>"
-    >>> str(msg.__class__).split("'")
-    ['<class ', 'pyramid_mailer.message.Message', '>']
-    """
-    return str(obj.__class__).split("'")[1]
+# The pending messages of a request, in its ``bound_data``.
+MESSAGES_KEY = "kinto_emailer.messages"
 
+# The cache keys invalidated by a request, in its ``bound_data``: it reads its own
+# uncommitted changes for them, which must not be cached in case they are rolled back.
+# Holds (bucket_id, collection_id) tuples, (bucket_id, None) for the whole bucket, and
+# group URIs.
+INVALIDATED_KEY = "kinto_emailer.invalidated"
 
-def context_from_event(event):
-    root_url = event.request.route_url("hello")
-    context = dict(
-        event=qualname(event),
-        root_url=root_url,
-        client_address=event.request.client_addr,
-        user_agent=event.request.user_agent,
-        impacted_objects=event.impacted_objects,
-        **event.payload,
-    )
-
-    context["settings"] = {
-        k: v
-        for k, v in event.request.registry.settings.items()
-        if k in ("project_name", "project_version", "url")
-    }
 
-    # The following payload attributes are not always present.
-    # See Kinto/kinto#945
-    context.setdefault("record_id", "{record_id}")
-    context.setdefault("collection_id", "{collection_id}")
-    return context
+def context_from_event(event):
+    return EventContext(event)
 
 
 def build_notification(event):
     resource_name = event.payload["resource_name"]
-    storage = event.request.registry.storage
+    invalidated = event.request.bound_data.get(INVALIDATED_KEY, set())
+    if resource_name == "record":
+        key = (event.payload["bucket_id"], event.payload["collection_id"])
+        hooks = None if _hooks_invalidated(key, invalidated) else resolved_hooks.get(key)
+        if hooks is not None and len(hooks) == 0:
+            # Most buckets and collections have no hooks, return early.
+            return
+
+    loader = StorageLoader.from_event(event, skip=resolved_hooks)
     context = context_from_event(event)
+    # Hooks are resolved once per (bucket, collection) for the whole event.
+    hooks_cache = {}
 
     # Build every email for every impacted objects.
-    messages = []
+    contexts = []
     for impacted in event.impacted_objects:
         # Maybe context reliable on batch requests.
         # See Kinto/kinto#945
-        _context = context.copy()
         object_id = impacted.get("new", impacted.get("old"))["id"]
-        _context[resource_name + "_id"] = _context["id"] = object_id
-        messages += get_messages(storage, _context)
+        contexts.append(ObjectContext(context, resource_name + "_id", object_id))
+    metrics = _get_metrics(event.request.registry)
+    pending = _get_pending_messages(
+        loader,
+        contexts,
+        hooks_cache=hooks_cache,
+        metrics=metrics,
+        resolved=resolved_hooks,
+        invalidated=invalidated,
+    )
+    if not pending:
+        return
+    _count_messages(metrics, event.payload["bucket_id"], "built", len(pending))
+
+    registry = event.request.registry
+    if registry.settings.get("emailer.delivery") == "outbox":
+        # Store them within the transaction, they will be sent by ``kinto-emailer-outbox``.
+        _add_to_outbox(registry, pending, metrics)
+        return
 
-    # Store the list in the current request, they will be sent from a
-    # post commit hook (we don't send them if DB transaction is rolledback).
-    setattr(event.request, "_kinto_emailer_messages", messages)
+    # Accumulate the messages of every event of the request (e.g. batch), they will be
+    # rendered and sent from a post commit hook (we don't send them if DB transaction
+    # is rolledback).
+    event.request.bound_data.setdefault(MESSAGES_KEY, []).extend(pending)
 
 
 def send_notification(event):
     # At this point, we can't use `storage` because the transaction was committed.
-    messages = event.request._kinto_emailer_messages
-    settings = event.request.registry.settings
+    # The messages of every event of the request are sent at once, on the first event.
+    pending = event.request.bound_data.pop(MESSAGES_KEY, None)
+    if not pending:
+        return
+    registry = event.request.registry
+    settings = registry.settings
     mailer = get_mailer(event.request)
-    try:
-        for message in messages:
-            if settings.get("mail.queue_path") is None:
-                mailer.send_immediately(message, fail_silently=False)
+    delivery = settings.get("emailer.delivery")
+    max_items = int(settings.get("emailer.digest.max_items", 100))
+    metrics = _get_metrics(registry)
+    # Messages are rendered one at a time, while being sent.
+    rendered = _render_messages(pending, max_items, metrics=metrics)
+    if ratelimit.is_enabled(settings):
+        rendered = _rate_limit(registry, rendered, metrics)
+    if delivery == "spool":
+        # They will be merged and sent periodically by ``kinto-emailer-flush``.
+        try:
+            rendered = list(rendered)
+            registry.emailer_spool.add(message for _, message in rendered)
+            _count_by_bucket(metrics, [first for first, _ in rendered], "queued")
+        except Exception:
+            _count_by_bucket(metrics, pending, "failed")
+            logger.exception("Could not send notifications")
+        return
+
+    retry = RetryPolicy.from_settings(settings)
+    # The messages sent inline share one deadline, since they delay the response.
+    retry.deadline = time.monotonic() + retry.max_time
+    dead_letters = DeadLetters.from_settings(settings)
+    queued = settings.get("mail.queue_path") is not None
+    inline = not queued and delivery not in ("background", "async")
+    # Only the messages sent inline reuse a connection, which is closed at the end of the
+    # block: the worker threads (or event loop) send them later, with the registry mailer.
+    with single_connection(mailer) if inline else contextlib.nullcontext(mailer) as session:
+        for first, message in rendered:
+            # A failure does not prevent the next messages from being sent.
+            try:
+                if queued:
+                    mailer.send_to_queue(message)
+                    status = "queued"
+                elif not inline:
+                    # Hand over to the worker threads (or event loop), SMTP latency does not
+                    # impact the response.
+                    enqueued = registry.emailer_delivery.enqueue(mailer, message)
+                    status = "queued" if enqueued else "dropped"
+                else:
+                    with metrics.timer("emailer.send.seconds"):
+                        sent = deliver(session, message, retry=retry, dead_letters=dead_letters)
+                    status = "sent" if sent else "failed"
+                    if not sent:
+                        # The relay is likely down: do not hold the response any longer.
+                        retry.attempts = 1
+            except Exception:
+                status = "failed"
+                logger.exception("Could not send notification")
+            _count_messages(metrics, first.context["bucket_id"], status)
+
+
+def _add_to_outbox(registry, pending, metrics):
+    settings = registry.settings
+    max_items = int(settings.get("emailer.digest.max_items", 100))
+    rendered = _render_messages(pending, max_items, metrics=metrics)
+    if ratelimit.is_enabled(settings):
+        rendered = _rate_limit(registry, rendered, metrics)
+    rendered = list(rendered)
+    # Failures are not caught: the request fails and its transaction is rolled back.
+    registry.emailer_outbox.add(message for _, message in rendered)
+    _count_by_bucket(metrics, [first for first, _ in rendered], "queued")
+
+
+def _rate_limit(registry, rendered, metrics):
+    """Yield the rendered messages within the rate limits, without the
+    recipients that are over the limit.
+
+    Depending on the policy, the messages for the others are dropped or
+    stored in the spool, to be sent in the next digest.
+    """
+    limiter = registry.emailer_rate_limiter
+    for first, message in rendered:
+        allowed = limiter.limit(first.hook.key, message.recipients)
+        limited = [r for r in message.recipients if r not in allowed]
+        if limited:
+            if limiter.policy == "digest":
+                deferred = copy.copy(message)
+                deferred.recipients = limited
+                try:
+                    registry.emailer_spool.add([deferred])
+                    status = "deferred"
+                except Exception:
+                    status = "failed"
+                    logger.exception("Could not defer notification")
             else:
-                mailer.send_to_queue(message)
-    except Exception:
-        logger.exception("Could not send notifications")
+                status = "rate_limited"
+            _count_messages(metrics, first.context["bucket_id"], status)
+        if allowed:
+            message.recipients = allowed
+            yield first, message
+
+
+def _get_metrics(registry):
+    # The metrics service is missing if ``kinto.core.initialization.setup_metrics``
+    # is not part of the initialization sequence.
+    return getattr(registry, "metrics", None) or NoOpMetricsService()
 
 
-def _get_emailer_hooks(storage, context):
+def _count_messages(metrics, bucket_id, status, count=1):
+    labels = [("bucket_id", bucket_id), ("status", status)]
+    metrics.count("emailer.messages", count=count, unique=labels)
+
+
+def _count_by_bucket(metrics, pending, status):
+    for bucket_id, count in Counter(p.context["bucket_id"] for p in pending).items():
+        _count_messages(metrics, bucket_id, status, count)
+
+
+def _get_emailer_hooks(loader, context, resolved=None, invalidated=()):
+    """Return the hooks of the context collection, or of its bucket if the
+    collection has no ``kinto-emailer`` metadata.
+
+    For records, the hooks are kept in ``resolved`` (if specified) by
+    (bucket_id, collection_id), and storage is not read again, unless they
+    were ``invalidated`` by the current request.
+    """
     bucket_id = context["bucket_id"]
     collection_id = context["collection_id"]
-    bucket_uri = "/buckets/%s" % bucket_id
     # Look-up collection metadata.
     # If the event is on the collection, do not rely on storage, use the event payload.
     if context["resource_name"] == "collection":
@@ -96,72 +236,220 @@ def _get_emailer_hooks(storage, context):
             impacted["old"] if context["action"] == "delete" else impacted["new"]
             for impacted in context["impacted_objects"]
         )
-    else:
+        return _resolve_hooks(loader, bucket_id, metadata.get("id"), metadata)
+
+    key = (bucket_id, collection_id)
+    if _hooks_invalidated(key, invalidated):
+        resolved = None
+    hooks = resolved.get(key) if resolved is not None else None
+    if hooks is None:
         # For records, look up storage.
-        metadata = storage.get(
-            parent_id=bucket_uri, resource_name="collection", object_id=collection_id
+        metadata = loader.get(
+            parent_id="/buckets/%s" % bucket_id,
+            resource_name="collection",
+            object_id=collection_id,
         )
+        hooks = _resolve_hooks(loader, bucket_id, collection_id, metadata)
+        if resolved is not None:
+            resolved.set(key, hooks)
+    return hooks
 
-    if "kinto-emailer" not in metadata:
-        # Try in bucket metadata.
-        metadata = storage.get(parent_id="", resource_name="bucket", object_id=bucket_id)
+
+def _resolve_hooks(loader, bucket_id, collection_id, metadata):
+    bucket_uri = "/buckets/%s" % bucket_id
+    if "kinto-emailer" in metadata:
+        return compile_hooks("%s/collections/%s" % (bucket_uri, collection_id), metadata)
+    # Try in bucket metadata.
+    metadata = loader.get(parent_id="", resource_name="bucket", object_id=bucket_id)
     # Returns empty list of hooks.
-    return metadata.get("kinto-emailer", {}).get("hooks", [])
+    return compile_hooks(bucket_uri, metadata)
 
 
-def _expand_recipients(storage, recipients, context):
-    emails = [r for r in recipients if not GROUP_REGEXP.match(r)]
-    # Group name using context (eg. /buckets/staging/{collection_id}-reviewers).
-    groups = [r.format(**context) for r in recipients if GROUP_REGEXP.match(r.format(**context))]
-    # Obtain group members from storage.
-    for group_uri in groups:
-        bucket_uri, group_id = group_uri.split("/groups/")
-        try:
-            group = storage.get(parent_id=bucket_uri, resource_name="group", object_id=group_id)
-        except storage_exceptions.RecordNotFoundError:
-            continue
-        # Take out prefix from user ids (e.g. "ldap:mathieu@mozilla.com")
-        unprefixed_members = [m.split(":", 1)[-1] for m in group["members"]]
-        # Keep only group members that are email addresses.
-        emails.extend([m for m in unprefixed_members if EMAIL_REGEXP.match(m)])
+def _hooks_invalidated(key, invalidated):
+    return key in invalidated or (key[0], None) in invalidated
+
 
+def _invalidate_resolved_hooks(event):
+    resource_name = event.payload["resource_name"]
+    invalidated = event.request.bound_data.setdefault(INVALIDATED_KEY, set())
+    for impacted in event.impacted_objects:
+        object_id = impacted.get("new", impacted.get("old"))["id"]
+        if resource_name == "collection":
+            key = (event.payload["bucket_id"], object_id)
+            invalidated.add(key)
+            resolved_hooks.pop(key)
+        else:
+            invalidated.add((object_id, None))
+            # The bucket hooks apply to every collection without hooks.
+            for key in resolved_hooks.keys():
+                if key[0] == object_id:
+                    resolved_hooks.pop(key)
+
+
+def _get_groups_emails(loader, group_uris, invalidated=()):
+    """Return the email addresses of the specified groups members, by group URI.
+
+    Groups that are not in cache, or that were ``invalidated`` by the current
+    request, are loaded from storage all at once.
+    """
+    emails = {}
+    missing = []
+    for group_uri in dict.fromkeys(group_uris):
+        members = None if group_uri in invalidated else group_emails.get(group_uri)
+        if members is None:
+            missing.append(group_uri)
+        else:
+            emails[group_uri] = members
+
+    for group_uri, group in loader.get_groups(missing).items():
+        members = [] if group is None else _members_emails(group)
+        if group_uri not in invalidated:
+            group_emails.set(group_uri, members)
+        emails[group_uri] = members
     return emails
 
 
-def _match(hook, context):
-    # Allow support of regexps in fields, if they start with ^
-    if hook.startswith("^"):
-        return re.match(hook, context)
-    return hook == context
-
-
-def get_messages(storage, context):
-    hooks = _get_emailer_hooks(storage, context)
-    filters = ("event", "action", "resource_name", "id", "record_id", "collection_id")
-    messages = []
-    for hook in hooks:
-        # Filter out hook if it doesn't meet current event attributes, and keep
-        # if nothing is specified.
-        conditions_met = all(
-            [
-                field not in hook or field not in context or _match(hook[field], context[field])
-                for field in filters
-            ]
-        )
-        if not conditions_met:
-            continue
+def _members_emails(group):
+    # Take out prefix from user ids (e.g. "ldap:mathieu@mozilla.com")
+    unprefixed_members = [m.split(":", 1)[-1] for m in group["members"]]
+    # Keep only group members that are email addresses.
+    return [m for m in unprefixed_members if EMAIL_REGEXP.match(m)]
 
-        msg = hook["template"].format(**context)
-        subject = hook.get("subject", "New message").format(**context)
-        recipients = _expand_recipients(storage, hook["recipients"], context)
 
-        if not recipients:
-            continue
+def _invalidate_group_emails(event):
+    bucket_uri = "/buckets/%s" % event.payload["bucket_id"]
+    invalidated = event.request.bound_data.setdefault(INVALIDATED_KEY, set())
+    for impacted in event.impacted_objects:
+        group_id = impacted.get("new", impacted.get("old"))["id"]
+        group_uri = "%s/groups/%s" % (bucket_uri, group_id)
+        invalidated.add(group_uri)
+        group_emails.pop(group_uri)
+
+
+def _render_message(hook, context, recipients):
+    subject = hook.subject.render(context)
+    body = hook.template.render(context)
+    # With an HTML template, messages are sent as multipart/alternative.
+    html = hook.html_template.render(context) if hook.html_template is not None else None
+    return Message(
+        subject=subject, sender=hook.sender, recipients=recipients, body=body, html=html
+    )
 
-        messages.append(
-            Message(subject=subject, sender=hook.get("sender"), recipients=recipients, body=msg)
-        )
-    return messages
+
+def _finish_digest(digest, messages):
+    digest.body = "\n".join(m.body for m in messages)
+    if digest.html is not None:
+        digest.html = "\n".join(m.html for m in messages if m.html is not None)
+    return digest
+
+
+def _unique_recipients(recipients):
+    """Remove the duplicate addresses (case-insensitive), keeping the first of each."""
+    unique = {}
+    for recipient in recipients:
+        recipient = recipient.strip()
+        address = parseaddr(recipient)[1] or recipient
+        unique.setdefault(address.lower(), recipient)
+    return list(unique.values())
+
+
+def _merge_messages(rendered):
+    """Merge the messages with the same sender, subject and body into one
+    message to all their recipients.
+    """
+    merged = {}
+    for pending, message in rendered:
+        key = (pending.hook.digest, message.sender, message.subject, message.body, message.html)
+        if key in merged:
+            first = merged[key][1]
+            first.recipients = _unique_recipients(first.recipients + message.recipients)
+        else:
+            merged[key] = (pending, message)
+    return list(merged.values())
+
+
+def _render_messages(pending, max_items, metrics=None):
+    """Render the pending messages one object at a time, and yield them with
+    their (first) pending message.
+
+    The identical messages of an object (e.g. from several hooks) are sent once
+    to all their recipients. The messages of hooks with ``digest`` enabled are
+    merged into one email per (sender, recipients, subject), whose body lists the
+    rendered templates (at most ``max_items`` per email).
+    """
+    metrics = metrics or NoOpMetricsService()
+    digests = {}
+    # The messages of an object are consecutive.
+    for _, same_object in itertools.groupby(pending, key=lambda p: id(p.context)):
+        rendered = []
+        for message in same_object:
+            try:
+                with metrics.timer("emailer.render.seconds"):
+                    rendered.append((message, _render_message(*message)))
+            except Exception:
+                # Skip this message, but render the next ones.
+                _count_messages(metrics, message.context["bucket_id"], "failed")
+                logger.exception("Could not render notification")
+        yield from _merge_digests(_merge_messages(rendered), digests, max_items)
+
+    for first, digest, messages in digests.values():
+        yield first, _finish_digest(digest, messages)
+
+
+def _merge_digests(rendered, digests, max_items):
+    """Yield the messages, except those of digests, which are yielded once full."""
+    for pending, message in rendered:
+        if not pending.hook.digest:
+            yield pending, message
+            continue
+        key = (message.sender, tuple(sorted(message.recipients)), message.subject)
+        # Digests are attributed to their first message (e.g. for its hook and bucket).
+        first, digest, messages = digests.setdefault(key, (pending, message, []))
+        messages.append(message)
+        if len(messages) >= max_items:
+            del digests[key]
+            yield first, _finish_digest(digest, messages)
+
+
+def get_messages(storage, context, hooks_cache=None):
+    loader = StorageLoader(storage)
+    rendered = [
+        (pending, _render_message(*pending))
+        for pending in _get_pending_messages(loader, [context], hooks_cache)
+    ]
+    return [message for _, message in _merge_messages(rendered)]
+
+
+def _get_pending_messages(
+    loader, contexts, hooks_cache=None, metrics=None, resolved=None, invalidated=()
+):
+    if hooks_cache is None:
+        hooks_cache = {}
+    metrics = metrics or NoOpMetricsService()
+
+    # Select the matching hooks for every context.
+    matches = []
+    with metrics.timer("emailer.hooks.seconds"):
+        for context in contexts:
+            key = (context["bucket_id"], context["collection_id"])
+            if key not in hooks_cache:
+                hooks_cache[key] = _get_emailer_hooks(loader, context, resolved, invalidated)
+            for hook in hooks_cache[key].match(context):
+                matches.append((context, hook, hook.render_groups(context)))
+
+    pending = []
+    with metrics.timer("emailer.recipients.seconds"):
+        # Obtain the members of every group at once.
+        group_uris = [uri for _, _, uris in matches for uri in uris]
+        groups = _get_groups_emails(loader, group_uris, invalidated)
+
+        for context, hook, group_uris in matches:
+            recipients = _unique_recipients(
+                hook.emails + [email for uri in group_uris for email in groups[uri]]
+            )
+            if recipients:
+                pending.append(PendingMessage(hook, context, recipients))
+    return pending
 
 
 def _validate_emailer_settings(event):
@@ -187,6 +475,10 @@ def _validate_emailer_settings(event):
             except KeyError:
                 raise_invalid(request, description='Missing "template".')
 
+            html_template = hook.get("html_template")
+            if html_template is not None and not isinstance(html_template, str):
+                raise_invalid(request, description='Invalid "html_template".')
+
             recipients = hook.get("recipients", [])
             if not recipients:
                 raise_invalid(request, description="Empty list of recipients.")
@@ -205,12 +497,68 @@ def _validate_emailer_settings(event):
                 error_msg = "Invalid bucket for groups %s" % ", ".join(invalid_groups)
                 raise_invalid(request, description=error_msg)
 
+        # Compile the hooks now, they will be ready for the next notifications.
+        uri = bucket_uri
+        if resource_name == "collection":
+            uri += "/collections/%s" % metadata["id"]
+        try:
+            compiled = compile_hooks(uri, metadata)
+        except re.error as e:
+            raise_invalid(request, description="Invalid filter regexp (%s)." % e)
+        for hook in compiled.hooks:
+            if hook.html_template is not None and hook.html_template.error is not None:
+                error_msg = "Invalid HTML template (%s)." % hook.html_template.error
+                raise_invalid(request, description=error_msg)
+
 
 def includeme(config):
     # Include the mailer
     settings = config.get_settings()
     debug = asbool(settings.get("mail.debug_mailer", "false"))
     config.include("pyramid_mailer" + (".debug" if debug else ""))
+    pool_size = int(settings.get("mail.pool_size") or 0)
+    if not debug and (pool_size or settings.get("mail.relays")):
+        # Reuse SMTP connections across messages and requests, or spread them across relays.
+        mailer = mailer_from_settings(settings)
+        config.registry.registerUtility(mailer, IMailer)
+        if hasattr(mailer.smtp_mailer, "close"):
+            atexit.register(mailer.smtp_mailer.close)
+
+    compiled_hooks.maxsize = int(settings.get("emailer.hooks_cache_size", 1000))
+    resolved_hooks.maxsize = int(settings.get("emailer.resolved_hooks_cache_size", 1000))
+    ttl = settings.get("emailer.resolved_hooks_cache_ttl", 60)
+    resolved_hooks.ttl = float(ttl) if ttl not in (None, "") else None
+    group_emails.maxsize = int(settings.get("emailer.groups_cache_size", 1000))
+    ttl = settings.get("emailer.groups_cache_ttl", 60)
+    group_emails.ttl = float(ttl) if ttl not in (None, "") else None
+
+    # Optionally deliver emails from background threads.
+    if settings.get("emailer.delivery") == "background":
+        delivery = BackgroundDelivery.from_settings(settings)
+        config.registry.emailer_delivery = delivery
+        atexit.register(delivery.shutdown)
+    # Or concurrently from an asyncio event loop.
+    if settings.get("emailer.delivery") == "async":
+        delivery = AsyncDelivery.from_settings(settings)
+        config.registry.emailer_delivery = delivery
+        atexit.register(delivery.shutdown)
+    # Optionally limit the rate of messages.
+    if ratelimit.is_enabled(settings):
+        limiter = ratelimit.RateLimiter.from_settings(settings, cache=config.registry.cache)
+        config.registry.emailer_rate_limiter = limiter
+    else:
+        limiter = None
+    # Or in the storage backend, within the transaction, to be sent by a dispatcher.
+    if settings.get("emailer.delivery") == "outbox":
+        if getattr(limiter, "policy", None) == "digest":
+            # The deferred messages would be spooled before commit, even if the change
+            # is rolled back.
+            raise ValueError("The digest rate limit policy cannot be used with the outbox")
+        config.registry.emailer_outbox = Outbox.from_settings(settings, config.registry.storage)
+    # Or store them in a local spool, to be merged and sent periodically.
+    # Messages over the rate limits can also be deferred to the spool.
+    if settings.get("emailer.delivery") == "spool" or getattr(limiter, "policy", None) == "digest":
+        config.registry.emailer_spool = Spool.from_settings(settings)
 
     # Expose the capabilities in the root endpoint.
     message = "Provide emailing capabilities to the server."
@@ -228,6 +576,18 @@ def includeme(config):
         for_actions=("create", "update"),
     )
 
+    # Forget cached group members when groups change. Groups are also forgotten
+    # after commit, in case they were read again from storage during the transaction.
+    for event_cls in (ResourceChanged, AfterResourceChanged):
+        config.add_subscriber(_invalidate_group_emails, event_cls, for_resources=("group",))
+
+    # Forget the hooks of records when buckets and collections change, before and
+    # after commit (like groups).
+    for event_cls in (ResourceChanged, AfterResourceChanged):
+        config.add_subscriber(
+            _invalidate_resolved_hooks, event_cls, for_resources=("bucket", "collection")
+        )
+
     # Listen to collection and record change events.
     config.add_subscriber(
         build_notification, ResourceChanged, for_resources=("record", "collection")
@@ -0,0 +1,223 @@
+import asyncio
+import logging
+import os
+import threading
+import time
+
+from pyramid.settings import asbool
+
+from kinto_emailer.deadletter import DeadLetters
+from kinto_emailer.retry import RetryPolicy, is_transient
+
+
+try:
+    import aiosmtplib
+except ImportError:  # pragma: no cover
+    aiosmtplib = None
+
+
+logger = logging.getLogger(__name__)
+
+
+def is_transient_async(error):
+    """Like :func:`kinto_emailer.retry.is_transient`, for ``aiosmtplib`` errors."""
+    if isinstance(error, aiosmtplib.SMTPRecipientsRefused):
+        return all(400 <= r.code < 500 for r in error.recipients)
+    if isinstance(error, aiosmtplib.SMTPResponseException):
+        return 400 <= error.code < 500
+    # Disconnections and timeouts are ``OSError``.
+    return is_transient(error)
+
+
+class AsyncDelivery:
+    """Send messages concurrently from an asyncio event loop, which runs in a
+    dedicated thread.
+
+    At most ``concurrency`` messages are sent at once, each over its own SMTP
+    connection. Connections are kept open and reused by the next messages.
+    At most ``queue_size`` messages can wait to be sent, the next ones are
+    dropped.
+
+    Like :class:`kinto_emailer.delivery.BackgroundDelivery`, the event loop is
+    started lazily on the first message (and again after a fork).
+    """
+
+    def __init__(
+        self,
+        hostname="localhost",
+        port=25,
+        username=None,
+        password=None,
+        use_tls=False,
+        start_tls=None,
+        timeout=60,
+        concurrency=10,
+        queue_size=1000,
+        shutdown_timeout=10,
+        retry=None,
+        dead_letters=None,
+    ):
+        if aiosmtplib is None:
+            raise ValueError(
+                "Async delivery requires aiosmtplib (pip install kinto-emailer[async])"
+            )
+        self.smtp_options = dict(
+            hostname=hostname,
+            port=port,
+            username=username,
+            password=password,
+            use_tls=use_tls,
+            start_tls=start_tls,
+            timeout=timeout,
+        )
+        self.concurrency = concurrency
+        self.queue_size = queue_size
+        self.shutdown_timeout = shutdown_timeout
+        self.retry = retry or RetryPolicy(attempts=1)
+        self.dead_letters = dead_letters
+        self._lock = threading.Lock()
+        self._pid = None
+        self._loop = None
+        self._thread = None
+        self._pending = set()
+
+    @classmethod
+    def from_settings(cls, settings, prefix="emailer.async."):
+        """Read the SMTP server options from the ``pyramid_mailer`` settings."""
+        port = settings.get("mail.port")
+        tls = settings.get("mail.tls")
+        return cls(
+            hostname=settings.get("mail.host", "localhost"),
+            port=int(port) if port else 25,
+            username=settings.get("mail.username"),
+            password=settings.get("mail.password"),
+            use_tls=asbool(settings.get("mail.ssl", False)),
+            start_tls=asbool(tls) if tls is not None else None,
+            timeout=float(settings.get(prefix + "timeout", 60)),
+            concurrency=int(settings.get(prefix + "concurrency", 10)),
+            queue_size=int(settings.get(prefix + "queue_size", 1000)),
+            shutdown_timeout=float(settings.get(prefix + "shutdown_timeout", 10)),
+            retry=RetryPolicy.from_settings(settings),
+            dead_letters=DeadLetters.from_settings(settings),
+        )
+
+    def _ensure_started(self):
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._pending = set()
+            self._loop = asyncio.new_event_loop()
+            # Created in the loop thread, once it runs.
+            self._semaphore = self._idle = None
+            self._thread = threading.Thread(
+                target=self._loop.run_forever, name="kinto-emailer-async", daemon=True
+            )
+            self._thread.start()
+
+    async def _acquire(self):
+        while self._idle:
+            smtp = self._idle.pop()
+            if smtp.is_connected:
+                return smtp
+        smtp = aiosmtplib.SMTP(**self.smtp_options)
+        await smtp.connect()
+        return smtp
+
+    async def _close(self, smtp):
+        try:
+            await smtp.quit()
+        except Exception:
+            smtp.close()
+
+    async def _send_once(self, sender, recipients, mime):
+        smtp = await self._acquire()
+        try:
+            await smtp.send_message(mime, sender=sender, recipients=recipients)
+        except Exception:
+            await self._close(smtp)
+            raise
+        self._idle.append(smtp)
+
+    async def _send(self, message, sender, recipients, mime):
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+            self._idle = []
+        async with self._semaphore:
+            deadline = time.monotonic() + self.retry.max_time
+            attempt = 1
+            while True:
+                try:
+                    await self._send_once(sender, recipients, mime)
+                    return True
+                except Exception as e:
+                    delay = self.retry.delay(attempt)
+                    if (
+                        attempt >= self.retry.attempts
+                        or not is_transient_async(e)
+                        or time.monotonic() + delay > deadline
+                    ):
+                        logger.exception("Could not send notification")
+                        break
+                    logger.warning("Could not send notification (%r), retry in %.2fs.", e, delay)
+                    await asyncio.sleep(delay)
+                    attempt += 1
+        if self.dead_letters is not None:
+            try:
+                self.dead_letters.add(message)
+            except Exception:
+                logger.exception("Could not store notification in dead letters")
+        return False
+
+    def enqueue(self, mailer, message):
+        """Schedule the message to be sent, without waiting.
+        Returns ``False`` if the message was dropped because too many are pending.
+        """
+        self._ensure_started()
+        with self._lock:
+            if len(self._pending) >= self.queue_size:
+                logger.warning("Notifications queue is full, message dropped.")
+                return False
+            # Like ``Mailer.send_immediately()``.
+            message.sender = message.sender or getattr(mailer, "default_sender", None)
+            coro = self._send(message, message.sender, message.send_to, message.to_message())
+            future = asyncio.run_coroutine_threadsafe(coro, self._loop)
+            self._pending.add(future)
+        future.add_done_callback(self._done)
+        return True
+
+    def _done(self, future):
+        with self._lock:
+            self._pending.discard(future)
+
+    async def _stop(self):
+        idle, self._idle = self._idle or [], []
+        for smtp in idle:
+            await self._close(smtp)
+        asyncio.get_running_loop().stop()
+
+    def shutdown(self, timeout=None):
+        """Stop the event loop once the pending messages were sent, waiting at
+        most ``timeout`` seconds (default: ``shutdown_timeout``).
+        Returns the number of messages left undelivered.
+        """
+        with self._lock:
+            if self._pid != os.getpid():
+                return 0
+            self._pid = None
+            pending = list(self._pending)
+        timeout = self.shutdown_timeout if timeout is None else timeout
+        deadline = time.monotonic() + timeout
+        for future in pending:
+            try:
+                future.result(max(deadline - time.monotonic(), 0))
+            except Exception:
+                pass
+        left = [future for future in pending if not future.done()]
+        if left:
+            logger.warning("%s notifications were not sent before shutdown.", len(left))
+            for future in left:
+                future.cancel()
+        asyncio.run_coroutine_threadsafe(self._stop(), self._loop)
+        self._thread.join(max(deadline - time.monotonic(), 0))
+        return len(left)
@@ -0,0 +1,45 @@
+import argparse
+import sys
+import time
+
+from pyramid.paster import bootstrap
+from pyramid_mailer import get_mailer
+
+from kinto_emailer.spool import Spool
+
+
+def main(args=None):
+    if args is None:
+        args = sys.argv[1:]
+    parser = argparse.ArgumentParser(description="Send the spooled kinto-emailer notifications.")
+    parser.add_argument("config_file", help="Kinto configuration file")
+    parser.add_argument("--once", action="store_true", help="Flush the spool once and exit")
+    parser.add_argument(
+        "--interval", type=float, help="Seconds between flushes (default: emailer.spool.interval)"
+    )
+    try:
+        args = parser.parse_args(args)
+    except SystemExit as e:
+        return e.code
+
+    print("Load config...")
+    env = bootstrap(args.config_file)
+
+    registry = env["registry"]
+    settings = registry.settings
+    spool = Spool.from_settings(settings)
+    mailer = get_mailer(registry)
+    max_items = int(settings.get("emailer.digest.max_items", 100))
+    interval = args.interval or float(settings.get("emailer.spool.interval", 60))
+
+    try:
+        while True:
+            sent = spool.flush(mailer, max_items=max_items)
+            print("Sent %s emails." % sent)
+            if args.once:
+                break
+            time.sleep(interval)
+    except KeyboardInterrupt:
+        pass
+    print("Done.")
+    return 0
@@ -0,0 +1,187 @@
+import argparse
+import logging
+import multiprocessing
+import queue
+import sys
+import time
+
+import transaction
+from kinto.core.storage.exceptions import BackendError
+from pyramid.paster import bootstrap
+from pyramid_mailer import get_mailer
+
+from kinto_emailer.deadletter import DeadLetters
+from kinto_emailer.mailers import single_connection
+from kinto_emailer.outbox import Outbox
+from kinto_emailer.retry import RetryPolicy
+
+
+logger = logging.getLogger(__name__)
+
+
+def _dispatch(registry, batch_size, interval, once, report):
+    """Send the outbox in batches until interrupted (or until it is empty if
+    ``once``), and call ``report(sent, failed, elapsed)`` after each batch.
+    """
+    settings = registry.settings
+    outbox = Outbox.from_settings(registry.settings, registry.storage)
+    mailer = get_mailer(registry)
+    retry = RetryPolicy.from_settings(settings)
+    dead_letters = DeadLetters.from_settings(settings)
+    while True:
+        started = time.monotonic()
+        try:
+            with single_connection(mailer) as session:
+                # Each lease is committed once created, and the removal of the sent messages after.
+                sent, failed = outbox.dispatch(
+                    session,
+                    limit=batch_size,
+                    retry=retry,
+                    dead_letters=dead_letters,
+                    commit=transaction.commit,
+                )
+            transaction.commit()
+        except BackendError:
+            # E.g. a conflict with another dispatcher, the messages will be claimed again.
+            logger.exception("Could not dispatch the outbox, will retry.")
+            transaction.abort()
+            time.sleep(interval)
+            continue
+        report(sent, failed, time.monotonic() - started)
+        if sent < batch_size:
+            # The outbox is empty (or has failing or claimed messages).
+            if once:
+                return
+            time.sleep(interval)
+
+
+def _work(config_file, batch_size, interval, once, stats):
+    """Entry point of the worker processes, which report to the ``stats`` queue."""
+    env = bootstrap(config_file)
+    try:
+        _dispatch(env["registry"], batch_size, interval, once, lambda *batch: stats.put(batch))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stats.put(None)
+
+
+def main(args=None):
+    if args is None:
+        args = sys.argv[1:]
+    parser = argparse.ArgumentParser(description="Send the kinto-emailer outbox notifications.")
+    parser.add_argument("config_file", help="Kinto configuration file")
+    parser.add_argument("--once", action="store_true", help="Send the pending emails and exit")
+    parser.add_argument(
+        "--processes",
+        type=int,
+        help="Number of worker processes (default: emailer.outbox.processes)",
+    )
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        help="Emails sent per batch (default: emailer.outbox.batch_size)",
+    )
+    parser.add_argument(
+        "--interval",
+        type=float,
+        help="Seconds between checks when the outbox is empty (default: emailer.outbox.interval)",
+    )
+    parser.add_argument(
+        "--stats-interval",
+        type=float,
+        help="Seconds between two reports of the worker processes "
+        "(default: emailer.outbox.stats_interval)",
+    )
+    try:
+        args = parser.parse_args(args)
+    except SystemExit as e:
+        return e.code
+
+    print("Load config...")
+    env = bootstrap(args.config_file)
+
+    registry = env["registry"]
+    settings = registry.settings
+    processes = args.processes or int(settings.get("emailer.outbox.processes", 1))
+    batch_size = args.batch_size or int(settings.get("emailer.outbox.batch_size", 100))
+    interval = args.interval or float(settings.get("emailer.outbox.interval", 1))
+    stats_interval = args.stats_interval or float(
+        settings.get("emailer.outbox.stats_interval", 10)
+    )
+    outbox = Outbox.from_settings(settings, registry.storage)
+
+    totals = [0, 0]
+    start = time.monotonic()
+
+    def report(sent, failed, elapsed):
+        totals[0] += sent
+        totals[1] += failed
+        if sent or failed:
+            print(
+                "Sent %s emails (%s failed) in %.2fs, %.1f emails/s."
+                % (sent, failed, elapsed, sent / elapsed if elapsed else 0)
+            )
+
+    try:
+        if processes == 1:
+            _dispatch(registry, batch_size, interval, args.once, report)
+        else:
+            worker_args = (args.config_file, batch_size, interval, args.once)
+            _supervise(outbox, worker_args, processes, stats_interval, totals)
+    except KeyboardInterrupt:
+        pass
+    elapsed = time.monotonic() - start
+    print("Done. Sent %s emails (%s failed) in %.2fs." % (totals[0], totals[1], elapsed))
+    print("%s requests with emails left in the outbox." % len(outbox))
+    return 0
+
+
+def _supervise(outbox, worker_args, processes, stats_interval, totals):
+    """Run the worker processes, and report their throughput and the outbox
+    backlog every ``stats_interval`` seconds.
+    """
+    # Workers load the configuration themselves, without sharing storage connections.
+    context = multiprocessing.get_context("spawn")
+    stats = context.Queue()
+    workers = [
+        context.Process(
+            target=_work,
+            args=worker_args + (stats,),
+            name="kinto-emailer-outbox-%s" % i,
+        )
+        for i in range(processes)
+    ]
+    for worker in workers:
+        worker.start()
+
+    running = processes
+    sent = failed = 0
+    reported = time.monotonic()
+    try:
+        while running:
+            try:
+                batch = stats.get(timeout=stats_interval)
+            except queue.Empty:
+                batch = ()
+            if batch is None:
+                running -= 1
+            elif batch:
+                sent += batch[0]
+                failed += batch[1]
+            now = time.monotonic()
+            if now - reported >= stats_interval or not running:
+                elapsed = now - reported
+                print(
+                    "Sent %s emails (%s failed) in %.2fs, %.1f emails/s. Backlog: %s requests."
+                    % (sent, failed, elapsed, sent / elapsed if elapsed else 0, len(outbox))
+                )
+                # Do not keep the storage transaction open while waiting.
+                transaction.commit()
+                totals[0] += sent
+                totals[1] += failed
+                sent = failed = 0
+                reported = now
+    finally:
+        for worker in workers:
+            worker.join()
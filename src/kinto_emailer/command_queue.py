@@ -0,0 +1,81 @@
+import argparse
+import sys
+import time
+
+from pyramid.paster import bootstrap
+
+from kinto_emailer.maildir import QueueProcessor
+from kinto_emailer.mailers import mailer_from_settings
+from kinto_emailer.retry import RetryPolicy
+
+
+def main(args=None):
+    if args is None:
+        args = sys.argv[1:]
+    parser = argparse.ArgumentParser(description="Send the queued kinto-emailer notifications.")
+    parser.add_argument("config_file", help="Kinto configuration file")
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument("--once", action="store_true", help="Send the queued emails and exit")
+    mode.add_argument(
+        "--watch", action="store_true", help="Send the queued emails until interrupted (default)"
+    )
+    parser.add_argument(
+        "--workers", type=int, help="Number of sending threads (default: emailer.queue.workers)"
+    )
+    parser.add_argument(
+        "--interval", type=float, help="Seconds between scans (default: emailer.queue.interval)"
+    )
+    try:
+        args = parser.parse_args(args)
+    except SystemExit as e:
+        return e.code
+
+    print("Load config...")
+    env = bootstrap(args.config_file)
+
+    settings = env["registry"].settings
+    queue_path = settings.get("mail.queue_path")
+    if not queue_path:
+        print("No queue to process (mail.queue_path is not set).")
+        return 1
+    workers = args.workers or int(settings.get("emailer.queue.workers", 4))
+    interval = args.interval or float(settings.get("emailer.queue.interval", 1))
+    # Keep SMTP connections open (one per worker by default).
+    pool_size = int(settings.get("mail.pool_size") or 0) or workers
+    mailer = mailer_from_settings({**settings, "mail.pool_size": pool_size})
+    processor = QueueProcessor(
+        queue_path,
+        mailer.smtp_mailer,
+        workers=workers,
+        retry=RetryPolicy.from_settings(settings),
+        claim_timeout=float(settings.get("emailer.queue.claim_timeout", 600)),
+        max_attempts=int(settings.get("emailer.queue.max_attempts", 10)),
+        backoff=float(settings.get("emailer.queue.backoff", 60)),
+        max_backoff=float(settings.get("emailer.queue.max_backoff", 3600)),
+    )
+
+    total_sent = total_failed = 0
+    start = time.monotonic()
+    try:
+        while True:
+            started = time.monotonic()
+            sent, failed = processor.process()
+            elapsed = time.monotonic() - started
+            total_sent += sent
+            total_failed += failed
+            if sent or failed or args.once:
+                print(
+                    "Sent %s emails (%s failed) in %.2fs, %.1f emails/s."
+                    % (sent, failed, elapsed, sent / elapsed if elapsed else 0)
+                )
+            if args.once:
+                break
+            time.sleep(interval)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if hasattr(mailer.smtp_mailer, "close"):
+            mailer.smtp_mailer.close()
+    elapsed = time.monotonic() - start
+    print("Done. Sent %s emails (%s failed) in %.2fs." % (total_sent, total_failed, elapsed))
+    return 0
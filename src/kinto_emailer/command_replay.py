@@ -0,0 +1,37 @@
+import argparse
+import sys
+
+from pyramid.paster import bootstrap
+from pyramid_mailer import get_mailer
+
+from kinto_emailer.deadletter import DeadLetters
+from kinto_emailer.retry import RetryPolicy
+
+
+def main(args=None):
+    if args is None:
+        args = sys.argv[1:]
+    parser = argparse.ArgumentParser(
+        description="Send again the kinto-emailer notifications that could not be sent."
+    )
+    parser.add_argument("config_file", help="Kinto configuration file")
+    try:
+        args = parser.parse_args(args)
+    except SystemExit as e:
+        return e.code
+
+    print("Load config...")
+    env = bootstrap(args.config_file)
+
+    registry = env["registry"]
+    settings = registry.settings
+    dead_letters = DeadLetters.from_settings(settings)
+    if dead_letters is None:
+        print("No dead letters to replay (emailer.dead_letter.path is not set).")
+        return 1
+    mailer = get_mailer(registry)
+    retry = RetryPolicy.from_settings(settings)
+
+    sent, failed = dead_letters.replay(mailer.smtp_mailer, retry)
+    print("Sent %s emails, %s failed." % (sent, failed))
+    return 1 if failed else 0
@@ -0,0 +1,98 @@
+from collections.abc import Mapping
+
+
+def qualname(obj):
+    """
+    >>> str(msg.__class__)
+    "<class 'pyramid_mailer.message.Message'>"
+    >>> str(msg.__class__).split("'")
+    ['<class ', 'pyramid_mailer.message.Message', '>']
+    """
+    return str(obj.__class__).split("'")[1]
+
+
+def _settings(event):
+    return {
+        k: v
+        for k, v in event.request.registry.settings.items()
+        if k in ("project_name", "project_version", "url")
+    }
+
+
+# Fields computed from the event, besides those of its payload.
+FIELDS = {
+    "event": qualname,
+    "root_url": lambda event: event.request.route_url("hello"),
+    "client_address": lambda event: event.request.client_addr,
+    "user_agent": lambda event: event.request.user_agent,
+    "impacted_objects": lambda event: event.impacted_objects,
+    "settings": _settings,
+}
+
+# The following payload attributes are not always present.
+# See Kinto/kinto#945
+DEFAULTS = {"record_id": "{record_id}", "collection_id": "{collection_id}"}
+
+
+class EventContext(Mapping):
+    """Read-only context of an event, used to render templates.
+
+    Fields are computed when first accessed, so that templates only pay for
+    the fields they use.
+    """
+
+    def __init__(self, event):
+        self._event = event
+        self._values = {}
+
+    def __getitem__(self, key):
+        try:
+            return self._values[key]
+        except KeyError:
+            pass
+        if key in FIELDS:
+            value = FIELDS[key](self._event)
+        elif key in self._event.payload:
+            value = self._event.payload[key]
+        elif key in DEFAULTS:
+            value = DEFAULTS[key]
+        else:
+            raise KeyError(key)
+        self._values[key] = value
+        return value
+
+    def __contains__(self, key):
+        return key in FIELDS or key in self._event.payload or key in DEFAULTS
+
+    def __iter__(self):
+        return iter(dict.fromkeys([*FIELDS, *self._event.payload, *DEFAULTS]))
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+
+class ObjectContext(Mapping):
+    """Read-only context of one of the event impacted objects: its id (as ``id``
+    and as ``key``, e.g. ``record_id``) over the shared event context.
+    """
+
+    __slots__ = ("_parent", "_key", "_id")
+
+    def __init__(self, parent, key, object_id):
+        self._parent = parent
+        self._key = key
+        self._id = object_id
+
+    def __getitem__(self, key):
+        if key == "id" or key == self._key:
+            return self._id
+        return self._parent[key]
+
+    def __contains__(self, key):
+        return key == "id" or key == self._key or key in self._parent
+
+    def __iter__(self):
+        return iter(dict.fromkeys(["id", self._key, *self._parent]))
+
+    def __len__(self):
+        return sum(1 for _ in self)
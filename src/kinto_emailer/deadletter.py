@@ -0,0 +1,58 @@
+import logging
+import os
+from email.header import Header
+
+from repoze.sendmail.maildir import Maildir
+
+from kinto_emailer.maildir import read_message
+
+
+logger = logging.getLogger(__name__)
+
+
+class DeadLetters:
+    """Maildir of the messages that could not be sent, to be replayed later.
+
+    Like the ``pyramid_mailer`` queue, the envelope is kept in the
+    ``X-Actually-From`` and ``X-Actually-To`` headers.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    @property
+    def _maildir(self):
+        # Created on first use.
+        return Maildir(self.path, create=True)
+
+    @classmethod
+    def from_settings(cls, settings, prefix="emailer.dead_letter."):
+        """Return the dead letters Maildir, or ``None`` if not configured."""
+        path = settings.get(prefix + "path")
+        return cls(path) if path else None
+
+    def __len__(self):
+        return len(list(self._maildir))
+
+    def add(self, message):
+        mime = message.to_message()
+        mime["X-Actually-From"] = Header(message.sender, "utf-8")
+        mime["X-Actually-To"] = Header(",".join(message.send_to), "utf-8")
+        self._maildir.add(mime).commit()
+
+    def replay(self, smtp_mailer, retry):
+        """Send the stored messages again with ``smtp_mailer``, and remove those
+        that were sent. Returns the number of messages sent and failed.
+        """
+        sent = failed = 0
+        for filename in list(self._maildir):
+            fromaddr, toaddrs, mime = read_message(filename)
+            try:
+                retry.run(smtp_mailer.send, fromaddr, toaddrs, mime)
+            except Exception:
+                logger.exception("Could not send %s", filename)
+                failed += 1
+                continue
+            os.remove(filename)
+            sent += 1
+        return sent, failed
@@ -0,0 +1,121 @@
+import logging
+import os
+import queue
+import threading
+import time
+
+from kinto_emailer.deadletter import DeadLetters
+from kinto_emailer.retry import RetryPolicy, deliver
+
+
+logger = logging.getLogger(__name__)
+
+
+OVERFLOW_POLICIES = ("block", "drop", "inline")
+
+_STOP = object()
+
+
+class BackgroundDelivery:
+    """Send messages from a pool of worker threads, fed by a bounded queue.
+
+    Workers are started lazily on the first message (and again after a fork),
+    so that the application can be loaded before the server spawns workers.
+    """
+
+    def __init__(
+        self,
+        queue_size=1000,
+        workers=2,
+        overflow="block",
+        shutdown_timeout=10,
+        retry=None,
+        dead_letters=None,
+    ):
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError(
+                "Invalid overflow policy %r (expected one of %s)"
+                % (overflow, ", ".join(OVERFLOW_POLICIES))
+            )
+        self.queue_size = queue_size
+        self.workers = workers
+        self.overflow = overflow
+        self.shutdown_timeout = shutdown_timeout
+        self.retry = retry
+        self.dead_letters = dead_letters
+        self._lock = threading.Lock()
+        self._pid = None
+        self._queue = None
+        self._threads = []
+
+    @classmethod
+    def from_settings(cls, settings, prefix="emailer.background."):
+        return cls(
+            queue_size=int(settings.get(prefix + "queue_size", 1000)),
+            workers=int(settings.get(prefix + "workers", 2)),
+            overflow=settings.get(prefix + "overflow", "block"),
+            shutdown_timeout=float(settings.get(prefix + "shutdown_timeout", 10)),
+            retry=RetryPolicy.from_settings(settings),
+            dead_letters=DeadLetters.from_settings(settings),
+        )
+
+    def _ensure_started(self):
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._queue = queue.Queue(maxsize=self.queue_size)
+            self._threads = [
+                threading.Thread(target=self._work, name="kinto-emailer-%s" % i, daemon=True)
+                for i in range(self.workers)
+            ]
+            for thread in self._threads:
+                thread.start()
+
+    def _work(self):
+        while True:
+            item = self._queue.get()
+            try:
+                if item is _STOP:
+                    return
+                mailer, message = item
+                deliver(mailer, message, retry=self.retry, dead_letters=self.dead_letters)
+            finally:
+                self._queue.task_done()
+
+    def enqueue(self, mailer, message):
+        """Hand the message over to the workers, applying the overflow policy
+        if the queue is full. Returns ``False`` if the message was dropped.
+        """
+        self._ensure_started()
+        try:
+            self._queue.put((mailer, message), block=self.overflow == "block")
+        except queue.Full:
+            if self.overflow == "drop":
+                logger.warning("Notifications queue is full, message dropped.")
+                return False
+            mailer.send_immediately(message, fail_silently=False)
+        return True
+
+    def shutdown(self, timeout=None):
+        """Stop the workers once the queued messages were sent, waiting at most
+        ``timeout`` seconds (default: ``shutdown_timeout``).
+        Returns the number of messages left undelivered.
+        """
+        with self._lock:
+            if self._pid != os.getpid():
+                return 0
+            self._pid = None
+        timeout = self.shutdown_timeout if timeout is None else timeout
+        deadline = time.monotonic() + timeout
+        try:
+            for _ in self._threads:
+                self._queue.put(_STOP, timeout=max(deadline - time.monotonic(), 0))
+        except queue.Full:
+            pass
+        for thread in self._threads:
+            thread.join(max(deadline - time.monotonic(), 0))
+        pending = sum(1 for item in list(self._queue.queue) if item is not _STOP)
+        if pending:
+            logger.warning("%s notifications were not sent before shutdown.", pending)
+        return pending
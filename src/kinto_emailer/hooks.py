@@ -0,0 +1,223 @@
+import hashlib
+import json
+import operator
+import re
+from functools import partial
+from string import Formatter
+
+from kinto_emailer.cache import LRUCache
+
+
+try:
+    import jinja2
+    from jinja2 import meta
+    from jinja2.sandbox import SandboxedEnvironment
+except ImportError:  # pragma: no cover
+    jinja2 = None
+
+
+EMAIL_REGEXP = re.compile(r"^(.*<[^@<>\s]+@[^@<>\s]+>)|([^@<>\s]+@[^@<>\s]+)$")
+GROUP_REGEXP = re.compile(r"^/buckets/[^/]+/groups/[^/]+$")
+
+FILTERS = ("event", "action", "resource_name", "id", "record_id", "collection_id")
+# Fields used to index hooks, from the most to the least selective.
+INDEXED_FILTERS = ("id", "record_id", "collection_id", "resource_name", "action", "event")
+
+# Compiled hooks, by (bucket or collection URI, last_modified).
+compiled_hooks = LRUCache(maxsize=1000)
+
+# Compiled HTML templates (and the fields they use), by hash of their source.
+html_templates = LRUCache(maxsize=1000)
+html_environment = SandboxedEnvironment(autoescape=True) if jinja2 else None
+
+
+class InvalidTemplate(ValueError):
+    pass
+
+
+class Template:
+    """A ``str.format()`` template, parsed once."""
+
+    __slots__ = ("source", "text")
+
+    def __init__(self, source):
+        self.source = source
+        self.text = None
+        try:
+            parsed = list(Formatter().parse(source))
+        except ValueError:
+            # Invalid templates fail when rendered.
+            return
+        if all(field is None for _, field, _, _ in parsed):
+            # Without placeholders, the rendered text is always the same.
+            self.text = "".join(literal for literal, _, _, _ in parsed)
+
+    def render(self, context):
+        if self.text is not None:
+            return self.text
+        # Only the fields used by the template are looked up.
+        return self.source.format_map(context)
+
+
+class HTMLTemplate:
+    """A Jinja template, rendered in a sandbox with HTML escaping.
+
+    Templates are compiled once, and shared by the hooks with the same source.
+    Invalid templates (or if Jinja is not installed) have an ``error``, and fail
+    when rendered.
+    """
+
+    __slots__ = ("source", "template", "fields", "error")
+
+    def __init__(self, source):
+        self.source = source
+        self.error = None
+        key = hashlib.sha256(source.encode()).hexdigest()
+        compiled = html_templates.get(key)
+        if compiled is None:
+            try:
+                compiled = self._compile(source)
+            except InvalidTemplate as e:
+                self.error = e
+                compiled = (None, ())
+            else:
+                html_templates.set(key, compiled)
+        self.template, self.fields = compiled
+
+    @staticmethod
+    def _compile(source):
+        if html_environment is None:
+            raise InvalidTemplate("HTML templates require Jinja (pip install kinto-emailer[html])")
+        try:
+            ast = html_environment.parse(source)
+        except jinja2.TemplateSyntaxError as e:
+            raise InvalidTemplate("%s (line %s)" % (e.message, e.lineno))
+        fields = tuple(meta.find_undeclared_variables(ast))
+        return html_environment.from_string(ast), fields
+
+    def render(self, context):
+        if self.error is not None:
+            raise self.error
+        # Only the fields used by the template are looked up.
+        return self.template.render({f: context[f] for f in self.fields if f in context})
+
+
+def _compile_filter(value):
+    # Allow support of regexps in fields, if they start with ^
+    if value.startswith("^"):
+        return re.compile(value).match
+    return partial(operator.eq, value)
+
+
+class CompiledHook:
+    """A hook from the ``kinto-emailer`` metadata, with its filters, templates
+    and recipients prepared for rendering messages.
+    """
+
+    __slots__ = (
+        "key",
+        "filters",
+        "exact",
+        "template",
+        "html_template",
+        "subject",
+        "sender",
+        "digest",
+        "emails",
+        "groups",
+    )
+
+    def __init__(self, hook):
+        # Identifies the hook across processes (e.g. for rate limits).
+        self.key = hashlib.sha1(json.dumps(hook, sort_keys=True).encode()).hexdigest()
+        self.filters = tuple(
+            (field, _compile_filter(hook[field])) for field in FILTERS if field in hook
+        )
+        self.exact = {
+            field: hook[field]
+            for field in INDEXED_FILTERS
+            if isinstance(hook.get(field), str) and not hook[field].startswith("^")
+        }
+        self.template = Template(hook["template"])
+        html = hook.get("html_template")
+        self.html_template = HTMLTemplate(html) if html else None
+        self.subject = Template(hook.get("subject", "New message"))
+        self.sender = hook.get("sender")
+        self.digest = bool(hook.get("digest"))
+
+        recipients = hook["recipients"]
+        self.emails = [r for r in recipients if not GROUP_REGEXP.match(r)]
+        # Group URIs can contain placeholders (eg. /buckets/staging/{collection_id}-reviewers).
+        templates = (Template(r) for r in recipients)
+        self.groups = [t for t in templates if t.text is None or GROUP_REGEXP.match(t.text)]
+
+    def matches(self, context):
+        # Filter out hook if it doesn't meet current event attributes, and keep
+        # if nothing is specified.
+        for field, match in self.filters:
+            if field in context and not match(context[field]):
+                return False
+        return True
+
+    def render_groups(self, context):
+        rendered = (t.render(context) for t in self.groups)
+        return [uri for uri in rendered if GROUP_REGEXP.match(uri)]
+
+
+class HookIndex:
+    """The compiled hooks of a bucket or collection, indexed by the value of
+    their most selective exact-match filter.
+
+    Only the hooks that could match an event are tested, the hooks without
+    exact-match filter (eg. regexps only) are always tested.
+    """
+
+    def __init__(self, hooks):
+        self.hooks = [CompiledHook(hook) for hook in hooks]
+        self._index = {}
+        self._unindexed = []
+        for position, hook in enumerate(self.hooks):
+            field = next((f for f in INDEXED_FILTERS if f in hook.exact), None)
+            if field is None:
+                self._unindexed.append(position)
+            else:
+                by_value = self._index.setdefault(field, {})
+                by_value.setdefault(hook.exact[field], []).append(position)
+
+    def __len__(self):
+        return len(self.hooks)
+
+    def match(self, context):
+        """Yield the hooks matching the specified context, in their original order."""
+        positions = list(self._unindexed)
+        for field, by_value in self._index.items():
+            if field in context:
+                positions.extend(by_value.get(context[field], ()))
+            else:
+                # Filters on fields that are absent from the context are ignored.
+                for values in by_value.values():
+                    positions.extend(values)
+        positions.sort()
+        for position in positions:
+            hook = self.hooks[position]
+            if hook.matches(context):
+                yield hook
+
+
+def compile_hooks(uri, metadata):
+    """Return the compiled hooks of the specified bucket or collection metadata.
+
+    They are cached by URI and timestamp, and thus compiled again only when
+    the metadata changes.
+    """
+    hooks = metadata.get("kinto-emailer", {}).get("hooks", [])
+    last_modified = metadata.get("last_modified")
+    if last_modified is None:
+        return HookIndex(hooks)
+
+    key = (uri, last_modified)
+    compiled = compiled_hooks.get(key)
+    if compiled is None:
+        compiled = HookIndex(hooks)
+        compiled_hooks.set(key, compiled)
+    return compiled
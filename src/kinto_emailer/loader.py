@@ -0,0 +1,107 @@
+from kinto.core.storage import Filter
+from kinto.core.storage import exceptions as storage_exceptions
+from kinto.core.utils import COMPARISON
+
+
+class StorageLoader:
+    """Read buckets, collections and groups from storage, with as few calls as
+    possible: objects of the same parent are loaded together, and kept for the
+    lifetime of the loader.
+    """
+
+    def __init__(self, storage):
+        self.storage = storage
+        # Loaded objects (``None`` if missing), by (resource_name, parent_id, object_id).
+        self._objects = {}
+
+    @classmethod
+    def from_event(cls, event, skip=()):
+        """Return the loader of the event request, created on the first call.
+
+        The collections and buckets of this event, and of the events of the same
+        request that are about to be notified, are loaded all at once, except
+        the (bucket_id, collection_id) in ``skip``.
+        """
+        bound_data = event.request.bound_data
+        loader = bound_data.get("kinto_emailer.loader")
+        if loader is None:
+            loader = bound_data["kinto_emailer.loader"] = cls(event.request.registry.storage)
+            collector = bound_data.get("resource_events")
+            pending = getattr(collector, "event_dict", {}).values()
+            payloads = [event.payload] + [payload for payload, _, _ in pending]
+            loader.prefetch_metadata(
+                [p for p in payloads if (p.get("bucket_id"), p.get("collection_id")) not in skip]
+            )
+        return loader
+
+    def load(self, resource_name, parent_id, object_ids):
+        """Load the specified objects, unless they were already."""
+        missing = [
+            id_
+            for id_ in dict.fromkeys(object_ids)
+            if (resource_name, parent_id, id_) not in self._objects
+        ]
+        if not missing:
+            return
+        for id_ in missing:
+            self._objects[(resource_name, parent_id, id_)] = None
+        if len(missing) == 1:
+            try:
+                self._objects[(resource_name, parent_id, missing[0])] = self.storage.get(
+                    resource_name=resource_name, parent_id=parent_id, object_id=missing[0]
+                )
+            except storage_exceptions.RecordNotFoundError:
+                pass
+            return
+        found = self.storage.list_all(
+            resource_name=resource_name,
+            parent_id=parent_id,
+            filters=[Filter("id", missing, COMPARISON.IN)],
+        )
+        for obj in found:
+            self._objects[(resource_name, parent_id, obj["id"])] = obj
+
+    def get(self, resource_name, parent_id, object_id):
+        """Return the specified object, loaded on demand.
+
+        :raises: :exc:`kinto.core.storage.exceptions.ObjectNotFoundError`
+        """
+        key = (resource_name, parent_id, object_id)
+        if key not in self._objects:
+            self.load(resource_name, parent_id, [object_id])
+        obj = self._objects[key]
+        if obj is None:
+            raise storage_exceptions.ObjectNotFoundError({"id": object_id})
+        return obj
+
+    def get_groups(self, group_uris):
+        """Return the specified groups (``None`` if missing), by URI."""
+        by_bucket = {}
+        for uri in group_uris:
+            bucket_uri, group_id = uri.split("/groups/")
+            by_bucket.setdefault(bucket_uri, []).append(group_id)
+        for bucket_uri, group_ids in by_bucket.items():
+            self.load("group", bucket_uri, group_ids)
+        return {
+            uri: self._objects[("group",) + tuple(uri.split("/groups/"))] for uri in group_uris
+        }
+
+    def prefetch_metadata(self, payloads):
+        """Load the collections of the records events of the specified payloads,
+        and then the buckets of those without ``kinto-emailer`` metadata.
+        """
+        by_bucket = {}
+        for payload in payloads:
+            if payload.get("resource_name") == "record":
+                by_bucket.setdefault(payload["bucket_id"], []).append(payload["collection_id"])
+        for bucket_id, collection_ids in by_bucket.items():
+            self.load("collection", "/buckets/%s" % bucket_id, collection_ids)
+
+        bucket_ids = [
+            bucket_id
+            for bucket_id, collection_ids in by_bucket.items()
+            for collection_id in collection_ids
+            if "kinto-emailer"
+            not in (self._objects[("collection", "/buckets/%s" % bucket_id, collection_id)] or {})
+        ]
+        self.load("bucket", "", bucket_ids)
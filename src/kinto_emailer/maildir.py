@@ -0,0 +1,174 @@
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from email.header import decode_header, make_header
+from email.parser import Parser
+
+from kinto_emailer.retry import RetryPolicy, is_transient
+
+
+logger = logging.getLogger(__name__)
+
+SENDING_PREFIX = ".sending-"
+REJECTED_PREFIX = ".rejected-"
+# Suffix of the messages queued again, with their number of failed attempts.
+ATTEMPTS_SEPARATOR = ";attempts="
+
+
+def _decode(value):
+    return str(make_header(decode_header(value)))
+
+
+def _split_attempts(name):
+    """Return the name of a queued message without its attempts suffix, and
+    its number of failed attempts.
+    """
+    base, _, attempts = name.partition(ATTEMPTS_SEPARATOR)
+    return base, int(attempts or 0)
+
+
+def read_message(filename):
+    """Read a message queued by ``pyramid_mailer``, and return its envelope
+    (from the ``X-Actually-From`` and ``X-Actually-To`` headers) and content.
+    """
+    with open(filename) as f:
+        mime = Parser().parse(f)
+    fromaddr = _decode(mime["X-Actually-From"])
+    toaddrs = [a.strip() for a in _decode(mime["X-Actually-To"]).split(",")]
+    del mime["X-Actually-From"]
+    del mime["X-Actually-To"]
+    return fromaddr, toaddrs, mime
+
+
+class QueueProcessor:
+    """Send the messages of a Maildir queue (e.g. ``mail.queue_path``) from
+    several threads, and possibly several processes.
+
+    A message is claimed by renaming it (atomically) as a hidden file in
+    ``cur/``, which other processors ignore. It is removed once sent, or kept
+    as ``.rejected-*`` after a permanent failure. After a transient one, it is
+    queued again with its number of attempts in its name, and its modification
+    time set to when it can be sent again (after an exponential delay of
+    ``backoff`` seconds, see :class:`RetryPolicy`). It is rejected too after
+    ``max_attempts``. Claims older than ``claim_timeout`` seconds (e.g. from a
+    crashed process) are queued again.
+    """
+
+    def __init__(
+        self,
+        path,
+        smtp_mailer,
+        workers=4,
+        retry=None,
+        claim_timeout=600,
+        max_attempts=10,
+        backoff=60,
+        max_backoff=3600,
+    ):
+        self.path = path
+        self.smtp_mailer = smtp_mailer
+        self.workers = workers
+        self.retry = retry or RetryPolicy(attempts=1)
+        self.claim_timeout = claim_timeout
+        self.max_attempts = max_attempts
+        self.backoff = RetryPolicy(backoff=backoff, max_backoff=max_backoff)
+        self._new = os.path.join(path, "new")
+        self._cur = os.path.join(path, "cur")
+        for subdir in ("new", "cur", "tmp"):
+            os.makedirs(os.path.join(path, subdir), exist_ok=True)
+
+    def __iter__(self):
+        """Yield the filenames of the queued messages that can be sent now,
+        oldest first.
+        """
+        entries = []
+        now = time.time()
+        for subdir in (self._new, self._cur):
+            for name in os.listdir(subdir):
+                if name.startswith("."):
+                    continue
+                path = os.path.join(subdir, name)
+                try:
+                    mtime = os.stat(path).st_mtime
+                except FileNotFoundError:
+                    # Claimed meanwhile.
+                    continue
+                if mtime <= now:
+                    entries.append((mtime, path))
+        entries.sort()
+        return iter([path for _, path in entries])
+
+    def claim(self, filename):
+        """Return the path of the claimed message, or ``None`` if it was
+        claimed by someone else.
+        """
+        claimed = os.path.join(self._cur, SENDING_PREFIX + os.path.basename(filename))
+        try:
+            # The claim time is the modification time.
+            os.utime(filename)
+            os.rename(filename, claimed)
+        except FileNotFoundError:
+            return None
+        return claimed
+
+    def release_stale_claims(self):
+        """Queue again the messages claimed for too long. Returns their number."""
+        released = 0
+        now = time.time()
+        for name in os.listdir(self._cur):
+            if not name.startswith(SENDING_PREFIX):
+                continue
+            path = os.path.join(self._cur, name)
+            try:
+                if now - os.stat(path).st_mtime < self.claim_timeout:
+                    continue
+                os.rename(path, os.path.join(self._new, name[len(SENDING_PREFIX) :]))
+            except FileNotFoundError:
+                # Sent or released meanwhile.
+                continue
+            released += 1
+        return released
+
+    def send(self, filename):
+        """Claim and send the specified message. Returns ``True`` if sent,
+        ``False`` if it failed and ``None`` if it was claimed by someone else.
+        """
+        claimed = self.claim(filename)
+        if claimed is None:
+            return None
+        name = os.path.basename(filename)
+        try:
+            fromaddr, toaddrs, mime = read_message(claimed)
+            self.retry.run(self.smtp_mailer.send, fromaddr, toaddrs, mime)
+        except Exception as e:
+            base, attempts = _split_attempts(name)
+            attempts += 1
+            if is_transient(e) and attempts < self.max_attempts:
+                delay = self.backoff.delay(attempts)
+                logger.warning(
+                    "Could not send %s (%r), it will be sent again in %.0fs.", name, e, delay
+                )
+                # Not listed until then (nor released, being in the future).
+                not_before = time.time() + delay
+                os.utime(claimed, (not_before, not_before))
+                os.rename(
+                    claimed, os.path.join(self._new, base + ATTEMPTS_SEPARATOR + str(attempts))
+                )
+            else:
+                logger.exception(
+                    "Could not send %s after %s attempts, it was rejected.", name, attempts
+                )
+                os.rename(claimed, os.path.join(self._cur, REJECTED_PREFIX + name))
+            return False
+        os.remove(claimed)
+        return True
+
+    def process(self):
+        """Send every queued message once. Returns the number of messages sent
+        and failed.
+        """
+        self.release_stale_claims()
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            results = list(executor.map(self.send, self))
+        return results.count(True), results.count(False)
@@ -0,0 +1,344 @@
+import contextlib
+import copy
+import hashlib
+import logging
+import math
+import smtplib
+import threading
+import time
+from email.message import Message as EmailMessage
+
+from pyramid.settings import aslist
+from pyramid_mailer.mailer import Mailer
+from repoze.sendmail.encoding import encode_message
+from repoze.sendmail.interfaces import IMailer
+from repoze.sendmail.mailer import (
+    EHLO_Error,
+    ESMTP_NotSupported,
+    NotAnEmailMessage,
+    SMTPMailer,
+    TLS_NotAvailable,
+)
+from zope.interface import implementer
+
+from kinto_emailer.retry import is_transient
+
+
+logger = logging.getLogger(__name__)
+
+
+class _Connection:
+    __slots__ = ("smtp", "sent", "last_used")
+
+    def __init__(self, smtp):
+        self.smtp = smtp
+        self.sent = 0
+        self.last_used = time.monotonic()
+
+    def close(self):
+        try:
+            self.smtp.quit()
+        except (smtplib.SMTPException, OSError):
+            self.smtp.close()
+
+
+@implementer(IMailer)
+class PooledSMTPMailer:
+    """SMTP mailer that keeps connections open and reuses them across messages.
+
+    It wraps a ``repoze.sendmail`` SMTP mailer, whose ``smtp_factory()`` and TLS
+    or authentication options are used to open new connections.
+
+    :param pool_size: number of idle connections kept open.
+    :param max_messages: number of messages sent before a connection is recycled.
+    :param idle_timeout: connections idle for longer are closed instead of reused.
+    :param noop_interval: connections idle for longer are checked with ``NOOP``
+        before being reused.
+    """
+
+    def __init__(
+        self, smtp_mailer, pool_size=2, max_messages=100, idle_timeout=60, noop_interval=1
+    ):
+        self.smtp_mailer = smtp_mailer
+        self.pool_size = pool_size
+        self.max_messages = max_messages
+        self.idle_timeout = idle_timeout
+        self.noop_interval = noop_interval
+        self._lock = threading.Lock()
+        self._idle = []
+
+    def _connect(self):
+        options = self.smtp_mailer
+        smtp = options.smtp_factory()
+
+        code, response = smtp.ehlo()
+        if code < 200 or code >= 300:
+            code, response = smtp.helo()
+            if code < 200 or code >= 300:
+                raise EHLO_Error(code, response)
+
+        have_tls = smtp.has_extn("starttls")
+        if not have_tls and options.force_tls:
+            raise TLS_NotAvailable()
+        if have_tls and not options.no_tls:
+            smtp.starttls()
+            smtp.ehlo()
+
+        if smtp.does_esmtp:
+            if options.username is not None and options.password is not None:
+                smtp.login(options.username, options.password)
+        elif options.username:
+            raise ESMTP_NotSupported()
+
+        return _Connection(smtp)
+
+    def _is_healthy(self, connection):
+        idle = time.monotonic() - connection.last_used
+        if idle > self.idle_timeout:
+            return False
+        if idle > self.noop_interval:
+            try:
+                code, _ = connection.smtp.noop()
+            except (smtplib.SMTPException, OSError):
+                return False
+            return code == 250
+        return True
+
+    def _acquire(self):
+        while True:
+            with self._lock:
+                if not self._idle:
+                    break
+                connection = self._idle.pop()
+            if self._is_healthy(connection):
+                return connection
+            connection.close()
+        return self._connect()
+
+    def _release(self, connection):
+        connection.sent += 1
+        connection.last_used = time.monotonic()
+        if connection.sent < self.max_messages:
+            with self._lock:
+                if len(self._idle) < self.pool_size:
+                    self._idle.append(connection)
+                    return
+        connection.close()
+
+    def send(self, fromaddr, toaddrs, message):
+        if not isinstance(message, EmailMessage):
+            raise NotAnEmailMessage()
+        message = encode_message(message)
+
+        connection = self._acquire()
+        try:
+            connection.smtp.sendmail(fromaddr, toaddrs, message)
+        except smtplib.SMTPServerDisconnected:
+            connection.close()
+            if connection.sent == 0:
+                raise
+            # The relay dropped a connection that was reused, try again on a new one.
+            connection = self._connect()
+            try:
+                connection.smtp.sendmail(fromaddr, toaddrs, message)
+            except Exception:
+                connection.close()
+                raise
+        except Exception:
+            connection.close()
+            raise
+        self._release(connection)
+
+    def close(self):
+        """Close every idle connection of the pool."""
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for connection in idle:
+            connection.close()
+
+
+RELAY_STRATEGIES = ("round_robin", "domain")
+
+
+class Relay:
+    __slots__ = ("name", "mailer", "weight", "current", "failures", "down_until")
+
+    def __init__(self, name, mailer, weight=1):
+        self.name = name
+        self.mailer = mailer
+        self.weight = weight
+        self.current = 0
+        self.failures = 0
+        self.down_until = 0
+
+
+def parse_relay(value):
+    """Parse a ``host[:port][=weight]`` relay (e.g. ``smtp1.example.com:587=3``)
+    into a (host, port, weight) tuple. The port is ``None`` if unspecified.
+    """
+    address, _, weight = value.partition("=")
+    host, _, port = address.partition(":")
+    return host, int(port) if port else None, int(weight or 1)
+
+
+@implementer(IMailer)
+class RelaySMTPMailer:
+    """SMTP mailer that spreads messages across several relays.
+
+    Relays are picked by smooth weighted round-robin, or by hashing the domain
+    of the first recipient (weighted rendezvous hashing), so that the messages
+    of a domain go through the same relay.
+
+    If a relay fails with a transient error, the message is sent through the
+    next one. After ``max_failures`` consecutive failures, a relay is marked as
+    unhealthy and only tried after the healthy ones for ``retry_after`` seconds.
+
+    :param relays: list of :class:`Relay`.
+    """
+
+    def __init__(self, relays, strategy="round_robin", max_failures=3, retry_after=30):
+        if strategy not in RELAY_STRATEGIES:
+            raise ValueError(
+                "Invalid relay strategy %r (expected one of %s)"
+                % (strategy, ", ".join(RELAY_STRATEGIES))
+            )
+        self.relays = relays
+        self.strategy = strategy
+        self.max_failures = max_failures
+        self.retry_after = retry_after
+        self._lock = threading.Lock()
+
+    def _round_robin(self):
+        total = 0
+        for relay in self.relays:
+            relay.current += relay.weight
+            total += relay.weight
+        best = max(self.relays, key=lambda relay: relay.current)
+        best.current -= total
+        # Fail over to the next relays of the list.
+        i = self.relays.index(best)
+        return self.relays[i:] + self.relays[:i]
+
+    def _by_domain(self, toaddrs):
+        domain = toaddrs[0].rpartition("@")[2].lower() if toaddrs else ""
+
+        def score(relay):
+            digest = hashlib.sha1(("%s/%s" % (relay.name, domain)).encode("utf-8")).digest()
+            # Uniform in ]0, 1[.
+            u = (int.from_bytes(digest[:8], "big") + 1) / (2**64 + 1)
+            return -relay.weight / math.log(u)
+
+        return sorted(self.relays, key=score, reverse=True)
+
+    def _order(self, toaddrs):
+        now = time.monotonic()
+        with self._lock:
+            if self.strategy == "domain":
+                relays = self._by_domain(toaddrs)
+            else:
+                relays = self._round_robin()
+        # Unhealthy relays are still tried as a last resort.
+        return sorted(relays, key=lambda relay: relay.down_until > now)
+
+    def _succeeded(self, relay):
+        with self._lock:
+            relay.failures = 0
+            relay.down_until = 0
+
+    def _failed(self, relay):
+        with self._lock:
+            relay.failures += 1
+            if relay.failures >= self.max_failures:
+                if relay.failures == self.max_failures:
+                    logger.warning("SMTP relay %s marked as unhealthy.", relay.name)
+                relay.down_until = time.monotonic() + self.retry_after
+
+    def send(self, fromaddr, toaddrs, message):
+        error = None
+        for relay in self._order(toaddrs):
+            try:
+                relay.mailer.send(fromaddr, toaddrs, message)
+            except Exception as e:
+                if not is_transient(e):
+                    # Would be rejected by the other relays too.
+                    raise
+                logger.warning("Could not send through SMTP relay %s (%r).", relay.name, e)
+                self._failed(relay)
+                error = e
+                continue
+            self._succeeded(relay)
+            return
+        raise error
+
+    def close(self):
+        """Close the pooled connections of every relay."""
+        for relay in self.relays:
+            if hasattr(relay.mailer, "close"):
+                relay.mailer.close()
+
+
+def _replace_smtp_mailer(mailer, smtp_mailer):
+    return Mailer(
+        smtp_mailer=smtp_mailer,
+        sendmail_mailer=mailer.sendmail_mailer,
+        queue_path=mailer.queue_path,
+        default_sender=mailer.default_sender,
+        transaction_manager=mailer.transaction_manager,
+    )
+
+
+def mailer_from_settings(settings, prefix="mail."):
+    """Build a ``pyramid_mailer`` mailer from settings, whose SMTP connections
+    are pooled if ``mail.pool_size`` is set, and spread across several relays
+    if ``mail.relays`` is set.
+    """
+    mailer = Mailer.from_settings(settings, prefix)
+    pool_size = int(settings.get(prefix + "pool_size") or 0)
+    relays = aslist(settings.get(prefix + "relays") or "")
+    if pool_size == 0 and not relays:
+        return mailer
+
+    def pooled(smtp_mailer):
+        if pool_size == 0:
+            return smtp_mailer
+        return PooledSMTPMailer(
+            smtp_mailer,
+            pool_size=pool_size,
+            max_messages=int(settings.get(prefix + "pool_max_messages", 100)),
+            idle_timeout=float(settings.get(prefix + "pool_idle_timeout", 60)),
+            noop_interval=float(settings.get(prefix + "pool_noop_interval", 1)),
+        )
+
+    if not relays:
+        return _replace_smtp_mailer(mailer, pooled(mailer.smtp_mailer))
+
+    servers = []
+    for value in relays:
+        host, port, weight = parse_relay(value)
+        # Same TLS and authentication options as ``mail.host``.
+        smtp_mailer = copy.copy(mailer.smtp_mailer)
+        smtp_mailer.hostname = host
+        smtp_mailer.port = port or mailer.smtp_mailer.port
+        servers.append(Relay("%s:%s" % (host, smtp_mailer.port), pooled(smtp_mailer), weight))
+    smtp_mailer = RelaySMTPMailer(
+        servers,
+        strategy=settings.get(prefix + "relays_strategy", "round_robin"),
+        max_failures=int(settings.get(prefix + "relays_max_failures", 3)),
+        retry_after=float(settings.get(prefix + "relays_retry_after", 30)),
+    )
+    return _replace_smtp_mailer(mailer, smtp_mailer)
+
+
+@contextlib.contextmanager
+def single_connection(mailer):
+    """Reuse one SMTP connection for the messages sent immediately within
+    this context, unless the connections of ``mailer`` are already pooled.
+    """
+    if not isinstance(getattr(mailer, "smtp_mailer", None), SMTPMailer):
+        yield mailer
+        return
+    smtp_mailer = PooledSMTPMailer(mailer.smtp_mailer, pool_size=1, max_messages=float("inf"))
+    try:
+        yield _replace_smtp_mailer(mailer, smtp_mailer)
+    finally:
+        smtp_mailer.close()
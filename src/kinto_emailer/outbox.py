@@ -0,0 +1,268 @@
+import collections
+import copy
+import logging
+import random
+import time
+
+from kinto.core.storage import Filter, Sort
+from kinto.core.storage.exceptions import ObjectNotFoundError, UnicityError
+from kinto.core.utils import COMPARISON
+from pyramid_mailer.message import Message
+
+from kinto_emailer.retry import RetryPolicy, is_transient
+
+
+logger = logging.getLogger(__name__)
+
+
+RESOURCE_NAME = "emailer-outbox"
+LEASE_RESOURCE_NAME = "emailer-outbox-lease"
+
+
+class Outbox:
+    """Messages stored in the Kinto storage backend, until they are sent by
+    the ``kinto-emailer-outbox`` dispatcher.
+
+    Messages are added within the transaction of the request that triggered
+    them: they are only stored if it is committed, and are not lost if the
+    process stops before sending them. The messages of a request are stored in
+    a single row, in one of ``shards`` parents picked at random, so that the
+    requests do not all bump the timestamp of the same collection.
+
+    Several dispatchers can send them concurrently: each row is claimed with a
+    lease, created with an identifier that depends on the row and on the
+    current period of ``lease_timeout`` seconds, so that only one dispatcher
+    can create it. A lease is only valid if the row had no lease in the
+    previous period, it thus lasts between one and two periods. No message is
+    sent (or retried) during the last ``lease_margin`` seconds of its lease, so
+    that it is not sent again by another dispatcher. The clocks of the
+    dispatchers are assumed to be synchronized.
+    """
+
+    def __init__(self, storage, shards=16, lease_timeout=60, lease_margin=30):
+        self.storage = storage
+        self.shards = shards
+        self.lease_timeout = lease_timeout
+        self.lease_margin = lease_margin
+        # Shard from which the next claim starts, so that each one is visited in turn.
+        self._next_shard = random.randrange(shards)
+
+    @classmethod
+    def from_settings(cls, settings, storage, prefix="emailer.outbox."):
+        return cls(
+            storage,
+            shards=int(settings.get(prefix + "shards", 16)),
+            lease_timeout=float(settings.get(prefix + "lease_timeout", 60)),
+            lease_margin=float(settings.get(prefix + "lease_margin", 30)),
+        )
+
+    @property
+    def parent_ids(self):
+        return [str(shard) for shard in range(self.shards)]
+
+    def add(self, messages):
+        """Store the specified messages until they are dispatched.
+        Returns the number of messages stored.
+        """
+        rows = [
+            {
+                "sender": m.sender,
+                "recipients": m.recipients,
+                "subject": m.subject,
+                "body": m.body,
+                "html": m.html,
+            }
+            for m in messages
+        ]
+        if rows:
+            self.storage.create(
+                resource_name=RESOURCE_NAME,
+                parent_id=random.choice(self.parent_ids),
+                obj={"messages": rows},
+            )
+        return len(rows)
+
+    def __len__(self):
+        """Number of rows stored, i.e. of requests whose messages were not all sent."""
+        return sum(
+            self.storage.count_all(resource_name=RESOURCE_NAME, parent_id=parent_id)
+            for parent_id in self.parent_ids
+        )
+
+    def pending(self, parent_id, limit=100, after=None):
+        """Return the oldest rows of the ``parent_id`` shard (added after the
+        ``after`` timestamp if specified), at most ``limit``.
+        """
+        filters = [Filter("last_modified", after, COMPARISON.GT)] if after is not None else None
+        return self.storage.list_all(
+            resource_name=RESOURCE_NAME,
+            parent_id=parent_id,
+            filters=filters,
+            sorting=[Sort("last_modified", 1)],
+            limit=limit,
+        )
+
+    def _lease_id(self, row_id, period):
+        return "%s-%s" % (row_id, period)
+
+    def _lease(self, parent_id, row_id, period):
+        lease_id = self._lease_id(row_id, period)
+        try:
+            self.storage.create(
+                resource_name=LEASE_RESOURCE_NAME, parent_id=parent_id, obj={"id": lease_id}
+            )
+        except UnicityError:
+            # Claimed by another dispatcher.
+            return None
+        try:
+            self.storage.get(
+                resource_name=LEASE_RESOURCE_NAME,
+                parent_id=parent_id,
+                object_id=self._lease_id(row_id, period - 1),
+            )
+            # Still claimed from the previous period.
+        except ObjectNotFoundError:
+            try:
+                # Rows are removed before their leases are released.
+                self.storage.get(
+                    resource_name=RESOURCE_NAME, parent_id=parent_id, object_id=row_id
+                )
+                return lease_id
+            except ObjectNotFoundError:
+                # Sent by another dispatcher since it was listed.
+                pass
+        self._release(parent_id, [lease_id])
+        return None
+
+    def _release(self, parent_id, lease_ids):
+        self.storage.delete_all(
+            resource_name=LEASE_RESOURCE_NAME,
+            parent_id=parent_id,
+            filters=[Filter("id", list(lease_ids), COMPARISON.IN)],
+            with_deleted=False,
+        )
+
+    def claim(self, limit=100, commit=None):
+        """Claim the oldest rows that are not claimed yet, until they contain
+        ``limit`` messages, visiting the shards in turn.
+
+        If specified, ``commit`` is called after each change, so that each
+        lease is visible to the other dispatchers as soon as it is created, and
+        that they never wait for one another.
+
+        Returns a list of (shard, lease id, row, end of the lease) tuples.
+        """
+        now = time.time()
+        period = int(now // self.lease_timeout)
+        # The other dispatchers can claim the rows again from the period after next.
+        ends = (period + 2) * self.lease_timeout
+        # Forget the leases of the rows that were removed, or of stopped dispatchers.
+        expired = int((now - 2 * self.lease_timeout) * 1000)
+        claimed = []
+        count = 0
+        first = self._next_shard
+        self._next_shard = (first + 1) % self.shards
+        for shard in range(first, first + self.shards):
+            parent_id = str(shard % self.shards)
+            self.storage.delete_all(
+                resource_name=LEASE_RESOURCE_NAME,
+                parent_id=parent_id,
+                filters=[Filter("last_modified", expired, COMPARISON.LT)],
+                with_deleted=False,
+            )
+            if commit is not None:
+                commit()
+            after = None
+            while count < limit:
+                rows = self.pending(parent_id, limit, after=after)
+                for row in rows:
+                    lease_id = self._lease(parent_id, row["id"], period)
+                    if commit is not None:
+                        commit()
+                    if lease_id is not None:
+                        claimed.append((parent_id, lease_id, row, ends))
+                        count += len(row["messages"])
+                        if count >= limit:
+                            break
+                if len(rows) < limit:
+                    break
+                after = rows[-1]["last_modified"]
+            if count >= limit:
+                break
+        return claimed
+
+    def remove(self, parent_id, ids, lease_ids=()):
+        """Remove the specified rows of the ``parent_id`` shard, and release their leases."""
+        if ids:
+            self.storage.delete_all(
+                resource_name=RESOURCE_NAME,
+                parent_id=parent_id,
+                filters=[Filter("id", list(ids), COMPARISON.IN)],
+                with_deleted=False,
+            )
+        if lease_ids:
+            self._release(parent_id, lease_ids)
+
+    def dispatch(self, mailer, limit=100, retry=None, dead_letters=None, commit=None):
+        """Claim and send the oldest messages (about ``limit``, since the
+        messages of a row are claimed together), and remove them once sent.
+
+        Messages that fail with a transient error are kept, to be sent again
+        once their lease expired. The others are stored in ``dead_letters`` (if
+        specified) and removed. Messages are kept unsent too once their lease is
+        about to end. Returns the numbers of messages sent and failed.
+
+        If specified, ``commit`` is called while the messages are claimed (see
+        :meth:`claim`), the removals remain to be committed by the caller.
+        """
+        retry = copy.copy(retry or RetryPolicy(attempts=1))
+        sent = failed = 0
+        claimed = self.claim(limit, commit=commit)
+        done = collections.defaultdict(lambda: ([], []))
+        ending = False
+        for parent_id, lease_id, row, ends in claimed:
+            kept = []
+            for i, fields in enumerate(row["messages"]):
+                remaining = ends - self.lease_margin - time.time()
+                if remaining <= 0:
+                    # Put the unsent messages back, they will be claimed again.
+                    logger.warning("Leases about to end, notifications left unsent.")
+                    kept.extend(row["messages"][i:])
+                    ending = True
+                    break
+                # Retries must not outlive the lease either.
+                retry.deadline = time.monotonic() + remaining
+                message = Message(**fields)
+                try:
+                    retry.run(mailer.send_immediately, message, fail_silently=False)
+                    sent += 1
+                except Exception as e:
+                    failed += 1
+                    if is_transient(e):
+                        logger.warning("Could not send notification (%r), will retry.", e)
+                        kept.append(fields)
+                        continue
+                    logger.exception("Could not send notification")
+                    if dead_letters is not None:
+                        try:
+                            dead_letters.add(message)
+                        except Exception:
+                            logger.exception("Could not store notification in dead letters")
+                            kept.append(fields)
+            if not kept:
+                ids, leases = done[parent_id]
+                ids.append(row["id"])
+                leases.append(lease_id)
+            elif len(kept) < len(row["messages"]):
+                # Only keep the failed messages, which are sent again once the lease expired.
+                self.storage.update(
+                    resource_name=RESOURCE_NAME,
+                    parent_id=parent_id,
+                    object_id=row["id"],
+                    obj={"messages": kept},
+                )
+            if ending:
+                break
+        for parent_id, (ids, leases) in done.items():
+            self.remove(parent_id, ids, leases)
+        return sent, failed
@@ -0,0 +1,115 @@
+import threading
+import time
+
+from kinto_emailer.cache import LRUCache
+
+
+SCOPES = ("global", "hook", "recipient")
+POLICIES = ("drop", "digest")
+
+
+def parse_limit(value):
+    """Parse a ``count/seconds`` limit (e.g. ``10/60``) into a (burst, rate per
+    second) tuple.
+    """
+    count, _, seconds = str(value).partition("/")
+    burst = float(count)
+    return burst, burst / float(seconds or 1)
+
+
+def is_enabled(settings, prefix="emailer.rate_limit."):
+    return any(settings.get(prefix + scope) for scope in SCOPES)
+
+
+class MemoryBackend:
+    """Keep the buckets in process memory. The least recently used buckets are
+    forgotten (i.e. refilled) beyond ``maxsize`` entries.
+    """
+
+    def __init__(self, maxsize=10000):
+        self._buckets = LRUCache(maxsize=maxsize)
+
+    def get(self, key):
+        return self._buckets.get(key)
+
+    def set(self, key, value, ttl):
+        self._buckets.set(key, value)
+
+
+class CacheBackend:
+    """Keep the buckets in a Kinto cache backend, shared by every process.
+
+    Buckets are read and written back without locking across processes, limits
+    are thus approximate under concurrency.
+    """
+
+    def __init__(self, cache, prefix="emailer.rate_limit."):
+        self.cache = cache
+        self.prefix = prefix
+
+    def get(self, key):
+        value = self.cache.get(self.prefix + key)
+        return tuple(value) if value is not None else None
+
+    def set(self, key, value, ttl):
+        self.cache.set(self.prefix + key, list(value), ttl)
+
+
+class RateLimiter:
+    """Token buckets limiting the number of messages sent globally, per hook and
+    per recipient.
+
+    :param limits: ``{scope: (burst, rate)}`` where scope is one of ``global``,
+        ``hook`` or ``recipient``: at most ``burst`` messages can be sent at
+        once, and the allowance grows back by ``rate`` messages per second.
+    """
+
+    def __init__(self, limits, backend=None, policy="drop"):
+        if policy not in POLICIES:
+            raise ValueError(
+                "Invalid rate limit policy %r (expected one of %s)" % (policy, ", ".join(POLICIES))
+            )
+        self.limits = limits
+        self.backend = backend or MemoryBackend()
+        self.policy = policy
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_settings(cls, settings, cache=None, prefix="emailer.rate_limit."):
+        limits = {
+            scope: parse_limit(settings[prefix + scope])
+            for scope in SCOPES
+            if settings.get(prefix + scope)
+        }
+        backend = settings.get(prefix + "backend", "memory")
+        if backend not in ("memory", "cache"):
+            raise ValueError("Invalid rate limit backend %r" % backend)
+        return cls(
+            limits,
+            backend=CacheBackend(cache) if backend == "cache" else MemoryBackend(),
+            policy=settings.get(prefix + "policy", "drop"),
+        )
+
+    def _consume(self, scope, key, now):
+        if scope not in self.limits:
+            return True
+        burst, rate = self.limits[scope]
+        key = "%s:%s" % (scope, key)
+        tokens, updated = self.backend.get(key) or (burst, now)
+        tokens = min(burst, tokens + (now - updated) * rate)
+        allowed = tokens >= 1
+        if allowed:
+            tokens -= 1
+        # Past this delay, the bucket is full again and can be forgotten.
+        self.backend.set(key, (tokens, now), ttl=int((burst - tokens) / rate) + 1)
+        return allowed
+
+    def limit(self, hook_key, recipients):
+        """Consume a token for the message of the specified hook, and one for
+        each of its recipients. Returns the recipients allowed to receive it.
+        """
+        now = time.time()
+        with self._lock:
+            if not self._consume("global", "", now) or not self._consume("hook", hook_key, now):
+                return []
+            return [r for r in recipients if self._consume("recipient", r.lower(), now)]
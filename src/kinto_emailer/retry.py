@@ -0,0 +1,91 @@
+import logging
+import random
+import smtplib
+import time
+
+
+logger = logging.getLogger(__name__)
+
+
+def is_transient(error):
+    """Return ``True`` if sending again could succeed (e.g. 4xx SMTP replies,
+    network errors).
+    """
+    if isinstance(error, smtplib.SMTPResponseException):
+        return 400 <= error.smtp_code < 500
+    if isinstance(error, smtplib.SMTPRecipientsRefused):
+        return all(400 <= code < 500 for code, _ in error.recipients.values())
+    if isinstance(error, smtplib.SMTPServerDisconnected):
+        return True
+    if isinstance(error, smtplib.SMTPException):
+        return False
+    return isinstance(error, OSError)
+
+
+class RetryPolicy:
+    """Retry transient failures, at most ``attempts`` times in total, waiting
+    an exponentially growing delay (with jitter) between attempts.
+
+    No attempt is made if it would start more than ``max_time`` seconds after
+    the first one, or after ``deadline`` (a ``time.monotonic()`` value shared by
+    every run) if set.
+    """
+
+    def __init__(self, attempts=3, backoff=0.5, max_backoff=10, max_time=10, deadline=None):
+        self.attempts = attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.max_time = max_time
+        self.deadline = deadline
+
+    @classmethod
+    def from_settings(cls, settings, prefix="emailer.retry."):
+        return cls(
+            attempts=int(settings.get(prefix + "attempts", 3)),
+            backoff=float(settings.get(prefix + "backoff", 0.5)),
+            max_backoff=float(settings.get(prefix + "max_backoff", 10)),
+            max_time=float(settings.get(prefix + "max_time", 10)),
+        )
+
+    def delay(self, attempt):
+        """Return the delay to wait after the specified failed attempt."""
+        delay = min(self.max_backoff, self.backoff * 2 ** (attempt - 1))
+        return random.uniform(delay / 2, delay)
+
+    def run(self, func, *args, **kwargs):
+        deadline = time.monotonic() + self.max_time
+        if self.deadline is not None:
+            deadline = min(deadline, self.deadline)
+        attempt = 1
+        while True:
+            try:
+                return func(*args, **kwargs)
+            except Exception as e:
+                if attempt >= self.attempts or not is_transient(e):
+                    raise
+                delay = self.delay(attempt)
+                if time.monotonic() + delay > deadline:
+                    raise
+                logger.warning("Could not send notification (%r), retry in %.2fs.", e, delay)
+                time.sleep(delay)
+                attempt += 1
+
+
+def deliver(mailer, message, retry=None, dead_letters=None):
+    """Send the message immediately, retrying transient failures.
+
+    Messages that cannot be sent are stored in ``dead_letters`` if specified.
+    Returns ``True`` if the message was sent.
+    """
+    retry = retry or RetryPolicy(attempts=1)
+    try:
+        retry.run(mailer.send_immediately, message, fail_silently=False)
+        return True
+    except Exception:
+        logger.exception("Could not send notification")
+    if dead_letters is not None:
+        try:
+            dead_letters.add(message)
+        except Exception:
+            logger.exception("Could not store notification in dead letters")
+    return False
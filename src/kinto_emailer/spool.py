@@ -0,0 +1,123 @@
+import json
+import logging
+import sqlite3
+import time
+from collections import OrderedDict
+
+from pyramid_mailer.message import Message
+
+
+logger = logging.getLogger(__name__)
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    sender TEXT,
+    recipients TEXT NOT NULL,
+    subject TEXT NOT NULL,
+    body TEXT NOT NULL,
+    html TEXT,
+    created REAL NOT NULL
+)
+"""
+
+
+class Spool:
+    """Local SQLite spool of messages waiting to be merged and sent.
+
+    Messages with the same sender, recipients and subject are merged into a
+    single email when the spool is flushed.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with self._connect() as conn:
+            conn.execute(SCHEMA)
+            columns = [row[1] for row in conn.execute("PRAGMA table_info(messages)")]
+            if "html" not in columns:
+                # Spools created before HTML templates.
+                conn.execute("ALTER TABLE messages ADD COLUMN html TEXT")
+
+    @classmethod
+    def from_settings(cls, settings, prefix="emailer.spool."):
+        path = settings.get(prefix + "path")
+        if not path:
+            raise ValueError("Missing '%spath' setting" % prefix)
+        return cls(path)
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30)
+        conn.execute("PRAGMA journal_mode=WAL")
+        return conn
+
+    def add(self, messages):
+        """Store the specified messages until the next flush.
+        Returns the number of messages stored.
+        """
+        now = time.time()
+        rows = [
+            (m.sender, json.dumps(sorted(m.recipients)), m.subject, m.body, m.html, now)
+            for m in messages
+        ]
+        conn = self._connect()
+        try:
+            with conn:
+                conn.executemany(
+                    "INSERT INTO messages (sender, recipients, subject, body, html, created)"
+                    " VALUES (?, ?, ?, ?, ?, ?)",
+                    rows,
+                )
+        finally:
+            conn.close()
+        return len(rows)
+
+    def __len__(self):
+        conn = self._connect()
+        try:
+            (count,) = conn.execute("SELECT COUNT(*) FROM messages").fetchone()
+        finally:
+            conn.close()
+        return count
+
+    def flush(self, mailer, max_items=100):
+        """Send one email per (sender, recipients, subject), whose body lists the
+        bodies of the spooled messages (at most ``max_items`` per email).
+
+        Messages are removed from the spool once sent. Returns the number of
+        emails sent.
+        """
+        conn = self._connect()
+        try:
+            rows = conn.execute(
+                "SELECT id, sender, recipients, subject, body, html FROM messages ORDER BY id"
+            ).fetchall()
+            groups = OrderedDict()
+            for id_, sender, recipients, subject, body, html in rows:
+                groups.setdefault((sender, recipients, subject), []).append((id_, body, html))
+
+            sent = 0
+            for (sender, recipients, subject), items in groups.items():
+                for i in range(0, len(items), max_items):
+                    chunk = items[i : i + max_items]
+                    htmls = [html for _, _, html in chunk if html is not None]
+                    message = Message(
+                        subject=subject,
+                        sender=sender,
+                        recipients=json.loads(recipients),
+                        body="\n".join(body for _, body, _ in chunk),
+                        html="\n".join(htmls) if htmls else None,
+                    )
+                    try:
+                        mailer.send_immediately(message, fail_silently=False)
+                    except Exception:
+                        logger.exception("Could not send spooled notifications")
+                        continue
+                    with conn:
+                        conn.executemany(
+                            "DELETE FROM messages WHERE id = ?", [(id_,) for id_, _, _ in chunk]
+                        )
+                    sent += 1
+        finally:
+            conn.close()
+        return sent
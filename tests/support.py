@@ -0,0 +1,130 @@
+import contextlib
+import socketserver
+import threading
+import time
+from collections import Counter
+
+from kinto.core.metrics import IMetricsService
+from zope.interface import implementer
+
+
+class _SMTPHandler(socketserver.StreamRequestHandler):
+    def reply(self, line):
+        self.wfile.write((line + "\r\n").encode("ascii"))
+
+    def handle(self):
+        server = self.server
+        with server.lock:
+            server.connections += 1
+        self.reply("220 localhost fake SMTP")
+        mail_from, rcpt_tos = None, []
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line.decode("ascii").strip()
+            verb = command.split(" ", 1)[0].split(":", 1)[0].upper()
+            with server.lock:
+                server.commands.append(verb)
+            if verb in ("EHLO", "HELO"):
+                self.reply("250 localhost")
+            elif verb == "MAIL":
+                with server.lock:
+                    failure = server.failures.pop(0) if server.failures else None
+                if failure:
+                    self.reply(failure)
+                    continue
+                mail_from, rcpt_tos = command.split(":", 1)[1].strip(), []
+                self.reply("250 OK")
+            elif verb == "RCPT":
+                rcpt_tos.append(command.split(":", 1)[1].strip())
+                self.reply("250 OK")
+            elif verb == "DATA":
+                self.reply("354 End data with <CR><LF>.<CR><LF>")
+                lines = []
+                while True:
+                    data = self.rfile.readline()
+                    if data in (b".\r\n", b""):
+                        break
+                    lines.append(data)
+                if server.delay:
+                    time.sleep(server.delay)
+                with server.lock:
+                    server.messages.append((mail_from, rcpt_tos, b"".join(lines)))
+                self.reply("250 OK")
+            elif verb in ("NOOP", "RSET"):
+                self.reply("250 OK")
+            elif verb == "QUIT":
+                self.reply("221 Bye")
+                return
+            else:
+                self.reply("502 Command not implemented")
+
+
+class FakeSMTPServer(socketserver.ThreadingTCPServer):
+    """A tiny SMTP server listening on localhost, which records the messages
+    it receives. Use it as a context manager.
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, delay=0, failures=None):
+        super().__init__(("127.0.0.1", 0), _SMTPHandler)
+        self.port = self.server_address[1]
+        self.delay = delay
+        # Replies to send (e.g. "451 Try again later") instead of accepting ``MAIL``.
+        self.failures = list(failures or [])
+        self.lock = threading.Lock()
+        self.connections = 0
+        self.commands = []
+        self.messages = []
+
+    def __enter__(self):
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.shutdown()
+        self.server_close()
+        self._thread.join()
+
+    def wait_for(self, count, timeout=5):
+        deadline = time.monotonic() + timeout
+        while len(self.messages) < count and time.monotonic() < deadline:
+            time.sleep(0.01)
+        return len(self.messages) >= count
+
+
+@implementer(IMetricsService)
+class MemoryMetricsService:
+    """Keep the metrics in memory, to assert on them in tests.
+
+    ``counts`` holds the counters by (key, labels), and ``timings`` the
+    durations measured by key.
+    """
+
+    def __init__(self):
+        self.counts = Counter()
+        self.timings = {}
+
+    @contextlib.contextmanager
+    def _timer(self, key):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timings.setdefault(key, []).append(time.perf_counter() - start)
+
+    def timer(self, key, value=None, labels=[]):
+        if value is not None:
+            self.timings.setdefault(key, []).append(value)
+            return None
+        return self._timer(key)
+
+    def observe(self, key, value, labels=[]):
+        self.timings.setdefault(key, []).append(value)
+
+    def count(self, key, count=1, unique=None):
+        self.counts[(key, tuple(unique or ()))] += count
@@ -0,0 +1,200 @@
+import os
+import time
+import unittest
+
+import aiosmtplib
+import mock
+from kinto.core.testing import get_user_headers
+from pyramid_mailer.mailer import Mailer
+
+from kinto_emailer.asyncsmtp import AsyncDelivery, is_transient_async
+from kinto_emailer.retry import RetryPolicy
+
+from .support import FakeSMTPServer
+from .test_delivery import make_message
+from .test_includeme import EmailerTest
+
+
+class AsyncDeliveryTest(unittest.TestCase):
+    def test_messages_are_sent_through_smtp_from_the_event_loop(self):
+        with FakeSMTPServer() as server:
+            delivery = AsyncDelivery(port=server.port, concurrency=3)
+            for i in range(10):
+                assert delivery.enqueue(None, make_message(i))
+            assert delivery.shutdown() == 0
+        assert len(server.messages) == 10
+        mail_from, rcpt_tos, data = server.messages[0]
+        assert mail_from == "<kinto@restmail.net>"
+        assert rcpt_tos == ["<me@you.com>"]
+        assert b"Subject: Hello" in data
+
+    def test_connections_are_bounded_by_concurrency_and_reused(self):
+        with FakeSMTPServer(delay=0.05) as server:
+            delivery = AsyncDelivery(port=server.port, concurrency=2)
+            for i in range(6):
+                delivery.enqueue(None, make_message(i))
+            assert delivery.shutdown() == 0
+        assert len(server.messages) == 6
+        assert server.connections == 2
+
+    def test_enqueue_does_not_wait_for_smtp(self):
+        with FakeSMTPServer(delay=0.5) as server:
+            delivery = AsyncDelivery(port=server.port)
+            delivery.enqueue(None, make_message())
+            assert server.messages == []
+            delivery.shutdown()
+        assert len(server.messages) == 1
+
+    def test_default_sender_is_used(self):
+        with FakeSMTPServer() as server:
+            delivery = AsyncDelivery(port=server.port)
+            mailer = Mailer(default_sender="default@restmail.net")
+            message = make_message()
+            message.sender = None
+            delivery.enqueue(mailer, message)
+            delivery.shutdown()
+        assert server.messages[0][0] == "<default@restmail.net>"
+
+    def test_closed_connections_are_not_reused(self):
+        with FakeSMTPServer() as server:
+            delivery = AsyncDelivery(port=server.port)
+            delivery.enqueue(None, make_message(1))
+            while delivery._pending:
+                time.sleep(0.01)
+            delivery._loop.call_soon_threadsafe(lambda: delivery._idle[0].close())
+            delivery.enqueue(None, make_message(2))
+            delivery.shutdown()
+        assert len(server.messages) == 2
+        assert server.connections == 2
+
+    def test_transient_failures_are_retried(self):
+        with FakeSMTPServer(failures=["451 Try again later"]) as server:
+            retry = RetryPolicy(attempts=2, backoff=0.01)
+            delivery = AsyncDelivery(port=server.port, retry=retry)
+            delivery.enqueue(None, make_message())
+            delivery.shutdown()
+        assert len(server.messages) == 1
+
+    def test_undelivered_messages_are_stored_in_dead_letters(self):
+        dead_letters = mock.MagicMock()
+        dead_letters.add.side_effect = [None, OSError]
+        failures = ["550 No such user", "550 No such user"]
+        with FakeSMTPServer(failures=failures) as server:
+            retry = RetryPolicy(attempts=3, backoff=0.01)
+            delivery = AsyncDelivery(port=server.port, retry=retry, dead_letters=dead_letters)
+            message = make_message()
+            with mock.patch("kinto_emailer.asyncsmtp.logger") as logger:
+                delivery.enqueue(None, message)
+                delivery.enqueue(None, make_message())
+                delivery.shutdown()
+        assert server.messages == []
+        assert mock.call(message) in dead_letters.add.call_args_list
+        assert logger.exception.call_count == 3
+
+    def test_messages_are_dropped_when_too_many_are_pending(self):
+        with FakeSMTPServer(delay=0.2) as server:
+            delivery = AsyncDelivery(port=server.port, queue_size=1)
+            assert delivery.enqueue(None, make_message(1))
+            assert not delivery.enqueue(None, make_message(2))
+            delivery.shutdown()
+        assert len(server.messages) == 1
+
+    def test_shutdown_reports_undelivered_messages_after_timeout(self):
+        with FakeSMTPServer(delay=0.5) as server:
+            delivery = AsyncDelivery(port=server.port, concurrency=1, shutdown_timeout=0.1)
+            delivery.enqueue(None, make_message(1))
+            delivery.enqueue(None, make_message(2))
+            assert delivery.shutdown() == 2
+
+    def test_connections_are_closed_on_shutdown_even_if_quit_fails(self):
+        with FakeSMTPServer() as server:
+            delivery = AsyncDelivery(port=server.port)
+            delivery.enqueue(None, make_message())
+            assert server.wait_for(1)
+            quit = mock.patch.object(
+                aiosmtplib.SMTP, "quit", side_effect=aiosmtplib.SMTPServerDisconnected("gone")
+            )
+            with quit:
+                assert delivery.shutdown() == 0
+        assert "QUIT" not in server.commands
+
+    def test_shutdown_is_noop_if_never_started_or_in_another_process(self):
+        delivery = AsyncDelivery()
+        assert delivery.shutdown() == 0
+        delivery._pid = os.getpid() + 1
+        assert delivery.shutdown() == 0
+
+    def test_can_be_configured_from_settings(self):
+        delivery = AsyncDelivery.from_settings(
+            {
+                "mail.host": "smtp.example.com",
+                "mail.port": "587",
+                "mail.tls": "true",
+                "emailer.async.concurrency": "20",
+                "emailer.async.queue_size": "50",
+                "emailer.async.timeout": "5",
+                "emailer.async.shutdown_timeout": "1.5",
+            }
+        )
+        assert delivery.smtp_options["hostname"] == "smtp.example.com"
+        assert delivery.smtp_options["port"] == 587
+        assert delivery.smtp_options["start_tls"] is True
+        assert delivery.smtp_options["timeout"] == 5
+        assert delivery.concurrency == 20
+        assert delivery.queue_size == 50
+        assert delivery.shutdown_timeout == 1.5
+        defaults = AsyncDelivery.from_settings({})
+        assert defaults.smtp_options["port"] == 25
+        assert defaults.smtp_options["start_tls"] is None
+
+    def test_aiosmtplib_is_required(self):
+        with mock.patch("kinto_emailer.asyncsmtp.aiosmtplib", None):
+            with self.assertRaises(ValueError):
+                AsyncDelivery()
+
+
+class TransientAsyncErrorsTest(unittest.TestCase):
+    def test_4xx_responses_are_transient(self):
+        assert is_transient_async(aiosmtplib.SMTPResponseException(451, "Try again"))
+        assert not is_transient_async(aiosmtplib.SMTPResponseException(550, "No such user"))
+
+    def test_refused_recipients_are_transient_if_all_are(self):
+        def refused(*codes):
+            return aiosmtplib.SMTPRecipientsRefused(
+                [aiosmtplib.SMTPRecipientRefused(code, "", "a@b.com") for code in codes]
+            )
+
+        assert is_transient_async(refused(450, 451))
+        assert not is_transient_async(refused(450, 550))
+
+    def test_disconnections_and_timeouts_are_transient(self):
+        assert is_transient_async(aiosmtplib.SMTPServerDisconnected("gone"))
+        assert is_transient_async(aiosmtplib.SMTPTimeoutError("slow"))
+        assert not is_transient_async(ValueError("boom"))
+
+
+class AsyncSetupTest(EmailerTest):
+    @classmethod
+    def get_app_settings(cls, extras=None):
+        settings = super().get_app_settings(extras)
+        settings["emailer.delivery"] = "async"
+        return settings
+
+    def setUp(self):
+        self.headers = dict(self.headers, **get_user_headers("nous"))
+
+    def test_delivery_engine_is_registered(self):
+        assert isinstance(self.app.app.registry.emailer_delivery, AsyncDelivery)
+
+    def test_messages_are_enqueued_after_commit(self):
+        bucket = {
+            "kinto-emailer": {
+                "hooks": [{"template": "Created {id}.", "recipients": ["me@you.com"]}]
+            }
+        }
+        self.app.put_json("/buckets/b", {"data": bucket}, headers=self.headers)
+        delivery = self.app.app.registry.emailer_delivery
+        with mock.patch.object(delivery, "enqueue") as enqueue:
+            self.app.put_json("/buckets/b/collections/c", headers=self.headers)
+        ((_, message), _) = enqueue.call_args
+        assert message.body == "Created c."
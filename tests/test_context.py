@@ -0,0 +1,60 @@
+import unittest
+
+import mock
+
+from kinto_emailer.context import EventContext, ObjectContext
+
+
+class EventContextTest(unittest.TestCase):
+    def setUp(self):
+        self.event = mock.MagicMock()
+        self.event.payload = {"action": "update", "bucket_id": "b", "resource_name": "record"}
+        self.event.request.registry.settings = {"project_name": "Kinto DEV", "secret": "s3cr3t"}
+        self.event.request.route_url.return_value = "http://kinto/v1/"
+        self.context = EventContext(self.event)
+
+    def test_fields_are_computed_when_accessed(self):
+        assert not self.event.request.route_url.called
+        assert self.context["root_url"] == "http://kinto/v1/"
+        assert self.context["root_url"] == "http://kinto/v1/"
+        assert self.event.request.route_url.call_count == 1
+
+    def test_payload_fields_are_available(self):
+        assert self.context["bucket_id"] == "b"
+        assert "action" in self.context
+
+    def test_only_public_settings_are_exposed(self):
+        assert self.context["settings"] == {"project_name": "Kinto DEV"}
+
+    def test_missing_ids_are_left_as_placeholders(self):
+        assert self.context["record_id"] == "{record_id}"
+        assert self.context["collection_id"] == "{collection_id}"
+
+    def test_unknown_fields_are_missing(self):
+        assert "unknown" not in self.context
+        with self.assertRaises(KeyError):
+            self.context["unknown"]
+
+    def test_context_can_be_expanded(self):
+        assert "{event} {action}".format(**self.context) == "mock.mock.MagicMock update"
+        assert len(self.context) == 11
+
+
+class ObjectContextTest(unittest.TestCase):
+    def setUp(self):
+        self.parent = {"bucket_id": "b", "record_id": "{record_id}"}
+        self.context = ObjectContext(self.parent, "record_id", "abc")
+
+    def test_object_id_is_exposed_as_id_and_resource_id(self):
+        assert self.context["id"] == "abc"
+        assert self.context["record_id"] == "abc"
+        assert "id" in self.context
+
+    def test_other_fields_are_read_from_event_context(self):
+        assert self.context["bucket_id"] == "b"
+        assert "bucket_id" in self.context
+        assert "unknown" not in self.context
+
+    def test_context_can_be_expanded(self):
+        assert dict(self.context) == {"id": "abc", "record_id": "abc", "bucket_id": "b"}
+        assert len(self.context) == 3
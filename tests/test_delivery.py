@@ -0,0 +1,162 @@
+import threading
+import unittest
+
+import mock
+from kinto.core.testing import get_user_headers
+from pyramid_mailer.mailer import Mailer
+from pyramid_mailer.message import Message
+
+from kinto_emailer.delivery import BackgroundDelivery
+
+from .support import FakeSMTPServer
+from .test_includeme import EmailerTest
+
+
+def make_message(i=0):
+    return Message(
+        subject="Hello %s" % i, sender="kinto@restmail.net", recipients=["me@you.com"], body="Hi"
+    )
+
+
+class BlockingMailer:
+    """A mailer whose sends wait until ``release`` is set."""
+
+    def __init__(self):
+        self.started = threading.Event()
+        self.release = threading.Event()
+        self.sent = []
+
+    def send_immediately(self, message, fail_silently=False):
+        self.started.set()
+        self.release.wait(5)
+        self.sent.append(message)
+
+
+class BackgroundDeliveryTest(unittest.TestCase):
+    def test_messages_are_sent_through_smtp_by_workers(self):
+        delivery = BackgroundDelivery(workers=3)
+        with FakeSMTPServer() as server:
+            mailer = Mailer(host="127.0.0.1", port=server.port)
+            for i in range(10):
+                assert delivery.enqueue(mailer, make_message(i))
+            assert delivery.shutdown() == 0
+        assert len(server.messages) == 10
+
+    def test_enqueue_does_not_wait_for_smtp(self):
+        delivery = BackgroundDelivery(workers=1)
+        mailer = BlockingMailer()
+        delivery.enqueue(mailer, make_message())
+        assert mailer.sent == []
+        mailer.release.set()
+        delivery.shutdown()
+        assert len(mailer.sent) == 1
+
+    def test_messages_are_dropped_when_queue_is_full_with_drop_policy(self):
+        delivery = BackgroundDelivery(queue_size=1, workers=1, overflow="drop")
+        mailer = BlockingMailer()
+        delivery.enqueue(mailer, make_message(1))
+        mailer.started.wait(5)
+        assert delivery.enqueue(mailer, make_message(2))
+        assert not delivery.enqueue(mailer, make_message(3))
+        mailer.release.set()
+        delivery.shutdown()
+        assert [m.subject for m in mailer.sent] == ["Hello 1", "Hello 2"]
+
+    def test_messages_are_sent_inline_when_queue_is_full_with_inline_policy(self):
+        delivery = BackgroundDelivery(queue_size=1, workers=1, overflow="inline")
+        mailer = BlockingMailer()
+        delivery.enqueue(mailer, make_message(1))
+        mailer.started.wait(5)
+        delivery.enqueue(mailer, make_message(2))
+        other = mock.MagicMock()
+        assert delivery.enqueue(other, make_message(3))
+        assert other.send_immediately.called
+        mailer.release.set()
+        delivery.shutdown()
+
+    def test_sending_errors_do_not_stop_the_workers(self):
+        delivery = BackgroundDelivery(workers=1)
+        mailer = mock.MagicMock()
+        mailer.send_immediately.side_effect = [ValueError("boom"), None]
+        with mock.patch("kinto_emailer.retry.logger") as logger:
+            delivery.enqueue(mailer, make_message(1))
+            delivery.enqueue(mailer, make_message(2))
+            delivery.shutdown()
+        assert mailer.send_immediately.call_count == 2
+        assert logger.exception.called
+
+    def test_shutdown_reports_undelivered_messages_after_timeout(self):
+        delivery = BackgroundDelivery(queue_size=2, workers=1, shutdown_timeout=0.1)
+        mailer = BlockingMailer()
+        delivery.enqueue(mailer, make_message(1))
+        mailer.started.wait(5)
+        delivery.enqueue(mailer, make_message(2))
+        delivery.enqueue(mailer, make_message(3))
+        assert delivery.shutdown() == 2
+        mailer.release.set()
+
+    def test_shutdown_is_noop_if_never_started(self):
+        assert BackgroundDelivery().shutdown() == 0
+
+    def test_overflow_policy_is_validated(self):
+        with self.assertRaises(ValueError):
+            BackgroundDelivery(overflow="explode")
+
+    def test_can_be_configured_from_settings(self):
+        delivery = BackgroundDelivery.from_settings(
+            {
+                "emailer.background.queue_size": "5",
+                "emailer.background.workers": "4",
+                "emailer.background.overflow": "drop",
+                "emailer.background.shutdown_timeout": "1.5",
+            }
+        )
+        assert delivery.queue_size == 5
+        assert delivery.workers == 4
+        assert delivery.overflow == "drop"
+        assert delivery.shutdown_timeout == 1.5
+
+
+class BackgroundSetupTest(EmailerTest):
+    @classmethod
+    def get_app_settings(cls, extras=None):
+        settings = super().get_app_settings(extras)
+        settings["emailer.delivery"] = "background"
+        return settings
+
+    def setUp(self):
+        self.headers = dict(self.headers, **get_user_headers("nous"))
+
+    def test_delivery_engine_is_registered(self):
+        assert isinstance(self.app.app.registry.emailer_delivery, BackgroundDelivery)
+
+    def test_messages_are_enqueued_after_commit(self):
+        bucket = {
+            "kinto-emailer": {
+                "hooks": [{"template": "Created {id}.", "recipients": ["me@you.com"]}]
+            }
+        }
+        self.app.put_json("/buckets/b", {"data": bucket}, headers=self.headers)
+        delivery = self.app.app.registry.emailer_delivery
+        with mock.patch.object(delivery, "enqueue") as enqueue:
+            self.app.put_json("/buckets/b/collections/c", headers=self.headers)
+        ((_, message), _) = enqueue.call_args
+        assert message.body == "Created c."
+
+    def test_workers_send_with_the_registry_mailer(self):
+        bucket = {
+            "kinto-emailer": {
+                "hooks": [{"template": "Created {id}.", "recipients": ["me@you.com"]}]
+            }
+        }
+        self.app.put_json("/buckets/b", {"data": bucket}, headers=self.headers)
+        delivery = self.app.app.registry.emailer_delivery
+        with FakeSMTPServer() as server:
+            mailer = Mailer(host="127.0.0.1", port=server.port, default_sender="a@b.com")
+            with mock.patch("kinto_emailer.get_mailer", return_value=mailer):
+                for i in range(3):
+                    self.app.put_json("/buckets/b/collections/c%s" % i, headers=self.headers)
+            delivery.shutdown()
+        assert len(server.messages) == 3
+        # No connection is left open in a throwaway pool.
+        assert server.commands.count("QUIT") == server.connections == 3
@@ -0,0 +1,207 @@
+import time
+import unittest
+
+import mock
+
+from kinto_emailer.cache import LRUCache
+from kinto_emailer.hooks import (
+    CompiledHook,
+    HookIndex,
+    HTMLTemplate,
+    Template,
+    compile_hooks,
+    compiled_hooks,
+    html_templates,
+)
+
+
+class TemplateTest(unittest.TestCase):
+    def test_placeholders_are_rendered(self):
+        assert Template("{a} and {b[c]}").render({"a": 1, "b": {"c": 2}}) == "1 and 2"
+
+    def test_templates_without_placeholders_are_not_formatted(self):
+        template = Template("Hello {{world}}")
+        assert template.text == "Hello {world}"
+        assert template.render({}) == "Hello {world}"
+
+    def test_invalid_templates_fail_when_rendered(self):
+        template = Template("Hello {")
+        with self.assertRaises(ValueError):
+            template.render({})
+
+
+class HTMLTemplateTest(unittest.TestCase):
+    def setUp(self):
+        html_templates.clear()
+        self.addCleanup(html_templates.clear)
+
+    def test_fields_are_rendered_with_html_escaping(self):
+        template = HTMLTemplate("<p>{{ a }} and {{ b.c }}</p>")
+        assert template.render({"a": "<b>", "b": {"c": 2}}) == "<p>&lt;b&gt; and 2</p>"
+
+    def test_only_used_fields_are_looked_up(self):
+        context = mock.MagicMock()
+        context.__contains__.return_value = True
+        context.__getitem__.return_value = "x"
+        assert HTMLTemplate("{{ a }}{% for i in [1] %}{{ i }}{% endfor %}").render(context) == "x1"
+        context.__getitem__.assert_called_once_with("a")
+
+    def test_templates_are_compiled_once_per_source(self):
+        first = HTMLTemplate("<p>{{ a }}</p>")
+        second = HTMLTemplate("<p>{{ a }}</p>")
+        assert first.template is second.template
+        assert len(html_templates) == 1
+
+    def test_templates_are_rendered_in_a_sandbox(self):
+        template = HTMLTemplate("{{ a.__class__.__mro__ }}")
+        with self.assertRaises(Exception) as cm:
+            template.render({"a": ""})
+        assert type(cm.exception).__name__ == "SecurityError"
+
+    def test_invalid_templates_fail_when_rendered(self):
+        template = HTMLTemplate("<p>{{ a </p>")
+        assert "line 1" in str(template.error)
+        with self.assertRaises(ValueError):
+            template.render({})
+        assert len(html_templates) == 0
+
+    def test_templates_fail_without_jinja(self):
+        with mock.patch("kinto_emailer.hooks.html_environment", None):
+            template = HTMLTemplate("<p>{{ a }}</p>")
+        assert "require Jinja" in str(template.error)
+
+
+class CompiledHookTest(unittest.TestCase):
+    def test_hook_matches_if_no_filter(self):
+        hook = CompiledHook({"template": "", "recipients": []})
+        assert hook.matches({"action": "create"})
+
+    def test_filters_are_ignored_if_field_is_not_in_context(self):
+        hook = CompiledHook({"action": "update", "template": "", "recipients": []})
+        assert hook.matches({})
+
+    def test_filters_values_are_compared(self):
+        hook = CompiledHook({"action": "update", "template": "", "recipients": []})
+        assert hook.matches({"action": "update"})
+        assert not hook.matches({"action": "create"})
+
+    def test_filters_values_can_be_regexps(self):
+        hook = CompiledHook({"collection_id": "^a.+", "template": "", "recipients": []})
+        assert hook.matches({"collection_id": "abc"})
+        assert not hook.matches({"collection_id": "a"})
+
+    def test_recipients_are_split_between_emails_and_groups(self):
+        hook = CompiledHook(
+            {
+                "template": "",
+                "recipients": ["me@you.com", "/buckets/b/groups/g", "/buckets/b/groups/{id}"],
+            }
+        )
+        assert hook.emails == ["me@you.com"]
+        assert hook.render_groups({"id": "h"}) == ["/buckets/b/groups/g", "/buckets/b/groups/h"]
+
+
+class HookIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.index = HookIndex(
+            [
+                {"collection_id": "a", "template": "1", "recipients": []},
+                {"collection_id": "^b", "template": "2", "recipients": []},
+                {"collection_id": "b", "action": "create", "template": "3", "recipients": []},
+                {"id": "x", "collection_id": "b", "template": "4", "recipients": []},
+                {"template": "5", "recipients": []},
+            ]
+        )
+
+    def match(self, context):
+        return [hook.template.text for hook in self.index.match(context)]
+
+    def test_only_hooks_with_matching_values_are_tested(self):
+        with mock.patch.object(CompiledHook, "matches", return_value=True) as matches:
+            assert self.match({"collection_id": "a", "id": "y"}) == ["1", "2", "5"]
+        assert matches.call_count == 3
+
+    def test_matching_hooks_are_returned_in_their_original_order(self):
+        context = {"collection_id": "b", "action": "create", "id": "x"}
+        assert self.match(context) == ["2", "3", "4", "5"]
+
+    def test_hooks_indexed_on_fields_absent_from_context_are_tested(self):
+        assert self.match({"collection_id": "b"}) == ["2", "3", "4", "5"]
+        assert self.match({}) == ["1", "2", "3", "4", "5"]
+
+    def test_hooks_are_still_filtered_on_other_fields(self):
+        assert self.match({"collection_id": "b", "action": "update", "id": "y"}) == ["2", "5"]
+
+
+class CompileHooksTest(unittest.TestCase):
+    def setUp(self):
+        compiled_hooks.clear()
+        self.metadata = {
+            "last_modified": 42,
+            "kinto-emailer": {"hooks": [{"template": "Hi", "recipients": ["me@you.com"]}]},
+        }
+
+    def test_hooks_are_compiled_once_per_timestamp(self):
+        first = compile_hooks("/buckets/b", self.metadata)
+        assert compile_hooks("/buckets/b", dict(self.metadata)) is first
+
+        self.metadata["last_modified"] = 43
+        assert compile_hooks("/buckets/b", self.metadata) is not first
+
+    def test_hooks_are_compiled_every_time_without_timestamp(self):
+        self.metadata.pop("last_modified")
+        first = compile_hooks("/buckets/b", self.metadata)
+        assert compile_hooks("/buckets/b", self.metadata) is not first
+        assert len(compiled_hooks) == 0
+
+    def test_metadata_without_hooks_have_no_compiled_hooks(self):
+        assert len(compile_hooks("/buckets/b", {"last_modified": 42})) == 0
+
+
+class LRUCacheTest(unittest.TestCase):
+    def test_least_recently_used_entries_are_evicted(self):
+        cache = LRUCache(maxsize=2)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        cache.get("a")
+        cache.set("c", 3)
+        assert cache.get("b") is None
+        assert cache.get("a") == 1
+        assert len(cache) == 2
+
+    def test_entries_expire_after_ttl(self):
+        cache = LRUCache(ttl=10)
+        cache.set("a", 1)
+        with mock.patch("kinto_emailer.cache.time.monotonic", return_value=time.monotonic() + 11):
+            assert cache.get("a") is None
+        assert len(cache) == 0
+
+    def test_hits_and_misses_are_counted(self):
+        cache = LRUCache()
+        cache.set("a", 1)
+        cache.get("a")
+        cache.get("b")
+        assert (cache.hits, cache.misses) == (1, 1)
+
+    def test_entries_can_be_removed(self):
+        cache = LRUCache()
+        cache.set("a", 1)
+        cache.pop("a")
+        cache.pop("b")
+        assert cache.get("a") is None
+
+    def test_cache_can_be_cleared(self):
+        cache = LRUCache()
+        cache.set("a", 1)
+        cache.clear()
+        assert cache.get("a", "missing") == "missing"
+
+    def test_membership_does_not_count_as_lookup(self):
+        cache = LRUCache(ttl=10)
+        cache.set("a", 1)
+        assert "a" in cache
+        assert "b" not in cache
+        with mock.patch("kinto_emailer.cache.time.monotonic", return_value=time.monotonic() + 11):
+            assert "a" not in cache
+        assert cache.keys() == ["a"]
+        assert (cache.hits, cache.misses) == (0, 0)
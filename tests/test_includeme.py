@@ -6,9 +6,25 @@ import mock
 from kinto import main as kinto_main
 from kinto.core import errors
 from kinto.core.events import AfterResourceChanged
+from kinto.core.metrics import IMetricsService
+from kinto.core.storage import exceptions as storage_exceptions
 from kinto.core.testing import BaseWebTest, FormattedErrorMixin, get_user_headers
 
-from kinto_emailer import build_notification, context_from_event, get_messages, send_notification
+from kinto_emailer import (
+    MESSAGES_KEY,
+    PendingMessage,
+    _render_messages,
+    build_notification,
+    context_from_event,
+    get_messages,
+    group_emails,
+    resolved_hooks,
+    send_notification,
+)
+from kinto_emailer.hooks import CompiledHook, Template, compiled_hooks
+from kinto_emailer.mailers import single_connection
+
+from .support import MemoryMetricsService
 
 
 HERE = os.path.dirname(os.path.abspath(__file__))
@@ -277,6 +293,8 @@ class BucketTest(unittest.TestCase):
 
 class GroupExpansionTest(unittest.TestCase):
     def setUp(self):
+        group_emails.clear()
+        self.addCleanup(group_emails.clear)
         self.storage = mock.MagicMock()
         self.collection_record = {
             "kinto-emailer": {
@@ -319,10 +337,141 @@ class GroupExpansionTest(unittest.TestCase):
             parent_id="/buckets/b", resource_name="group", object_id="c"
         )
 
+    def test_group_members_are_read_once(self):
+        get_messages(self.storage, self.payload)
+        self.storage.get.side_effect = [self.collection_record]
+        (message,) = get_messages(self.storage, self.payload)
+        assert message.recipients == ["devnull@localhost.com"]
+        assert group_emails.hits == 1
+
+    def test_missing_groups_are_cached_too(self):
+        self.storage.get.side_effect = [
+            self.collection_record,
+            storage_exceptions.ObjectNotFoundError,
+            self.collection_record,
+        ]
+        assert get_messages(self.storage, self.payload) == []
+        assert get_messages(self.storage, self.payload) == []
+        assert self.storage.get.call_count == 3
+
+
+class HTMLTemplateMessagesTest(unittest.TestCase):
+    def setUp(self):
+        self.storage = mock.MagicMock()
+        self.hook = {
+            "sender": "kinto@restmail.net",
+            "subject": "Record {id}",
+            "template": "Record {id} created.",
+            "html_template": "<p>Record <b>{{ id }}</b> created.</p>",
+            "recipients": ["me@you.com"],
+        }
+        self.storage.get.return_value = {"kinto-emailer": {"hooks": [self.hook]}}
+        self.payload = {"bucket_id": "b", "collection_id": "c", "resource_name": "record"}
+
+    def test_messages_are_sent_as_multipart_alternative(self):
+        (message,) = get_messages(self.storage, dict(self.payload, id="<r1>"))
+        assert message.body == "Record <r1> created."
+        assert message.html == "<p>Record <b>&lt;r1&gt;</b> created.</p>"
+        assert message.to_message().get_content_type() == "multipart/alternative"
+
+    def test_html_of_digests_is_merged(self):
+        self.hook["digest"] = True
+        self.hook["subject"] = "Records"
+        pending = [
+            PendingMessage(CompiledHook(self.hook), {"id": id_}, ["me@you.com"])
+            for id_ in ("r1", "r2")
+        ]
+        ((_, digest),) = _render_messages(pending, max_items=10)
+        assert digest.body == "Record r1 created.\nRecord r2 created."
+        assert digest.html == "<p>Record <b>r1</b> created.</p>\n<p>Record <b>r2</b> created.</p>"
+
+
+class DeduplicationTest(unittest.TestCase):
+    def setUp(self):
+        resolved_hooks.clear()
+        self.addCleanup(resolved_hooks.clear)
+        group_emails.clear()
+        self.addCleanup(group_emails.clear)
+        self.storage = mock.MagicMock()
+        self.hooks = [
+            {"template": "Changed.", "recipients": ["me@you.com", "/buckets/b/groups/g"]},
+            {"template": "Changed.", "recipients": ["Them <them@you.com>", "ME@you.com"]},
+        ]
+        group = {"members": ["portier:me@you.com", "portier:Them@You.com", "fxa:123"]}
+        self.storage.get.side_effect = [{"kinto-emailer": {"hooks": self.hooks}}, group]
+        self.payload = {"bucket_id": "b", "collection_id": "c", "resource_name": "record"}
+
+    def test_recipients_are_deduplicated_case_insensitively(self):
+        self.hooks.pop()
+        (message,) = get_messages(self.storage, self.payload)
+        assert message.recipients == ["me@you.com", "Them@You.com"]
+
+    def test_identical_messages_are_merged(self):
+        (message,) = get_messages(self.storage, self.payload)
+        assert message.recipients == ["me@you.com", "Them@You.com"]
+
+    def test_different_messages_are_not_merged(self):
+        self.hooks[1]["subject"] = "Other"
+        first, second = get_messages(self.storage, self.payload)
+        assert second.recipients == ["Them <them@you.com>", "ME@you.com"]
+
+    def test_identical_messages_of_an_object_are_sent_once(self):
+        event = mock.MagicMock()
+        event.request.bound_data = {}
+        event.request.registry.settings = {}
+        event.request.registry.storage = self.storage
+        event.impacted_objects = [{"new": {"id": "r1"}}, {"new": {"id": "r2"}}]
+        event.payload = dict(self.payload, action="create")
+        self.hooks[0]["template"] = self.hooks[1]["template"] = "Created {id}."
+        build_notification(event)
+        with mock.patch("kinto_emailer.get_mailer") as get_mailer:
+            send_notification(event)
+        sent = [c[0][0] for c in get_mailer().send_immediately.call_args_list]
+        assert [m.body for m in sent] == ["Created r1.", "Created r2."]
+        assert sent[0].recipients == ["me@you.com", "Them@You.com"]
+
+
+class GroupCacheInvalidationTest(EmailerTest):
+    def setUp(self):
+        self.headers = dict(self.headers, **get_user_headers("nous"))
+        bucket = {
+            "kinto-emailer": {
+                "hooks": [{"template": "Changed.", "recipients": ["/buckets/b/groups/g"]}]
+            }
+        }
+        self.app.put_json("/buckets/b", {"data": bucket}, headers=self.headers)
+        self.app.put_json(
+            "/buckets/b/groups/g", {"data": {"members": ["a@b.com"]}}, headers=self.headers
+        )
+        patch = mock.patch("kinto_emailer.get_mailer")
+        self.get_mailer = patch.start()
+        self.addCleanup(patch.stop)
+
+    def recipients_of_next_change(self):
+        self.get_mailer.reset_mock()
+        self.app.put_json("/buckets/b/collections/c", headers=self.headers)
+        ((message,), _) = self.get_mailer().send_immediately.call_args
+        return message.recipients
+
+    def test_group_changes_are_visible_immediately(self):
+        assert self.recipients_of_next_change() == ["a@b.com"]
+        self.app.put_json(
+            "/buckets/b/groups/g", {"data": {"members": ["c@d.com"]}}, headers=self.headers
+        )
+        assert self.recipients_of_next_change() == ["c@d.com"]
+
+    def test_group_deletion_is_visible_immediately(self):
+        assert self.recipients_of_next_change() == ["a@b.com"]
+        self.app.delete("/buckets/b/groups/g", headers=self.headers)
+        self.get_mailer.reset_mock()
+        self.app.put_json("/buckets/b/collections/c", headers=self.headers)
+        assert not self.get_mailer().send_immediately.called
+
 
 class SendNotificationTest(unittest.TestCase):
     def test_send_notification_does_not_call_the_mailer_if_no_message(self):
         event = mock.MagicMock()
+        event.request.bound_data = {}
         event.payload = {
             "resource_name": "record",
             "action": "update",
@@ -338,6 +487,7 @@ class SendNotificationTest(unittest.TestCase):
 
     def test_send_notification_calls_the_mailer_if_match_event(self):
         event = mock.MagicMock()
+        event.request.bound_data = {}
         event.impacted_objects = [{"new": {"id": "a"}}]
         event.payload = {
             "resource_name": "record",
@@ -355,6 +505,7 @@ class SendNotificationTest(unittest.TestCase):
 
     def test_send_notification_calls_the_mailer_queue_if_configured(self):
         event = mock.MagicMock()
+        event.request.bound_data = {}
         event.impacted_objects = [{"new": {"id": "a"}}]
         event.payload = {
             "resource_name": "record",
@@ -371,6 +522,134 @@ class SendNotificationTest(unittest.TestCase):
             assert get_mailer().send_to_queue.called
 
 
+class HooksResolutionTest(unittest.TestCase):
+    def setUp(self):
+        resolved_hooks.clear()
+        self.addCleanup(resolved_hooks.clear)
+        self.event = mock.MagicMock()
+        self.event.request.bound_data = {}
+        self.event.impacted_objects = [{"new": {"id": "r%s" % i}} for i in range(500)]
+        self.event.payload = {
+            "resource_name": "record",
+            "action": "update",
+            "bucket_id": "default",
+            "collection_id": "foobar",
+        }
+        self.storage = self.event.request.registry.storage
+
+    def test_hooks_are_looked_up_once_per_event(self):
+        self.storage.get.return_value = COLLECTION_RECORD
+        build_notification(self.event)
+        assert self.storage.get.call_count == 1
+        assert len(self.event.request.bound_data[MESSAGES_KEY]) == 500
+
+    def test_bucket_fallback_is_looked_up_once_per_event(self):
+        bucket_metadata = {
+            "kinto-emailer": {
+                "hooks": [{"template": "Poll changed.", "recipients": ["from@bucket.com"]}]
+            }
+        }
+        self.storage.get.side_effect = [{}, bucket_metadata]
+        build_notification(self.event)
+        assert self.storage.get.call_count == 2
+        assert len(self.event.request.bound_data[MESSAGES_KEY]) == 500
+
+    def test_events_without_hooks_return_early_once_resolved(self):
+        self.storage.get.return_value = {}
+        build_notification(self.event)
+        self.event.request.bound_data = {}
+        build_notification(self.event)
+        assert self.storage.get.call_count == 2
+        # Not even a loader was needed, and no message is pending.
+        assert self.event.request.bound_data == {}
+
+
+class LazyRenderingTest(unittest.TestCase):
+    def setUp(self):
+        resolved_hooks.clear()
+        self.addCleanup(resolved_hooks.clear)
+        self.event = mock.MagicMock()
+        self.event.request.bound_data = {}
+        self.event.impacted_objects = [{"new": {"id": "r%s" % i}} for i in range(3)]
+        self.event.payload = {
+            "resource_name": "record",
+            "action": "update",
+            "bucket_id": "default",
+            "collection_id": "foobar",
+        }
+        self.event.request.registry.settings = {}
+        self.event.request.registry.storage.get.return_value = COLLECTION_RECORD
+        patch = mock.patch.object(Template, "render", autospec=True, return_value="")
+        self.render = patch.start()
+        self.addCleanup(patch.stop)
+
+    def test_messages_are_not_rendered_before_commit(self):
+        build_notification(self.event)
+        assert len(self.event.request.bound_data[MESSAGES_KEY]) == 3
+        assert not self.render.called
+
+    def test_messages_are_rendered_one_at_a_time_while_sent(self):
+        build_notification(self.event)
+        renders = []
+        with mock.patch("kinto_emailer.get_mailer") as get_mailer:
+            get_mailer().send_immediately.side_effect = lambda *a, **kw: renders.append(
+                self.render.call_count
+            )
+            send_notification(self.event)
+        # Subject and body of each message.
+        assert renders == [2, 4, 6]
+
+
+class DigestTest(unittest.TestCase):
+    def setUp(self):
+        resolved_hooks.clear()
+        self.addCleanup(resolved_hooks.clear)
+        self.event = mock.MagicMock()
+        self.event.request.bound_data = {}
+        self.event.impacted_objects = [{"new": {"id": "r%s" % i}} for i in range(5)]
+        self.event.payload = {
+            "resource_name": "record",
+            "action": "update",
+            "bucket_id": "b",
+            "collection_id": "c",
+        }
+        self.event.request.registry.settings = {}
+        self.hook = {
+            "digest": True,
+            "subject": "Records of {collection_id} updated",
+            "template": "- {id}",
+            "recipients": ["me@you.com"],
+        }
+        self.event.request.registry.storage.get.return_value = {
+            "kinto-emailer": {"hooks": [self.hook, {"template": "{id}", "recipients": ["a@b.c"]}]}
+        }
+
+    def sent_messages(self):
+        build_notification(self.event)
+        with mock.patch("kinto_emailer.get_mailer") as get_mailer:
+            send_notification(self.event)
+        return [c[0][0] for c in get_mailer().send_immediately.call_args_list]
+
+    def test_messages_of_digest_hooks_are_merged(self):
+        messages = self.sent_messages()
+        digests = [m for m in messages if m.recipients == ["me@you.com"]]
+        assert len(messages) == 6
+        assert len(digests) == 1
+        assert digests[0].subject == "Records of c updated"
+        assert digests[0].body == "- r0\n- r1\n- r2\n- r3\n- r4"
+
+    def test_messages_with_different_subjects_are_not_merged(self):
+        self.hook["subject"] = "Record {id} updated"
+        messages = self.sent_messages()
+        assert len(messages) == 10
+
+    def test_digests_are_split_according_to_max_items(self):
+        self.event.request.registry.settings = {"emailer.digest.max_items": "2"}
+        messages = self.sent_messages()
+        digests = [m.body for m in messages if m.recipients == ["me@you.com"]]
+        assert digests == ["- r0\n- r1", "- r2\n- r3", "- r4"]
+
+
 class ContextContentTest(unittest.TestCase):
     def test_context_contains_settings(self):
         event = mock.MagicMock()
@@ -413,6 +692,260 @@ class BatchRequestTest(EmailerTest):
         assert call1[0][0].subject == "Created b/1."
         assert call2[0][0].subject == "Created b/2."
 
+    def test_metadata_and_groups_are_read_once_per_batch(self):
+        self.app.put_json(
+            "/buckets/b/groups/g", {"data": {"members": ["a@b.com"]}}, headers=self.headers
+        )
+        hook = {
+            "resource_name": "record",
+            "template": "{id}",
+            "recipients": ["/buckets/b/groups/g"],
+        }
+        for cid in ("c1", "c2", "c3"):
+            self.app.put_json(
+                "/buckets/b/collections/%s" % cid,
+                {"data": {"kinto-emailer": {"hooks": [hook]}}},
+                headers=self.headers,
+            )
+        group_emails.clear()
+        requests = {
+            "defaults": {"method": "POST"},
+            "requests": [
+                {"path": "/buckets/b/collections/%s/records" % cid} for cid in ("c1", "c2", "c3")
+            ],
+        }
+        storage = self.app.app.registry.storage
+        with mock.patch.object(storage, "get", wraps=storage.get) as get:
+            with mock.patch.object(storage, "list_all", wraps=storage.list_all) as list_all:
+                self.app.post_json("/batch", requests, headers=self.headers)
+        assert len(self.get_mailer().send_immediately.call_args_list) == 3
+        reads = [
+            (c[1]["resource_name"], "filters" in c[1])
+            for c in get.call_args_list + list_all.call_args_list
+        ]
+        # Besides Kinto checking that each parent collection exists, collections
+        # metadata are listed at once, and the group is read once.
+        assert reads.count(("collection", False)) == 3
+        assert reads.count(("collection", True)) == 1
+        assert reads.count(("group", False)) == 1
+
+
+class RequestMessagesTest(EmailerTest):
+    def setUp(self):
+        self.headers = dict(self.headers, **get_user_headers("nous"))
+        hooks = [
+            {
+                "resource_name": "record",
+                "digest": True,
+                "subject": "Records changed",
+                "template": "{collection_id}/{id}",
+                "recipients": ["me@you.com"],
+            }
+        ]
+        bucket = {"kinto-emailer": {"hooks": hooks}}
+        self.app.put_json("/buckets/b", {"data": bucket}, headers=self.headers)
+        self.app.put_json("/buckets/b/collections/c1", headers=self.headers)
+        self.app.put_json("/buckets/b/collections/c2", headers=self.headers)
+        patch = mock.patch("kinto_emailer.get_mailer")
+        self.get_mailer = patch.start()
+        self.addCleanup(patch.stop)
+
+    def test_messages_of_every_event_of_a_request_are_sent_at_once(self):
+        requests = {
+            "defaults": {"method": "PUT"},
+            "requests": [
+                {"path": "/buckets/b/collections/c1/records/r1"},
+                {"path": "/buckets/b/collections/c2/records/r2"},
+                {"path": "/buckets/b/collections/c1/records/r3"},
+            ],
+        }
+        with mock.patch("kinto_emailer.single_connection", wraps=single_connection) as session:
+            self.app.post_json("/batch", requests, headers=self.headers)
+        assert session.call_count == 1
+        assert self.get_mailer().send_immediately.call_count == 1
+        # Digests are merged for the whole request.
+        ((message,), _) = self.get_mailer().send_immediately.call_args
+        assert sorted(message.body.splitlines()) == ["c1/r1", "c1/r3", "c2/r2"]
+
+    def test_messages_are_sent_once(self):
+        self.app.put_json("/buckets/b/collections/c1/records/r1", headers=self.headers)
+        request = self.get_mailer.call_args[0][0]
+        send_notification(mock.MagicMock(request=request))
+        assert self.get_mailer().send_immediately.call_count == 1
+
+
+class ResolvedHooksCacheTest(EmailerTest):
+    def setUp(self):
+        self.headers = dict(self.headers, **get_user_headers("nous"))
+        self.hook = {"resource_name": "record", "template": "Bucket", "recipients": ["me@you.com"]}
+        bucket = {"kinto-emailer": {"hooks": [self.hook]}}
+        self.app.put_json("/buckets/b", {"data": bucket}, headers=self.headers)
+        self.app.put_json("/buckets/b/collections/c", headers=self.headers)
+        patch = mock.patch("kinto_emailer.get_mailer")
+        self.get_mailer = patch.start()
+        self.addCleanup(patch.stop)
+
+    def create_record(self):
+        self.app.post_json("/buckets/b/collections/c/records", headers=self.headers)
+        return self.get_mailer().send_immediately.call_args[0][0]
+
+    def test_metadata_is_not_read_again_for_next_records(self):
+        self.create_record()
+        storage = self.app.app.registry.storage
+        with mock.patch.object(storage, "get", wraps=storage.get) as get:
+            with mock.patch.object(storage, "list_all", wraps=storage.list_all) as list_all:
+                assert self.create_record().body == "Bucket"
+        reads = [c[1]["resource_name"] for c in get.call_args_list + list_all.call_args_list]
+        # Only Kinto checks that the parent collection exists.
+        assert reads == ["collection"]
+
+    def test_hooks_are_resolved_again_when_the_collection_changes(self):
+        self.create_record()
+        hook = dict(self.hook, template="Collection")
+        self.app.patch_json(
+            "/buckets/b/collections/c",
+            {"data": {"kinto-emailer": {"hooks": [hook]}}},
+            headers=self.headers,
+        )
+        assert self.create_record().body == "Collection"
+
+    def test_hooks_are_resolved_again_when_the_bucket_changes(self):
+        self.create_record()
+        hook = dict(self.hook, template="New bucket")
+        self.app.patch_json(
+            "/buckets/b", {"data": {"kinto-emailer": {"hooks": [hook]}}}, headers=self.headers
+        )
+        assert self.create_record().body == "New bucket"
+
+    def fail_after_notification(self, requests):
+        # The request fails once the messages are built: its transaction is rolled back.
+        with mock.patch("kinto_emailer._count_messages", side_effect=ValueError):
+            self.app.post_json("/batch", {"requests": requests}, headers=self.headers, status=500)
+
+    def test_hooks_changed_by_a_failed_request_are_not_cached(self):
+        hook = dict(self.hook, template="Collection")
+        self.fail_after_notification(
+            [
+                {
+                    "method": "PATCH",
+                    "path": "/buckets/b/collections/c",
+                    "body": {"data": {"kinto-emailer": {"hooks": [hook]}}},
+                },
+                {"method": "POST", "path": "/buckets/b/collections/c/records"},
+            ]
+        )
+        assert resolved_hooks.get(("b", "c")) is None
+
+    def test_groups_changed_by_a_failed_request_are_not_cached(self):
+        group_emails.clear()
+        self.addCleanup(group_emails.clear)
+        hook = dict(self.hook, recipients=["/buckets/b/groups/g"])
+        self.app.patch_json(
+            "/buckets/b", {"data": {"kinto-emailer": {"hooks": [hook]}}}, headers=self.headers
+        )
+        self.fail_after_notification(
+            [
+                {
+                    "method": "PUT",
+                    "path": "/buckets/b/groups/g",
+                    "body": {"data": {"members": ["me@you.com"]}},
+                },
+                {"method": "POST", "path": "/buckets/b/collections/c/records"},
+            ]
+        )
+        assert group_emails.get("/buckets/b/groups/g") is None
+
+
+class MetricsTest(EmailerTest):
+    def setUp(self):
+        self.headers = dict(self.headers, **get_user_headers("nous"))
+        bucket = {
+            "kinto-emailer": {
+                "hooks": [
+                    {
+                        "resource_name": "record",
+                        "template": "Created {id}.",
+                        "recipients": ["me@you.com"],
+                    }
+                ]
+            }
+        }
+        self.app.put_json("/buckets/b", {"data": bucket}, headers=self.headers)
+        self.app.put_json("/buckets/b/collections/c", headers=self.headers)
+
+        self.metrics = MemoryMetricsService()
+        self.app.app.registry.registerUtility(self.metrics, IMetricsService)
+        patch = mock.patch("kinto_emailer.get_mailer")
+        self.get_mailer = patch.start()
+        self.addCleanup(patch.stop)
+
+    def count(self, status):
+        labels = (("bucket_id", "b"), ("status", status))
+        return self.metrics.counts[("emailer.messages", labels)]
+
+    def create_records(self, count):
+        requests = {
+            "defaults": {"method": "POST", "path": "/buckets/b/collections/c/records"},
+            "requests": [{}] * count,
+        }
+        self.app.post_json("/batch", requests, headers=self.headers)
+
+    def test_messages_are_counted_per_bucket(self):
+        self.create_records(3)
+        assert self.count("built") == 3
+        assert self.count("sent") == 3
+        assert self.count("failed") == 0
+
+    def test_failures_are_counted(self):
+        self.get_mailer().send_immediately.side_effect = ValueError
+        self.create_records(1)
+        assert self.count("sent") == 0
+        assert self.count("failed") == 1
+
+    def test_queued_messages_are_counted(self):
+        settings = self.app.app.registry.settings
+        settings["mail.queue_path"] = "/var/mail"
+        self.addCleanup(settings.pop, "mail.queue_path")
+        self.create_records(2)
+        assert self.count("queued") == 2
+        assert self.count("sent") == 0
+
+    def test_pipeline_steps_are_timed(self):
+        self.create_records(2)
+        timings = self.metrics.timings
+        assert len(timings["emailer.hooks.seconds"]) == 1
+        assert len(timings["emailer.recipients.seconds"]) == 1
+        assert len(timings["emailer.render.seconds"]) == 2
+        assert len(timings["emailer.send.seconds"]) == 2
+
+    def test_rendering_failures_are_counted_and_next_messages_are_sent(self):
+        self.get_mailer().send_immediately.side_effect = None
+        with mock.patch.object(Template, "render", side_effect=[KeyError, "", "", ""]):
+            self.create_records(2)
+        assert self.count("failed") == 1
+        assert self.count("sent") == 1
+
+    def test_queue_failures_are_counted(self):
+        settings = self.app.app.registry.settings
+        settings["mail.queue_path"] = "/var/mail"
+        self.addCleanup(settings.pop, "mail.queue_path")
+        self.get_mailer().send_to_queue.side_effect = [OSError, None]
+        self.create_records(2)
+        assert self.count("failed") == 1
+        assert self.count("queued") == 1
+
+    def test_messages_dropped_by_background_delivery_are_counted(self):
+        hook = CompiledHook({"template": "", "recipients": []})
+        event = mock.MagicMock()
+        event.request.bound_data = {
+            MESSAGES_KEY: [PendingMessage(hook, {"bucket_id": "b"}, ["me@you.com"])]
+        }
+        event.request.registry.metrics = self.metrics
+        event.request.registry.settings = {"emailer.delivery": "background"}
+        event.request.registry.emailer_delivery.enqueue.return_value = False
+        send_notification(event)
+        assert self.count("dropped") == 1
+
 
 class HookValidationTest(FormattedErrorMixin, EmailerTest):
     def setUp(self):
@@ -552,3 +1085,40 @@ class HookValidationTest(FormattedErrorMixin, EmailerTest):
             status=400,
         )
         assert "Invalid recipients /buckets/b/group/g" in r.json["message"]
+
+    def test_fails_if_filter_regexp_is_invalid(self):
+        self.valid_collection["kinto-emailer"]["hooks"][0]["collection_id"] = "^(abc"
+        r = self.app.put_json(
+            "/buckets/b/collections/c",
+            {"data": self.valid_collection},
+            headers=self.headers,
+            status=400,
+        )
+        assert "Invalid filter regexp" in r.json["message"]
+
+    def test_fails_if_html_template_is_invalid(self):
+        self.valid_collection["kinto-emailer"]["hooks"][0]["html_template"] = "<p>{{ id </p>"
+        r = self.app.put_json(
+            "/buckets/b/collections/c",
+            {"data": self.valid_collection},
+            headers=self.headers,
+            status=400,
+        )
+        assert "Invalid HTML template" in r.json["message"]
+
+    def test_fails_if_html_template_is_not_a_string(self):
+        self.valid_collection["kinto-emailer"]["hooks"][0]["html_template"] = 5
+        r = self.app.put_json(
+            "/buckets/b/collections/c",
+            {"data": self.valid_collection},
+            headers=self.headers,
+            status=400,
+        )
+        assert 'Invalid "html_template".' in r.json["message"]
+
+    def test_valid_hooks_are_compiled_when_saved(self):
+        r = self.app.put_json(
+            "/buckets/b/collections/c", {"data": self.valid_collection}, headers=self.headers
+        )
+        key = ("/buckets/b/collections/c", r.json["data"]["last_modified"])
+        assert compiled_hooks.get(key) is not None
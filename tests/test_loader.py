@@ -0,0 +1,71 @@
+import unittest
+
+import mock
+from kinto.core.storage import exceptions as storage_exceptions
+from kinto.core.storage.memory import Storage
+
+from kinto_emailer.loader import StorageLoader
+
+
+class StorageLoaderTest(unittest.TestCase):
+    def setUp(self):
+        storage = Storage()
+        for bucket_id in ("b1", "b2"):
+            storage.create("bucket", "", {"id": bucket_id})
+        storage.create("collection", "/buckets/b1", {"id": "c1", "kinto-emailer": {}})
+        storage.create("collection", "/buckets/b1", {"id": "c2"})
+        storage.create("collection", "/buckets/b2", {"id": "c1"})
+        storage.create("group", "/buckets/b1", {"id": "g1", "members": []})
+        storage.create("group", "/buckets/b1", {"id": "g2", "members": []})
+        self.storage = mock.MagicMock(wraps=storage)
+        self.loader = StorageLoader(self.storage)
+
+    def test_single_objects_are_read_individually(self):
+        assert self.loader.get("bucket", "", "b1")["id"] == "b1"
+        assert self.storage.get.call_count == 1
+        assert not self.storage.list_all.called
+
+    def test_objects_of_the_same_parent_are_read_together(self):
+        self.loader.load("collection", "/buckets/b1", ["c1", "c2", "c1"])
+        self.loader.get("collection", "/buckets/b1", "c1")
+        self.loader.get("collection", "/buckets/b1", "c2")
+        assert self.storage.list_all.call_count == 1
+        assert not self.storage.get.called
+
+    def test_missing_objects_are_remembered(self):
+        self.loader.load("collection", "/buckets/b1", ["c1", "unknown"])
+        for _ in range(2):
+            with self.assertRaises(storage_exceptions.ObjectNotFoundError):
+                self.loader.get("collection", "/buckets/b1", "unknown")
+            with self.assertRaises(storage_exceptions.ObjectNotFoundError):
+                self.loader.get("bucket", "", "unknown")
+        assert self.storage.list_all.call_count == 1
+        assert self.storage.get.call_count == 1
+
+    def test_groups_are_returned_by_uri(self):
+        uris = ["/buckets/b1/groups/g1", "/buckets/b1/groups/g2", "/buckets/b2/groups/g1"]
+        groups = self.loader.get_groups(uris)
+        assert groups["/buckets/b1/groups/g1"]["id"] == "g1"
+        assert groups["/buckets/b1/groups/g2"]["id"] == "g2"
+        assert groups["/buckets/b2/groups/g1"] is None
+        assert self.storage.list_all.call_count == 1
+        assert self.storage.get.call_count == 1
+
+    def test_metadata_of_records_events_is_prefetched(self):
+        self.loader.prefetch_metadata(
+            [
+                {"resource_name": "record", "bucket_id": "b1", "collection_id": "c1"},
+                {"resource_name": "record", "bucket_id": "b1", "collection_id": "c2"},
+                {"resource_name": "record", "bucket_id": "b2", "collection_id": "c1"},
+                {"resource_name": "collection", "bucket_id": "b3"},
+            ]
+        )
+        # One read for the collections of each bucket, one for the buckets.
+        assert self.storage.list_all.call_count == 2
+        assert self.storage.get.call_count == 1
+        # Buckets are only needed for collections without hooks.
+        assert self.storage.list_all.call_args[1]["filters"][0].value == ["b1", "b2"]
+        self.storage.reset_mock()
+        self.loader.get("collection", "/buckets/b2", "c1")
+        self.loader.get("bucket", "", "b2")
+        assert not self.storage.get.called
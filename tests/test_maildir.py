@@ -0,0 +1,194 @@
+import os
+import tempfile
+import time
+import unittest
+
+import mock
+import transaction
+from pyramid_mailer.mailer import Mailer
+from pyramid_mailer.message import Message
+
+from kinto_emailer import command_queue
+from kinto_emailer.maildir import QueueProcessor, read_message
+
+from .support import FakeSMTPServer
+
+
+def queue_messages(path, count):
+    """Queue messages like ``send_notification`` does with ``mail.queue_path``."""
+    mailer = Mailer(queue_path=path, transaction_manager=transaction.TransactionManager())
+    for i in range(count):
+        message = Message(
+            subject="Hello %s" % i,
+            sender="kinto@restmail.net",
+            recipients=["me@you.com", "them@you.com"],
+            body="Hi",
+        )
+        mailer.send_to_queue(message)
+    mailer.transaction_manager.commit()
+
+
+def listdir(path, subdir):
+    return sorted(os.listdir(os.path.join(path, subdir)))
+
+
+class QueueProcessorTest(unittest.TestCase):
+    def setUp(self):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.path = os.path.join(tmpdir.name, "queue")
+        queue_messages(self.path, 3)
+        self.smtp_mailer = mock.MagicMock()
+        self.processor = QueueProcessor(self.path, self.smtp_mailer, workers=2)
+
+    def test_envelope_is_read_from_headers(self):
+        (filename, *_) = self.processor
+        fromaddr, toaddrs, mime = read_message(filename)
+        assert fromaddr == "kinto@restmail.net"
+        assert sorted(toaddrs) == ["me@you.com", "them@you.com"]
+        assert "X-Actually-To" not in mime
+
+    def test_queued_messages_are_sent_and_removed(self):
+        with FakeSMTPServer() as server:
+            mailer = Mailer(host="127.0.0.1", port=server.port)
+            processor = QueueProcessor(self.path, mailer.smtp_mailer, workers=2)
+            assert processor.process() == (3, 0)
+        assert len(server.messages) == 3
+        assert list(processor) == []
+        assert listdir(self.path, "cur") == []
+
+    def test_messages_can_only_be_claimed_once(self):
+        (filename, *_) = self.processor
+        other = QueueProcessor(self.path, self.smtp_mailer)
+        assert self.processor.claim(filename) is not None
+        assert other.claim(filename) is None
+        assert other.send(filename) is None
+        assert len(list(other)) == 2
+
+    def test_messages_claimed_while_listed_are_skipped(self):
+        with mock.patch("kinto_emailer.maildir.os.stat", side_effect=FileNotFoundError):
+            assert list(self.processor) == []
+
+    def test_transient_failures_are_queued_again_after_a_delay(self):
+        self.smtp_mailer.send.side_effect = ConnectionRefusedError
+        assert self.processor.process() == (0, 3)
+        assert list(self.processor) == []
+        assert all(name.endswith(";attempts=1") for name in listdir(self.path, "new"))
+        # Between 30 and 60 seconds by default.
+        with mock.patch("kinto_emailer.maildir.time.time", return_value=time.time() + 30):
+            assert list(self.processor) == []
+        with mock.patch("kinto_emailer.maildir.time.time", return_value=time.time() + 60):
+            assert len(list(self.processor)) == 3
+
+    def test_delays_grow_with_the_number_of_attempts(self):
+        self.smtp_mailer.send.side_effect = ConnectionRefusedError
+        processor = QueueProcessor(self.path, self.smtp_mailer, workers=1)
+        with mock.patch.object(processor.backoff, "delay", return_value=0) as delay:
+            for _ in range(3):
+                processor.process()
+        assert [args for args, _ in delay.call_args_list] == [(1,)] * 3 + [(2,)] * 3 + [(3,)] * 3
+        assert all(name.endswith(";attempts=3") for name in listdir(self.path, "new"))
+
+    def test_messages_are_rejected_after_max_attempts(self):
+        self.smtp_mailer.send.side_effect = ConnectionRefusedError
+        processor = QueueProcessor(self.path, self.smtp_mailer, max_attempts=2, backoff=0)
+        assert processor.process() == (0, 3)
+        assert processor.process() == (0, 3)
+        assert list(processor) == []
+        rejected = listdir(self.path, "cur")
+        assert len(rejected) == 3
+        assert all(name.startswith(".rejected-") for name in rejected)
+
+    def test_permanent_failures_are_rejected(self):
+        self.smtp_mailer.send.side_effect = [None, ValueError, None]
+        processor = QueueProcessor(self.path, self.smtp_mailer, workers=1)
+        assert processor.process() == (2, 1)
+        assert list(processor) == []
+        (rejected,) = listdir(self.path, "cur")
+        assert rejected.startswith(".rejected-")
+
+    def test_stale_claims_are_queued_again(self):
+        (first, second, third) = self.processor
+        claimed = self.processor.claim(first)
+        self.processor.claim(second)
+        self.smtp_mailer.send.side_effect = ValueError
+        self.processor.send(third)
+        old = time.time() - 3600
+        os.utime(claimed, (old, old))
+        assert self.processor.release_stale_claims() == 1
+        assert len(list(self.processor)) == 1
+
+    def test_claims_sent_meanwhile_are_not_released(self):
+        (filename, *_) = self.processor
+        self.processor.claim(filename)
+        with mock.patch("kinto_emailer.maildir.os.stat", side_effect=FileNotFoundError):
+            assert self.processor.release_stale_claims() == 0
+
+
+class QueueCommandTest(unittest.TestCase):
+    def setUp(self):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.path = os.path.join(tmpdir.name, "queue")
+        queue_messages(self.path, 2)
+
+        self.server = FakeSMTPServer()
+        self.server.__enter__()
+        self.addCleanup(self.server.__exit__)
+
+        registry = mock.MagicMock()
+        registry.settings = self.settings = {
+            "mail.host": "127.0.0.1",
+            "mail.port": str(self.server.port),
+            "mail.queue_path": self.path,
+        }
+        patch = mock.patch(
+            "kinto_emailer.command_queue.bootstrap", return_value={"registry": registry}
+        )
+        patch.start()
+        self.addCleanup(patch.stop)
+
+    def test_returns_non_zero_if_not_enough_args(self):
+        assert command_queue.main([]) > 0
+
+    def test_uses_sys_args_by_default(self):
+        with mock.patch("kinto_emailer.command_queue.sys.argv", ["queue", "config.ini", "--once"]):
+            assert command_queue.main() == 0
+
+    def test_returns_non_zero_if_no_queue_is_configured(self):
+        self.settings.pop("mail.queue_path")
+        assert command_queue.main(["config.ini"]) > 0
+
+    def test_sends_the_queue_once(self):
+        assert command_queue.main(["config.ini", "--once", "--workers", "2"]) == 0
+        assert len(self.server.messages) == 2
+        # Connections are reused.
+        assert self.server.connections <= 2
+
+    def test_connections_are_pooled_if_pool_size_is_zero(self):
+        self.settings["mail.pool_size"] = "0"
+        assert command_queue.main(["config.ini", "--once", "--workers", "1"]) == 0
+        assert len(self.server.messages) == 2
+        assert self.server.connections == 1
+
+    def test_retries_can_be_configured_from_settings(self):
+        self.settings.update({"emailer.queue.max_attempts": "3", "emailer.queue.backoff": "5"})
+        with mock.patch("kinto_emailer.command_queue.QueueProcessor") as processor:
+            processor().process.return_value = (0, 0)
+            assert command_queue.main(["config.ini", "--once"]) == 0
+        _, kwargs = processor.call_args
+        assert (kwargs["max_attempts"], kwargs["backoff"], kwargs["max_backoff"]) == (3, 5, 3600)
+
+    def test_watches_the_queue_until_interrupted(self):
+        def sleep(interval):
+            if sleep.calls == 0:
+                queue_messages(self.path, 1)
+            sleep.calls += 1
+            if sleep.calls == 3:
+                raise KeyboardInterrupt
+
+        sleep.calls = 0
+        with mock.patch("kinto_emailer.command_queue.time.sleep", side_effect=sleep) as mocked:
+            assert command_queue.main(["config.ini", "--watch", "--interval", "5"]) == 0
+        mocked.assert_called_with(5)
+        assert len(self.server.messages) == 3
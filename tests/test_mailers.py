@@ -0,0 +1,391 @@
+import smtplib
+import unittest
+
+import mock
+from pyramid_mailer import get_mailer
+from pyramid_mailer.mailer import Mailer
+from pyramid_mailer.message import Message
+from repoze.sendmail.mailer import (
+    EHLO_Error,
+    ESMTP_NotSupported,
+    NotAnEmailMessage,
+    SMTPMailer,
+    TLS_NotAvailable,
+)
+
+from kinto_emailer.mailers import (
+    PooledSMTPMailer,
+    Relay,
+    RelaySMTPMailer,
+    mailer_from_settings,
+    parse_relay,
+    single_connection,
+)
+
+from .support import FakeSMTPServer
+from .test_includeme import EmailerTest
+
+
+def make_message(i=0):
+    return Message(
+        subject="Hello %s" % i, sender="kinto@restmail.net", recipients=["me@you.com"], body="Hi"
+    )
+
+
+class PooledSMTPMailerTest(unittest.TestCase):
+    def make_mailer(self, server, **kwargs):
+        smtp_mailer = SMTPMailer(hostname="127.0.0.1", port=server.port, no_tls=True)
+        return Mailer(smtp_mailer=PooledSMTPMailer(smtp_mailer, **kwargs))
+
+    def test_connection_is_reused_across_messages(self):
+        with FakeSMTPServer() as server:
+            mailer = self.make_mailer(server)
+            for i in range(5):
+                mailer.send_immediately(make_message(i))
+            mailer.smtp_mailer.close()
+        assert len(server.messages) == 5
+        assert server.connections == 1
+        assert server.commands.count("EHLO") == 1
+
+    def test_connection_is_recycled_after_max_messages(self):
+        with FakeSMTPServer() as server:
+            mailer = self.make_mailer(server, max_messages=2)
+            for i in range(5):
+                mailer.send_immediately(make_message(i))
+            mailer.smtp_mailer.close()
+        assert len(server.messages) == 5
+        assert server.connections == 3
+
+    def test_idle_connection_is_checked_with_noop(self):
+        with FakeSMTPServer() as server:
+            mailer = self.make_mailer(server, noop_interval=-1)
+            mailer.send_immediately(make_message(1))
+            mailer.send_immediately(make_message(2))
+            mailer.smtp_mailer.close()
+        assert server.commands.count("NOOP") == 1
+        assert server.connections == 1
+
+    def test_connection_idle_for_too_long_is_replaced(self):
+        with FakeSMTPServer() as server:
+            mailer = self.make_mailer(server, idle_timeout=-1)
+            mailer.send_immediately(make_message(1))
+            mailer.send_immediately(make_message(2))
+        assert server.connections == 2
+
+    def test_no_connection_is_kept_if_pool_is_full(self):
+        with FakeSMTPServer() as server:
+            mailer = self.make_mailer(server, pool_size=0)
+            mailer.send_immediately(make_message(1))
+            mailer.send_immediately(make_message(2))
+        assert server.connections == 2
+        assert mailer.smtp_mailer._idle == []
+
+    def test_rejects_non_email_messages(self):
+        with self.assertRaises(NotAnEmailMessage):
+            PooledSMTPMailer(mock.MagicMock()).send("a@b.com", ["c@d.com"], "Hi")
+
+
+class PooledConnectionTest(unittest.TestCase):
+    def setUp(self):
+        self.options = mock.MagicMock(
+            username=None, password=None, force_tls=False, no_tls=True, spec=SMTPMailer
+        )
+        self.smtp = self.options.smtp_factory.return_value
+        self.smtp.ehlo.return_value = (250, "OK")
+        self.smtp.noop.return_value = (250, "OK")
+        self.smtp.has_extn.return_value = False
+        self.smtp.does_esmtp = True
+        self.mailer = PooledSMTPMailer(self.options, noop_interval=-1)
+        self.message = make_message().to_message()
+
+    def send(self):
+        self.mailer.send("kinto@restmail.net", ["me@you.com"], self.message)
+
+    def test_falls_back_to_helo(self):
+        self.smtp.ehlo.return_value = (500, "No")
+        self.smtp.helo.return_value = (250, "OK")
+        self.send()
+        assert self.smtp.helo.called
+
+    def test_fails_if_helo_is_rejected(self):
+        self.smtp.ehlo.return_value = (500, "No")
+        self.smtp.helo.return_value = (500, "No")
+        with self.assertRaises(EHLO_Error):
+            self.send()
+
+    def test_fails_if_tls_is_required_but_not_available(self):
+        self.options.force_tls = True
+        with self.assertRaises(TLS_NotAvailable):
+            self.send()
+
+    def test_starts_tls_if_available(self):
+        self.options.no_tls = False
+        self.smtp.has_extn.return_value = True
+        self.send()
+        assert self.smtp.starttls.called
+
+    def test_logs_in_once_per_connection(self):
+        self.options.username = "user"
+        self.options.password = "pass"
+        self.send()
+        self.send()
+        self.smtp.login.assert_called_once_with("user", "pass")
+
+    def test_fails_if_username_without_esmtp(self):
+        self.options.username = "user"
+        self.smtp.does_esmtp = False
+        with self.assertRaises(ESMTP_NotSupported):
+            self.send()
+
+    def test_unhealthy_connection_is_replaced(self):
+        self.send()
+        self.smtp.noop.side_effect = smtplib.SMTPServerDisconnected
+        self.send()
+        assert self.options.smtp_factory.call_count == 2
+
+    def test_connection_answering_noop_with_error_is_replaced(self):
+        self.send()
+        self.smtp.noop.return_value = (421, "Closing")
+        self.send()
+        assert self.options.smtp_factory.call_count == 2
+
+    def test_reused_connection_dropped_by_server_is_retried_once(self):
+        self.send()
+        self.smtp.sendmail.side_effect = [smtplib.SMTPServerDisconnected, None]
+        self.send()
+        assert self.smtp.sendmail.call_count == 3
+        assert self.options.smtp_factory.call_count == 2
+
+    def test_retry_failure_is_raised(self):
+        self.send()
+        self.smtp.sendmail.side_effect = smtplib.SMTPServerDisconnected
+        with self.assertRaises(smtplib.SMTPServerDisconnected):
+            self.send()
+        assert self.mailer._idle == []
+
+    def test_new_connection_dropped_by_server_is_not_retried(self):
+        self.smtp.sendmail.side_effect = smtplib.SMTPServerDisconnected
+        with self.assertRaises(smtplib.SMTPServerDisconnected):
+            self.send()
+        assert self.smtp.sendmail.call_count == 1
+
+    def test_connection_is_discarded_on_errors(self):
+        self.smtp.sendmail.side_effect = smtplib.SMTPRecipientsRefused({})
+        with self.assertRaises(smtplib.SMTPRecipientsRefused):
+            self.send()
+        assert self.mailer._idle == []
+        assert self.smtp.quit.called
+
+    def test_connection_is_closed_if_quit_fails(self):
+        self.send()
+        self.smtp.quit.side_effect = smtplib.SMTPServerDisconnected
+        self.mailer.close()
+        assert self.smtp.close.called
+
+
+class MailerFromSettingsTest(unittest.TestCase):
+    def test_connections_are_not_pooled_by_default(self):
+        mailer = mailer_from_settings({"mail.host": "localhost"})
+        assert not isinstance(mailer.smtp_mailer, PooledSMTPMailer)
+
+    def test_pool_is_configured_from_settings(self):
+        mailer = mailer_from_settings(
+            {
+                "mail.host": "smtp.example.com",
+                "mail.queue_path": "/tmp/queue",
+                "mail.default_sender": "kinto@restmail.net",
+                "mail.pool_size": "4",
+                "mail.pool_max_messages": "10",
+                "mail.pool_idle_timeout": "30",
+                "mail.pool_noop_interval": "2",
+            }
+        )
+        pool = mailer.smtp_mailer
+        assert pool.smtp_mailer.hostname == "smtp.example.com"
+        assert (pool.pool_size, pool.max_messages) == (4, 10)
+        assert (pool.idle_timeout, pool.noop_interval) == (30, 2)
+        assert mailer.queue_path == "/tmp/queue"
+        assert mailer.default_sender == "kinto@restmail.net"
+
+    def test_relays_are_configured_from_settings(self):
+        mailer = mailer_from_settings(
+            {
+                "mail.port": "2525",
+                "mail.username": "kinto",
+                "mail.relays": "smtp1.example.com=3\nsmtp2.example.com:587",
+                "mail.relays_strategy": "domain",
+                "mail.relays_max_failures": "5",
+                "mail.relays_retry_after": "10",
+            }
+        )
+        relays = mailer.smtp_mailer
+        assert relays.strategy == "domain"
+        assert (relays.max_failures, relays.retry_after) == (5, 10)
+        assert [(r.name, r.weight) for r in relays.relays] == [
+            ("smtp1.example.com:2525", 3),
+            ("smtp2.example.com:587", 1),
+        ]
+        assert relays.relays[1].mailer.username == "kinto"
+
+    def test_relays_connections_can_be_pooled(self):
+        mailer = mailer_from_settings({"mail.relays": "smtp1 smtp2", "mail.pool_size": "2"})
+        pools = [relay.mailer for relay in mailer.smtp_mailer.relays]
+        assert [pool.smtp_mailer.hostname for pool in pools] == ["smtp1", "smtp2"]
+        assert all(isinstance(pool, PooledSMTPMailer) for pool in pools)
+
+
+class RelaySMTPMailerTest(unittest.TestCase):
+    def make_mailer(self, *weights, **kwargs):
+        relays = [
+            Relay("relay%s" % i, mock.MagicMock(spec=["send"]), weight)
+            for i, weight in enumerate(weights)
+        ]
+        return RelaySMTPMailer(relays, **kwargs)
+
+    def sent_by(self, mailer):
+        return [relay.mailer.send.call_count for relay in mailer.relays]
+
+    def test_messages_are_spread_by_weighted_round_robin(self):
+        mailer = self.make_mailer(3, 1)
+        order = []
+        for _ in range(8):
+            mailer.send("a@b.com", ["c@d.com"], "message")
+            order.append(self.sent_by(mailer).copy())
+        assert self.sent_by(mailer) == [6, 2]
+        # Smooth: the light relay is not starved until the end of the cycle.
+        assert order[3] == [3, 1]
+
+    def test_messages_are_spread_by_recipient_domain(self):
+        mailer = self.make_mailer(3, 1, strategy="domain")
+        for _ in range(3):
+            mailer.send("a@b.com", ["me@example.com", "you@other.com"], "message")
+        assert sorted(self.sent_by(mailer)) == [0, 3]
+        for i in range(1000):
+            mailer.send("a@b.com", ["me@domain%s.com" % i], "message")
+        heavy, _ = self.sent_by(mailer)
+        assert 700 < heavy < 800
+
+    def test_messages_fail_over_to_next_relay_on_transient_errors(self):
+        mailer = self.make_mailer(1, 1)
+        mailer.relays[0].mailer.send.side_effect = smtplib.SMTPServerDisconnected()
+        for _ in range(4):
+            mailer.send("a@b.com", ["c@d.com"], "message")
+        assert mailer.relays[1].mailer.send.call_count == 4
+
+    def test_permanent_errors_are_raised_without_fail_over(self):
+        mailer = self.make_mailer(1, 1)
+        mailer.relays[0].mailer.send.side_effect = smtplib.SMTPDataError(550, "No")
+        with self.assertRaises(smtplib.SMTPDataError):
+            mailer.send("a@b.com", ["c@d.com"], "message")
+        assert self.sent_by(mailer) == [1, 0]
+        assert mailer.relays[0].failures == 0
+
+    def test_last_error_is_raised_if_every_relay_fails(self):
+        mailer = self.make_mailer(1, 1)
+        mailer.relays[0].mailer.send.side_effect = OSError("refused")
+        mailer.relays[1].mailer.send.side_effect = smtplib.SMTPServerDisconnected()
+        with self.assertRaises(smtplib.SMTPServerDisconnected):
+            mailer.send("a@b.com", ["c@d.com"], "message")
+
+    @mock.patch("kinto_emailer.mailers.time.monotonic")
+    def test_unhealthy_relays_are_tried_last_until_retry_delay(self, monotonic):
+        monotonic.return_value = 100
+        mailer = self.make_mailer(1, 1, max_failures=2, retry_after=30)
+        down, up = mailer.relays
+        down.mailer.send.side_effect = OSError("refused")
+        with mock.patch("kinto_emailer.mailers.logger") as logger:
+            for _ in range(4):
+                mailer.send("a@b.com", ["c@d.com"], "message")
+        assert down.mailer.send.call_count == 2
+        assert logger.warning.call_args_list[-1] == mock.call(
+            "SMTP relay %s marked as unhealthy.", "relay0"
+        )
+        # Tried again once the delay expired, and healthy once it succeeds.
+        monotonic.return_value = 131
+        down.mailer.send.side_effect = None
+        mailer.send("a@b.com", ["c@d.com"], "message")
+        mailer.send("a@b.com", ["c@d.com"], "message")
+        assert down.mailer.send.call_count == 3
+        assert (down.failures, down.down_until) == (0, 0)
+
+    def test_relays_connections_are_closed(self):
+        mailer = self.make_mailer(1)
+        pooled = mock.MagicMock(spec=["send", "close"])
+        mailer.relays.append(Relay("pooled", pooled))
+        mailer.close()
+        assert pooled.close.called
+
+    def test_strategy_is_validated(self):
+        with self.assertRaises(ValueError):
+            RelaySMTPMailer([], strategy="random")
+
+    def test_relays_are_parsed(self):
+        assert parse_relay("smtp.example.com") == ("smtp.example.com", None, 1)
+        assert parse_relay("smtp.example.com:587=3") == ("smtp.example.com", 587, 3)
+
+    def test_messages_are_sent_through_the_relays_that_are_up(self):
+        with FakeSMTPServer() as down:
+            port = down.port
+        with FakeSMTPServer() as server:
+            mailer = mailer_from_settings(
+                {"mail.relays": "127.0.0.1:%s 127.0.0.1:%s" % (port, server.port)}
+            )
+            for i in range(4):
+                mailer.send_immediately(make_message(i), fail_silently=False)
+        assert len(server.messages) == 4
+
+
+class SingleConnectionTest(unittest.TestCase):
+    def test_messages_are_sent_over_one_connection(self):
+        with FakeSMTPServer() as server:
+            mailer = Mailer(host="127.0.0.1", port=server.port)
+            with single_connection(mailer) as session:
+                for i in range(3):
+                    session.send_immediately(make_message(i), fail_silently=False)
+        assert len(server.messages) == 3
+        assert server.connections == 1
+
+    def test_pooled_and_other_mailers_are_used_as_is(self):
+        pooled = mailer_from_settings({"mail.pool_size": "1"})
+        for mailer in (pooled, mock.MagicMock()):
+            with single_connection(mailer) as session:
+                assert session is mailer
+
+
+class PooledMailerSetupTest(EmailerTest):
+    @classmethod
+    def get_app_settings(cls, extras=None):
+        settings = super().get_app_settings(extras)
+        settings["mail.debug_mailer"] = "false"
+        settings["mail.pool_size"] = "2"
+        return settings
+
+    def test_pooled_mailer_is_registered(self):
+        mailer = get_mailer(self.app.app.registry)
+        assert isinstance(mailer.smtp_mailer, PooledSMTPMailer)
+
+
+class UnpooledMailerSetupTest(EmailerTest):
+    @classmethod
+    def get_app_settings(cls, extras=None):
+        settings = super().get_app_settings(extras)
+        settings["mail.debug_mailer"] = "false"
+        settings["mail.pool_size"] = "0"
+        return settings
+
+    def test_connections_are_not_pooled_if_pool_size_is_zero(self):
+        mailer = get_mailer(self.app.app.registry)
+        assert not isinstance(mailer.smtp_mailer, PooledSMTPMailer)
+
+
+class RelayMailerSetupTest(EmailerTest):
+    @classmethod
+    def get_app_settings(cls, extras=None):
+        settings = super().get_app_settings(extras)
+        settings["mail.debug_mailer"] = "false"
+        settings["mail.relays"] = "smtp1.example.com smtp2.example.com"
+        return settings
+
+    def test_relay_mailer_is_registered(self):
+        mailer = get_mailer(self.app.app.registry)
+        assert isinstance(mailer.smtp_mailer, RelaySMTPMailer)
@@ -0,0 +1,417 @@
+import os
+import queue
+import smtplib
+import tempfile
+import threading
+import time
+import unittest
+
+import mock
+from kinto.core.metrics import IMetricsService
+from kinto.core.storage.exceptions import BackendError
+from kinto.core.storage.memory import Storage
+from kinto.core.testing import get_user_headers
+from pyramid_mailer.mailer import DummyMailer
+from pyramid_mailer.message import Message
+
+from kinto_emailer import command_outbox, resolved_hooks
+from kinto_emailer.outbox import LEASE_RESOURCE_NAME, RESOURCE_NAME, Outbox
+from kinto_emailer.ratelimit import RateLimiter
+from kinto_emailer.retry import RetryPolicy
+
+from .support import MemoryMetricsService
+from .test_includeme import EmailerTest
+
+
+def make_message(subject="Hello", body="Hi", html=None):
+    return Message(
+        subject=subject,
+        sender="kinto@restmail.net",
+        recipients=["me@you.com"],
+        body=body,
+        html=html,
+    )
+
+
+def stored(outbox):
+    """Return the messages stored in every shard of the ``outbox``."""
+    return [
+        fields
+        for parent_id in outbox.parent_ids
+        for row in outbox.pending(parent_id, limit=1000)
+        for fields in row["messages"]
+    ]
+
+
+class OutboxTest(unittest.TestCase):
+    def setUp(self):
+        self.outbox = Outbox(Storage(), shards=1)
+        self.mailer = DummyMailer()
+
+    def test_messages_are_kept_until_dispatched(self):
+        assert self.outbox.add([make_message(), make_message(html="<p>Hi</p>")]) == 2
+        assert len(stored(self.outbox)) == 2
+        assert self.outbox.dispatch(self.mailer) == (2, 0)
+        assert len(self.outbox) == 0
+        first, second = self.mailer.outbox
+        assert (first.subject, first.recipients, first.body) == ("Hello", ["me@you.com"], "Hi")
+        assert second.html == "<p>Hi</p>"
+
+    def test_messages_of_a_request_are_stored_in_a_single_row(self):
+        with mock.patch.object(self.outbox.storage, "create") as create:
+            assert self.outbox.add(make_message(subject=str(i)) for i in range(3)) == 3
+            assert self.outbox.add([]) == 0
+        assert create.call_count == 1
+
+    def test_messages_are_stored_across_shards(self):
+        outbox = Outbox(Storage(), shards=4)
+        for i in range(40):
+            outbox.add([make_message(subject=str(i))])
+        counts = [
+            outbox.storage.count_all(resource_name=RESOURCE_NAME, parent_id=parent_id)
+            for parent_id in outbox.parent_ids
+        ]
+        assert sum(counts) == len(outbox) == 40
+        assert all(counts)
+        while outbox.dispatch(self.mailer, limit=7) != (0, 0):
+            pass
+        assert sorted(int(m.subject) for m in self.mailer.outbox) == list(range(40))
+
+    def test_oldest_messages_are_dispatched_first(self):
+        for i in range(5):
+            self.outbox.add([make_message(subject=str(i))])
+        assert self.outbox.dispatch(self.mailer, limit=3) == (3, 0)
+        assert self.outbox.dispatch(self.mailer, limit=3) == (2, 0)
+        assert [m.subject for m in self.mailer.outbox] == ["0", "1", "2", "3", "4"]
+
+    def test_each_lease_is_committed_once_created(self):
+        self.outbox.add([make_message()])
+        self.outbox.add([make_message()])
+        calls = mock.MagicMock()
+        calls.send_immediately.side_effect = self.mailer.send_immediately
+        lease = self.outbox._lease
+
+        def leased(*args):
+            calls.lease()
+            return lease(*args)
+
+        with mock.patch.object(self.outbox, "_lease", side_effect=leased):
+            with mock.patch.object(self.outbox, "remove", side_effect=calls.remove):
+                self.outbox.dispatch(calls, commit=calls.commit)
+        names = [name for name, _, _ in calls.mock_calls]
+        # After expired leases are removed, and after each lease.
+        expected = ["commit", "lease", "commit", "lease", "commit"]
+        assert names == expected + ["send_immediately", "send_immediately", "remove"]
+
+    def test_messages_failing_with_transient_errors_are_kept(self):
+        self.outbox.add([make_message(subject="a"), make_message(subject="b")])
+        mailer = mock.MagicMock()
+        disconnected = smtplib.SMTPServerDisconnected()
+        mailer.send_immediately.side_effect = [disconnected, disconnected, None]
+        retry = RetryPolicy(attempts=2, backoff=0)
+        assert self.outbox.dispatch(mailer, retry=retry) == (1, 1)
+        assert mailer.send_immediately.call_count == 3
+        # Only the failed message is kept.
+        assert [fields["subject"] for fields in stored(self.outbox)] == ["a"]
+
+    def test_messages_failing_with_permanent_errors_are_stored_in_dead_letters(self):
+        self.outbox.add([make_message(subject="a"), make_message(subject="b")])
+        mailer = mock.MagicMock()
+        mailer.send_immediately.side_effect = smtplib.SMTPDataError(550, "No")
+        dead_letters = mock.MagicMock()
+        dead_letters.add.side_effect = [None, OSError]
+        assert self.outbox.dispatch(mailer, dead_letters=dead_letters) == (0, 2)
+        assert dead_letters.add.call_count == 2
+        # Kept if it could not be stored in dead letters, and sent again once its lease expired.
+        assert [fields["subject"] for fields in stored(self.outbox)] == ["b"]
+        assert self.outbox.dispatch(mailer) == (0, 0)
+        with mock.patch("kinto_emailer.outbox.time.time", return_value=time.time() + 120):
+            assert self.outbox.dispatch(mailer) == (0, 1)
+        assert len(self.outbox) == 0
+
+    def test_can_be_configured_from_settings(self):
+        settings = {"emailer.outbox.shards": "4", "emailer.outbox.lease_timeout": "30"}
+        outbox = Outbox.from_settings(settings, Storage())
+        assert outbox.parent_ids == ["0", "1", "2", "3"]
+        assert outbox.lease_timeout == 30
+        assert Outbox.from_settings({}, Storage()).shards == 16
+
+
+class OutboxLeaseTest(unittest.TestCase):
+    def setUp(self):
+        self.storage = Storage()
+        self.outbox = Outbox(self.storage, shards=1, lease_timeout=60)
+        for i in range(5):
+            self.outbox.add([make_message(subject=str(i))])
+        self.now = 6000.0
+        patch = mock.patch("kinto_emailer.outbox.time.time", side_effect=lambda: self.now)
+        patch.start()
+        self.addCleanup(patch.stop)
+
+    def subjects(self, claimed):
+        return [fields["subject"] for _, _, row, _ in claimed for fields in row["messages"]]
+
+    def leases(self):
+        return self.storage.count_all(resource_name=LEASE_RESOURCE_NAME, parent_id="0")
+
+    def test_dispatchers_claim_different_messages(self):
+        other = Outbox(self.storage, shards=1, lease_timeout=60)
+        assert self.subjects(self.outbox.claim(2)) == ["0", "1"]
+        assert self.subjects(other.claim(2)) == ["2", "3"]
+        assert self.subjects(self.outbox.claim(2)) == ["4"]
+        assert other.claim(2) == []
+
+    def test_rows_are_claimed_whole(self):
+        self.outbox.add([make_message(subject=str(i)) for i in range(5, 8)])
+        assert self.subjects(self.outbox.claim(6)) == [str(i) for i in range(8)]
+
+    def test_leases_last_until_the_end_of_the_next_period(self):
+        assert len(self.outbox.claim(5)) == 5
+        self.now += 60
+        assert self.outbox.claim(5) == []
+        self.now += 60
+        assert len(self.outbox.claim(5)) == 5
+
+    def test_leases_are_released_with_their_messages(self):
+        claimed = self.outbox.claim(2)
+        self.outbox.remove(
+            "0", [row["id"] for _, _, row, _ in claimed], [lease for _, lease, _, _ in claimed]
+        )
+        assert len(self.outbox) == 3
+        assert self.leases() == 0
+
+    def test_leases_end_after_the_next_period(self):
+        assert {ends for _, _, _, ends in self.outbox.claim(5)} == {6120}
+
+    def test_messages_are_not_sent_when_their_lease_is_about_to_end(self):
+        outbox = Outbox(Storage(), shards=1, lease_timeout=60, lease_margin=30)
+        outbox.add([make_message(subject=str(i)) for i in range(5)])
+        mailer = DummyMailer()
+
+        def send_immediately(message, fail_silently=False):
+            self.now += 30
+            mailer.outbox.append(message)
+
+        with mock.patch.object(mailer, "send_immediately", side_effect=send_immediately):
+            # Sent at 6000, 6030 and 6060, the lease ends at 6120.
+            assert outbox.dispatch(mailer) == (3, 0)
+            assert [fields["subject"] for fields in stored(outbox)] == ["3", "4"]
+            assert outbox.dispatch(mailer) == (0, 0)
+            self.now = 6120
+            assert outbox.dispatch(mailer) == (2, 0)
+        assert [m.subject for m in mailer.outbox] == ["0", "1", "2", "3", "4"]
+
+    def test_retries_do_not_outlive_the_lease(self):
+        outbox = Outbox(Storage(), shards=1, lease_timeout=60, lease_margin=30)
+        outbox.add([make_message()])
+        retry = RetryPolicy(attempts=3)
+        deadlines = []
+
+        def run(policy, func, *args, **kwargs):
+            deadlines.append(policy.deadline)
+
+        with mock.patch.object(RetryPolicy, "run", autospec=True, side_effect=run):
+            with mock.patch("kinto_emailer.outbox.time.monotonic", return_value=100):
+                outbox.dispatch(DummyMailer(), retry=retry)
+        # The lease ends at 6120, 90 seconds before its last 30 seconds.
+        assert deadlines == [190]
+        assert retry.deadline is None
+
+    def test_expired_leases_are_forgotten(self):
+        self.outbox.claim(5)
+        self.outbox.remove("0", [row["id"] for row in self.outbox.pending("0")])
+        self.now += 121
+        self.outbox.claim(5)
+        assert self.leases() == 0
+
+    def test_concurrent_dispatchers_send_every_message_once(self):
+        self.outbox.add([make_message(subject=str(i)) for i in range(5, 10)])
+        for i in range(10, 200):
+            self.outbox.add([make_message(subject=str(i))])
+        mailer = DummyMailer()
+        dispatchers = [Outbox(self.storage, shards=1) for _ in range(4)]
+
+        def work(outbox):
+            while outbox.dispatch(mailer, limit=7) != (0, 0):
+                pass
+
+        threads = [threading.Thread(target=work, args=(outbox,)) for outbox in dispatchers]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert sorted(int(m.subject) for m in mailer.outbox) == list(range(200))
+        assert len(self.outbox) == 0
+
+
+class CommandTestCase(unittest.TestCase):
+    def setUp(self):
+        registry = mock.MagicMock()
+        registry.settings = {}
+        registry.storage = Storage()
+        self.outbox = Outbox(registry.storage)
+        for i in range(3):
+            self.outbox.add([make_message(subject=str(i))])
+        patch = mock.patch(
+            "kinto_emailer.command_outbox.bootstrap", return_value={"registry": registry}
+        )
+        patch.start()
+        self.addCleanup(patch.stop)
+        self.mailer = DummyMailer()
+        patch = mock.patch("kinto_emailer.command_outbox.get_mailer", return_value=self.mailer)
+        patch.start()
+        self.addCleanup(patch.stop)
+
+
+class OutboxCommandTest(CommandTestCase):
+    def test_uses_sys_args_by_default(self):
+        assert command_outbox.main() > 0  # will fail
+
+    def test_returns_non_zero_if_not_enough_args(self):
+        assert command_outbox.main([]) > 0
+
+    def test_sends_the_outbox_in_batches_once(self):
+        with mock.patch("kinto_emailer.command_outbox.transaction") as transaction:
+            assert command_outbox.main(["config.ini", "--once", "--batch-size", "2"]) == 0
+        assert len(self.mailer.outbox) == 3
+        assert transaction.commit.called
+        assert not transaction.abort.called
+        assert len(self.outbox) == 0
+
+    def test_storage_errors_are_logged_and_the_batch_is_claimed_again(self):
+        dispatch = mock.patch.object(
+            Outbox, "dispatch", side_effect=[BackendError(message="deadlock"), (0, 0)]
+        )
+        with dispatch, mock.patch("kinto_emailer.command_outbox.transaction") as transaction:
+            with mock.patch("kinto_emailer.command_outbox.time.sleep") as sleep:
+                with mock.patch("kinto_emailer.command_outbox.logger") as logger:
+                    assert command_outbox.main(["config.ini", "--once"]) == 0
+        assert transaction.abort.call_count == 1
+        assert sleep.call_count == 1
+        assert logger.exception.called
+
+    def test_checks_the_outbox_periodically_until_interrupted(self):
+        with mock.patch(
+            "kinto_emailer.command_outbox.time.sleep", side_effect=[None, KeyboardInterrupt]
+        ) as sleep:
+            assert command_outbox.main(["config.ini", "--interval", "5"]) == 0
+        sleep.assert_called_with(5)
+        assert sleep.call_count == 2
+        assert len(self.mailer.outbox) == 3
+
+
+class ThreadsContext:
+    """Run the worker processes as threads, sharing the same memory storage."""
+
+    Process = threading.Thread
+    Queue = queue.Queue
+
+
+class OutboxWorkersCommandTest(CommandTestCase):
+    def setUp(self):
+        super().setUp()
+        patch = mock.patch(
+            "kinto_emailer.command_outbox.multiprocessing.get_context",
+            return_value=ThreadsContext,
+        )
+        self.get_context = patch.start()
+        self.addCleanup(patch.stop)
+
+    def test_worker_processes_send_the_outbox_once(self):
+        for i in range(3, 50):
+            self.outbox.add([make_message(subject=str(i))])
+        with mock.patch("builtins.print") as output:
+            args = ["config.ini", "--once", "--processes", "3", "--batch-size", "4"]
+            assert command_outbox.main(args) == 0
+        self.get_context.assert_called_with("spawn")
+        assert sorted(int(m.subject) for m in self.mailer.outbox) == list(range(50))
+        assert mock.call("0 requests with emails left in the outbox.") in output.call_args_list
+        ((report,), _) = output.call_args_list[-3]
+        assert report.endswith("Backlog: 0 requests.")
+
+    def test_throughput_and_backlog_are_reported_periodically(self):
+        def send_immediately(message, fail_silently=False):
+            time.sleep(0.05)
+            self.mailer.outbox.append(message)
+
+        with mock.patch.object(self.mailer, "send_immediately", side_effect=send_immediately):
+            with mock.patch("builtins.print") as output:
+                args = ["config.ini", "--once", "--processes", "2", "--stats-interval", "0.01"]
+                assert command_outbox.main(args) == 0
+        reports = [args[0] for args, _ in output.call_args_list if "Backlog" in args[0]]
+        assert len(reports) > 1
+        assert len(self.mailer.outbox) == 3
+
+    def test_worker_processes_stop_when_interrupted(self):
+        with mock.patch("kinto_emailer.command_outbox.time.sleep", side_effect=KeyboardInterrupt):
+            assert command_outbox.main(["config.ini", "--processes", "2"]) == 0
+        assert len(self.mailer.outbox) == 3
+
+
+class OutboxSetupTest(EmailerTest):
+    @classmethod
+    def get_app_settings(cls, extras=None):
+        settings = super().get_app_settings(extras)
+        settings["emailer.delivery"] = "outbox"
+        return settings
+
+    def setUp(self):
+        resolved_hooks.clear()
+        self.headers = dict(self.headers, **get_user_headers("nous"))
+        self.metrics = MemoryMetricsService()
+        self.app.app.registry.registerUtility(self.metrics, IMetricsService)
+        self.outbox = self.app.app.registry.emailer_outbox
+        for parent_id in self.outbox.parent_ids:
+            self.outbox.remove(parent_id, [row["id"] for row in self.outbox.pending(parent_id)])
+        bucket = {
+            "kinto-emailer": {
+                "hooks": [
+                    {
+                        "resource_name": "record",
+                        "sender": "kinto@restmail.net",
+                        "template": "Created {id}.",
+                        "recipients": ["me@you.com"],
+                    }
+                ]
+            }
+        }
+        self.app.put_json("/buckets/b", {"data": bucket}, headers=self.headers)
+        self.app.put_json("/buckets/b/collections/c", headers=self.headers)
+
+    def test_messages_are_stored_in_the_outbox_instead_of_sent(self):
+        with mock.patch("kinto_emailer.get_mailer") as get_mailer:
+            self.app.put_json("/buckets/b/collections/c/records/r", headers=self.headers)
+        assert not get_mailer.called
+        (row,) = stored(self.outbox)
+        assert row["body"] == "Created r."
+        assert row["recipients"] == ["me@you.com"]
+        labels = (("bucket_id", "b"), ("status", "queued"))
+        assert self.metrics.counts[("emailer.messages", labels)] == 1
+
+    def test_rate_limits_apply_before_storing_messages(self):
+        registry = self.app.app.registry
+        limiter = RateLimiter({"recipient": (1, 1 / 3600)})
+        with mock.patch.dict(registry.settings, {"emailer.rate_limit.recipient": "1/3600"}):
+            with mock.patch.object(registry, "emailer_rate_limiter", limiter, create=True):
+                self.app.put_json("/buckets/b/collections/c/records/r1", headers=self.headers)
+                self.app.put_json("/buckets/b/collections/c/records/r2", headers=self.headers)
+        assert len(self.outbox) == 1
+        labels = (("bucket_id", "b"), ("status", "rate_limited"))
+        assert self.metrics.counts[("emailer.messages", labels)] == 1
+
+    def test_digest_rate_limit_policy_is_rejected(self):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        settings = {
+            "emailer.rate_limit.recipient": "1/3600",
+            "emailer.rate_limit.policy": "digest",
+            "emailer.spool.path": os.path.join(tmpdir.name, "spool.db"),
+        }
+        with self.assertRaisesRegex(ValueError, "cannot be used with the outbox"):
+            self.make_app(settings)
+
+    def test_request_fails_if_messages_cannot_be_stored(self):
+        with mock.patch.object(Outbox, "add", side_effect=ValueError):
+            self.app.put_json(
+                "/buckets/b/collections/c/records/r", headers=self.headers, status=500
+            )
@@ -0,0 +1,160 @@
+import os
+import tempfile
+import unittest
+
+import mock
+from kinto.core.cache.memory import Cache
+from kinto.core.metrics import IMetricsService
+from kinto.core.testing import get_user_headers
+from pyramid_mailer.mailer import DummyMailer
+
+from kinto_emailer.ratelimit import CacheBackend, MemoryBackend, RateLimiter, parse_limit
+from kinto_emailer.spool import Spool
+
+from .support import MemoryMetricsService
+from .test_includeme import EmailerTest
+
+
+class RateLimiterTest(unittest.TestCase):
+    def setUp(self):
+        self.now = 1000.0
+        patch = mock.patch("kinto_emailer.ratelimit.time.time", side_effect=lambda: self.now)
+        patch.start()
+        self.addCleanup(patch.stop)
+
+    def test_limits_are_parsed_as_count_per_seconds(self):
+        assert parse_limit("10/60") == (10, 10 / 60)
+        assert parse_limit("3") == (3, 3)
+
+    def test_messages_are_allowed_up_to_the_burst(self):
+        limiter = RateLimiter({"global": (2, 1 / 60)})
+        assert limiter.limit("h", ["a@b.com"]) == ["a@b.com"]
+        assert limiter.limit("h", ["a@b.com"]) == ["a@b.com"]
+        assert limiter.limit("h", ["a@b.com"]) == []
+
+    def test_allowance_grows_back_over_time(self):
+        limiter = RateLimiter({"global": (2, 1 / 60)})
+        for _ in range(3):
+            limiter.limit("h", ["a@b.com"])
+        self.now += 59
+        assert limiter.limit("h", ["a@b.com"]) == []
+        self.now += 2
+        assert limiter.limit("h", ["a@b.com"]) == ["a@b.com"]
+        assert limiter.limit("h", ["a@b.com"]) == []
+
+    def test_hooks_are_limited_separately(self):
+        limiter = RateLimiter({"hook": (1, 1 / 60)})
+        assert limiter.limit("h1", ["a@b.com"]) == ["a@b.com"]
+        assert limiter.limit("h1", ["a@b.com"]) == []
+        assert limiter.limit("h2", ["a@b.com"]) == ["a@b.com"]
+
+    def test_recipients_over_the_limit_are_removed(self):
+        limiter = RateLimiter({"recipient": (1, 1 / 60)})
+        assert limiter.limit("h", ["a@b.com"]) == ["a@b.com"]
+        assert limiter.limit("h", ["A@b.com", "c@d.com"]) == ["c@d.com"]
+
+    def test_buckets_can_be_shared_in_a_cache_backend(self):
+        cache = Cache(cache_prefix="", cache_max_size_bytes=10000)
+        first = RateLimiter({"recipient": (1, 1 / 60)}, backend=CacheBackend(cache))
+        second = RateLimiter({"recipient": (1, 1 / 60)}, backend=CacheBackend(cache))
+        assert first.limit("h", ["a@b.com"]) == ["a@b.com"]
+        assert second.limit("h", ["a@b.com"]) == []
+        # Buckets expire once full again.
+        assert 0 < cache.ttl("emailer.rate_limit.recipient:a@b.com") <= 61
+
+    def test_can_be_configured_from_settings(self):
+        cache = mock.sentinel.cache
+        limiter = RateLimiter.from_settings(
+            {
+                "emailer.rate_limit.recipient": "10/3600",
+                "emailer.rate_limit.backend": "cache",
+                "emailer.rate_limit.policy": "digest",
+            },
+            cache=cache,
+        )
+        assert limiter.limits == {"recipient": (10, 10 / 3600)}
+        assert limiter.backend.cache is cache
+        assert limiter.policy == "digest"
+        assert isinstance(RateLimiter.from_settings({}).backend, MemoryBackend)
+
+    def test_invalid_settings_are_rejected(self):
+        with self.assertRaises(ValueError):
+            RateLimiter.from_settings({"emailer.rate_limit.policy": "wait"})
+        with self.assertRaises(ValueError):
+            RateLimiter.from_settings({"emailer.rate_limit.backend": "redis"})
+
+
+class RateLimitSetupTest(EmailerTest):
+    @classmethod
+    def get_app_settings(cls, extras=None):
+        settings = super().get_app_settings(extras)
+        cls.tmpdir = tempfile.TemporaryDirectory()
+        settings["emailer.rate_limit.recipient"] = "2/3600"
+        settings["emailer.rate_limit.policy"] = "digest"
+        settings["emailer.spool.path"] = os.path.join(cls.tmpdir.name, "spool.db")
+        return settings
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        cls.tmpdir.cleanup()
+
+    def setUp(self):
+        self.headers = dict(self.headers, **get_user_headers("nous"))
+        self.limiter = self.app.app.registry.emailer_rate_limiter
+        self.limiter.backend = MemoryBackend()
+        self.metrics = MemoryMetricsService()
+        self.app.app.registry.registerUtility(self.metrics, IMetricsService)
+        bucket = {
+            "kinto-emailer": {
+                "hooks": [
+                    {
+                        "resource_name": "record",
+                        "sender": "kinto@restmail.net",
+                        "template": "Created {id}.",
+                        "recipients": ["me@you.com"],
+                    }
+                ]
+            }
+        }
+        self.app.put_json("/buckets/b", {"data": bucket}, headers=self.headers)
+        self.app.put_json("/buckets/b/collections/c", headers=self.headers)
+        patch = mock.patch("kinto_emailer.get_mailer")
+        self.get_mailer = patch.start()
+        self.addCleanup(patch.stop)
+
+    def count(self, status):
+        labels = (("bucket_id", "b"), ("status", status))
+        return self.metrics.counts[("emailer.messages", labels)]
+
+    def create_records(self, count):
+        requests = {
+            "defaults": {"method": "POST", "path": "/buckets/b/collections/c/records"},
+            "requests": [{}] * count,
+        }
+        self.app.post_json("/batch", requests, headers=self.headers)
+
+    def test_messages_over_the_limit_are_deferred_to_the_digest(self):
+        self.create_records(5)
+        assert self.get_mailer().send_immediately.call_count == 2
+        assert self.count("sent") == 2
+        assert self.count("deferred") == 3
+
+        mailer = DummyMailer()
+        self.app.app.registry.emailer_spool.flush(mailer)
+        (digest,) = mailer.outbox
+        assert digest.recipients == ["me@you.com"]
+        assert len(digest.body.splitlines()) == 3
+
+    def test_deferring_failures_are_counted(self):
+        with mock.patch.object(Spool, "add", side_effect=OSError):
+            self.create_records(3)
+        assert self.count("sent") == 2
+        assert self.count("failed") == 1
+
+    def test_messages_over_the_limit_can_be_dropped(self):
+        self.limiter.policy = "drop"
+        self.addCleanup(setattr, self.limiter, "policy", "digest")
+        self.create_records(3)
+        assert self.count("sent") == 2
+        assert self.count("rate_limited") == 1
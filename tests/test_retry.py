@@ -0,0 +1,257 @@
+import os
+import smtplib
+import tempfile
+import unittest
+
+import mock
+from kinto.core.testing import get_user_headers
+from pyramid_mailer.mailer import Mailer
+from pyramid_mailer.message import Message
+
+from kinto_emailer import command_replay
+from kinto_emailer.deadletter import DeadLetters
+from kinto_emailer.retry import RetryPolicy, deliver, is_transient
+
+from .support import FakeSMTPServer
+from .test_includeme import EmailerTest
+
+
+def make_message(i=0):
+    return Message(
+        subject="Hello %s" % i, sender="kinto@restmail.net", recipients=["me@you.com"], body="Hi"
+    )
+
+
+class IsTransientTest(unittest.TestCase):
+    def test_4xx_replies_are_transient(self):
+        assert is_transient(smtplib.SMTPSenderRefused(451, b"Try later", "a@b.com"))
+        assert not is_transient(smtplib.SMTPSenderRefused(550, b"No", "a@b.com"))
+
+    def test_refused_recipients_are_transient_if_all_are_4xx(self):
+        assert is_transient(smtplib.SMTPRecipientsRefused({"a@b.com": (450, b"Busy")}))
+        refused = {"a@b.com": (450, b"Busy"), "c@d.com": (550, b"Unknown")}
+        assert not is_transient(smtplib.SMTPRecipientsRefused(refused))
+
+    def test_network_errors_are_transient(self):
+        assert is_transient(smtplib.SMTPServerDisconnected())
+        assert is_transient(ConnectionRefusedError())
+        assert not is_transient(smtplib.SMTPNotSupportedError())
+        assert not is_transient(ValueError())
+
+
+class RetryPolicyTest(unittest.TestCase):
+    def setUp(self):
+        patch = mock.patch("kinto_emailer.retry.time.sleep")
+        self.sleep = patch.start()
+        self.addCleanup(patch.stop)
+        self.func = mock.MagicMock()
+        self.transient = smtplib.SMTPServerDisconnected()
+
+    def test_transient_failures_are_retried(self):
+        self.func.side_effect = [self.transient, self.transient, "ok"]
+        assert RetryPolicy(attempts=3).run(self.func, 1, a=2) == "ok"
+        self.func.assert_called_with(1, a=2)
+        assert self.sleep.call_count == 2
+
+    def test_delays_grow_exponentially_with_jitter(self):
+        policy = RetryPolicy(backoff=1, max_backoff=3)
+        for attempt, (low, high) in enumerate([(0.5, 1), (1, 2), (1.5, 3), (1.5, 3)], 1):
+            assert low <= policy.delay(attempt) <= high
+
+    def test_permanent_failures_are_not_retried(self):
+        self.func.side_effect = ValueError
+        with self.assertRaises(ValueError):
+            RetryPolicy(attempts=3).run(self.func)
+        assert self.func.call_count == 1
+
+    def test_error_is_raised_after_the_last_attempt(self):
+        self.func.side_effect = self.transient
+        with self.assertRaises(smtplib.SMTPServerDisconnected):
+            RetryPolicy(attempts=3).run(self.func)
+        assert self.func.call_count == 3
+
+    def test_no_attempt_is_made_after_max_time(self):
+        clock = [0]
+        self.sleep.side_effect = lambda delay: clock.append(clock.pop() + delay)
+        self.func.side_effect = self.transient
+        with mock.patch("kinto_emailer.retry.time.monotonic", side_effect=lambda: clock[0]):
+            with self.assertRaises(smtplib.SMTPServerDisconnected):
+                RetryPolicy(attempts=10, backoff=4, max_time=10).run(self.func)
+        # Delays of at least 2s, 4s and 8s.
+        assert self.func.call_count < 4
+        assert clock[0] <= 10
+
+    def test_no_attempt_is_made_after_the_shared_deadline(self):
+        clock = [0]
+        self.sleep.side_effect = lambda delay: clock.append(clock.pop() + delay)
+        self.func.side_effect = self.transient
+        policy = RetryPolicy(attempts=10, backoff=1, max_backoff=1, max_time=10, deadline=3)
+        with mock.patch("kinto_emailer.retry.time.monotonic", side_effect=lambda: clock[0]):
+            for _ in range(3):
+                with self.assertRaises(smtplib.SMTPServerDisconnected):
+                    policy.run(self.func)
+        assert clock[0] <= 3
+        assert self.func.call_count < 10
+
+    def test_can_be_configured_from_settings(self):
+        policy = RetryPolicy.from_settings(
+            {"emailer.retry.attempts": "5", "emailer.retry.max_time": "60"}
+        )
+        assert policy.attempts == 5
+        assert policy.backoff == 0.5
+        assert policy.max_time == 60
+
+
+class DeadLettersTest(unittest.TestCase):
+    def setUp(self):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.path = os.path.join(tmpdir.name, "dead")
+        self.dead_letters = DeadLetters(self.path)
+        self.retry = RetryPolicy(attempts=1)
+
+    def test_is_not_configured_without_path(self):
+        assert DeadLetters.from_settings({}) is None
+        assert DeadLetters.from_settings({"emailer.dead_letter.path": self.path}).path == self.path
+
+    def test_messages_are_replayed_and_removed(self):
+        self.dead_letters.add(make_message(1))
+        self.dead_letters.add(make_message(2))
+        with FakeSMTPServer() as server:
+            mailer = Mailer(host="127.0.0.1", port=server.port)
+            assert self.dead_letters.replay(mailer.smtp_mailer, self.retry) == (2, 0)
+        assert len(self.dead_letters) == 0
+        mail_from, rcpt_tos, data = server.messages[0]
+        assert (mail_from, rcpt_tos) == ("<kinto@restmail.net>", ["<me@you.com>"])
+        assert b"X-Actually" not in data
+
+    def test_messages_that_fail_again_are_kept(self):
+        self.dead_letters.add(make_message())
+        with FakeSMTPServer(failures=["550 No"]) as server:
+            mailer = Mailer(host="127.0.0.1", port=server.port)
+            assert self.dead_letters.replay(mailer.smtp_mailer, self.retry) == (0, 1)
+        assert len(self.dead_letters) == 1
+
+
+class DeliverTest(unittest.TestCase):
+    def setUp(self):
+        self.mailer = mock.MagicMock()
+        self.dead_letters = mock.MagicMock()
+
+    def test_message_is_sent_with_retries(self):
+        self.mailer.send_immediately.side_effect = [smtplib.SMTPServerDisconnected(), None]
+        with mock.patch("kinto_emailer.retry.time.sleep"):
+            sent = deliver(self.mailer, make_message(), retry=RetryPolicy(attempts=2))
+        assert sent
+        assert self.mailer.send_immediately.call_count == 2
+
+    def test_failed_messages_are_stored_in_dead_letters(self):
+        self.mailer.send_immediately.side_effect = ValueError
+        message = make_message()
+        assert not deliver(self.mailer, message, dead_letters=self.dead_letters)
+        self.dead_letters.add.assert_called_with(message)
+
+    def test_dead_letters_errors_are_logged(self):
+        self.mailer.send_immediately.side_effect = ValueError
+        self.dead_letters.add.side_effect = OSError
+        with mock.patch("kinto_emailer.retry.logger") as logger:
+            assert not deliver(self.mailer, make_message(), dead_letters=self.dead_letters)
+        assert logger.exception.call_count == 2
+
+
+class ReplayCommandTest(unittest.TestCase):
+    def setUp(self):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.settings = {"emailer.dead_letter.path": os.path.join(tmpdir.name, "dead")}
+        DeadLetters.from_settings(self.settings).add(make_message())
+
+        registry = mock.MagicMock()
+        registry.settings = self.settings
+        patch = mock.patch(
+            "kinto_emailer.command_replay.bootstrap", return_value={"registry": registry}
+        )
+        patch.start()
+        self.addCleanup(patch.stop)
+        self.mailer = mock.MagicMock()
+        patch = mock.patch("kinto_emailer.command_replay.get_mailer", return_value=self.mailer)
+        patch.start()
+        self.addCleanup(patch.stop)
+
+    def test_returns_non_zero_if_not_enough_args(self):
+        assert command_replay.main([]) > 0
+
+    def test_uses_sys_args_by_default(self):
+        with mock.patch("kinto_emailer.command_replay.sys.argv", ["replay", "config.ini"]):
+            assert command_replay.main() == 0
+
+    def test_returns_non_zero_if_not_configured(self):
+        self.settings.clear()
+        assert command_replay.main(["config.ini"]) > 0
+
+    def test_replays_the_dead_letters(self):
+        assert command_replay.main(["config.ini"]) == 0
+        assert self.mailer.smtp_mailer.send.call_count == 1
+        assert len(DeadLetters.from_settings(self.settings)) == 0
+
+    def test_returns_non_zero_if_some_failed(self):
+        self.mailer.smtp_mailer.send.side_effect = ValueError
+        assert command_replay.main(["config.ini"]) > 0
+
+
+class DeadLettersSetupTest(EmailerTest):
+    @classmethod
+    def get_app_settings(cls, extras=None):
+        settings = super().get_app_settings(extras)
+        cls.tmpdir = tempfile.TemporaryDirectory()
+        settings["emailer.dead_letter.path"] = os.path.join(cls.tmpdir.name, "dead")
+        settings["emailer.retry.attempts"] = "1"
+        return settings
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        cls.tmpdir.cleanup()
+
+    def setUp(self):
+        self.headers = dict(self.headers, **get_user_headers("nous"))
+        bucket = {
+            "kinto-emailer": {
+                "hooks": [
+                    {
+                        "resource_name": "record",
+                        "sender": "kinto@restmail.net",
+                        "template": "Created {id}.",
+                        "recipients": ["me@you.com"],
+                    }
+                ]
+            }
+        }
+        self.app.put_json("/buckets/b", {"data": bucket}, headers=self.headers)
+        self.app.put_json("/buckets/b/collections/c", headers=self.headers)
+
+    def test_failures_do_not_prevent_next_messages_from_being_sent(self):
+        requests = {
+            "defaults": {"method": "POST", "path": "/buckets/b/collections/c/records"},
+            "requests": [{}] * 3,
+        }
+        with mock.patch("kinto_emailer.get_mailer") as get_mailer:
+            get_mailer().send_immediately.side_effect = [None, ValueError, None]
+            self.app.post_json("/batch", requests, headers=self.headers)
+        assert get_mailer().send_immediately.call_count == 3
+        dead_letters = DeadLetters.from_settings(self.app.app.registry.settings)
+        assert len(dead_letters) == 1
+
+    def test_next_messages_are_not_retried_once_one_could_not_be_sent(self):
+        requests = {
+            "defaults": {"method": "POST", "path": "/buckets/b/collections/c/records"},
+            "requests": [{}] * 3,
+        }
+        settings = self.app.app.registry.settings
+        with mock.patch.dict(settings, {"emailer.retry.attempts": "3"}):
+            with mock.patch("kinto_emailer.retry.time.sleep"):
+                with mock.patch("kinto_emailer.get_mailer") as get_mailer:
+                    get_mailer().send_immediately.side_effect = smtplib.SMTPServerDisconnected()
+                    self.app.post_json("/batch", requests, headers=self.headers)
+        # Three attempts for the first message, then one for each of the others.
+        assert get_mailer().send_immediately.call_count == 5
@@ -0,0 +1,184 @@
+import os
+import sqlite3
+import tempfile
+import unittest
+
+import mock
+from kinto.core.metrics import IMetricsService
+from kinto.core.testing import get_user_headers
+from pyramid_mailer.mailer import DummyMailer
+from pyramid_mailer.message import Message
+
+from kinto_emailer import command_flush
+from kinto_emailer.spool import SCHEMA, Spool
+
+from .support import MemoryMetricsService
+from .test_includeme import EmailerTest
+
+
+def make_message(subject="Hello", body="Hi", recipients=("me@you.com",)):
+    return Message(
+        subject=subject, sender="kinto@restmail.net", recipients=list(recipients), body=body
+    )
+
+
+class SpoolTest(unittest.TestCase):
+    def setUp(self):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.spool = Spool(os.path.join(tmpdir.name, "spool.db"))
+        self.mailer = DummyMailer()
+
+    def test_messages_are_kept_until_flushed(self):
+        self.spool.add([make_message(), make_message()])
+        assert len(self.spool) == 2
+        assert self.spool.flush(self.mailer) == 1
+        assert len(self.spool) == 0
+
+    def test_messages_with_same_subject_and_recipients_are_merged(self):
+        self.spool.add([make_message(body="a"), make_message(body="b")])
+        self.spool.add([make_message(body="c", recipients=["you@me.com"]), make_message(body="d")])
+        self.spool.flush(self.mailer)
+        first, second = self.mailer.outbox
+        assert first.recipients == ["me@you.com"]
+        assert first.body == "a\nb\nd"
+        assert second.recipients == ["you@me.com"]
+        assert second.body == "c"
+
+    def test_recipients_order_does_not_matter(self):
+        self.spool.add(
+            [
+                make_message(recipients=["a@b.com", "c@d.com"]),
+                make_message(recipients=["c@d.com", "a@b.com"]),
+            ]
+        )
+        assert self.spool.flush(self.mailer) == 1
+
+    def test_merged_emails_are_split_according_to_max_items(self):
+        self.spool.add([make_message(body=str(i)) for i in range(5)])
+        assert self.spool.flush(self.mailer, max_items=2) == 3
+        assert [m.body for m in self.mailer.outbox] == ["0\n1", "2\n3", "4"]
+
+    def test_messages_are_kept_if_sending_fails(self):
+        self.spool.add([make_message(subject="a"), make_message(subject="b")])
+        mailer = mock.MagicMock()
+        mailer.send_immediately.side_effect = [ValueError("boom"), None]
+        assert self.spool.flush(mailer) == 1
+        assert len(self.spool) == 1
+        self.spool.flush(self.mailer)
+        assert self.mailer.outbox[0].subject == "a"
+
+    def test_html_parts_are_merged(self):
+        html = make_message(body="a")
+        html.html = "<p>a</p>"
+        self.spool.add([html, make_message(body="b")])
+        self.spool.flush(self.mailer)
+        (message,) = self.mailer.outbox
+        assert message.body == "a\nb"
+        assert message.html == "<p>a</p>"
+
+    def test_spools_without_html_column_are_migrated(self):
+        conn = sqlite3.connect(self.spool.path)
+        with conn:
+            conn.execute("DROP TABLE messages")
+            conn.execute(SCHEMA.replace("    html TEXT,\n", ""))
+        conn.close()
+        spool = Spool(self.spool.path)
+        spool.add([make_message()])
+        assert spool.flush(self.mailer) == 1
+
+    def test_path_is_read_from_settings(self):
+        spool = Spool.from_settings({"emailer.spool.path": self.spool.path})
+        assert spool.path == self.spool.path
+
+    def test_path_setting_is_mandatory(self):
+        with self.assertRaises(ValueError):
+            Spool.from_settings({})
+
+
+class FlushCommandTest(unittest.TestCase):
+    def setUp(self):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.settings = {"emailer.spool.path": os.path.join(tmpdir.name, "spool.db")}
+        Spool.from_settings(self.settings).add([make_message()])
+
+        registry = mock.MagicMock()
+        registry.settings = self.settings
+        patch = mock.patch(
+            "kinto_emailer.command_flush.bootstrap", return_value={"registry": registry}
+        )
+        patch.start()
+        self.addCleanup(patch.stop)
+        self.mailer = DummyMailer()
+        patch = mock.patch("kinto_emailer.command_flush.get_mailer", return_value=self.mailer)
+        patch.start()
+        self.addCleanup(patch.stop)
+
+    def test_uses_sys_args_by_default(self):
+        assert command_flush.main() > 0  # will fail
+
+    def test_returns_non_zero_if_not_enough_args(self):
+        assert command_flush.main([]) > 0
+
+    def test_flushes_the_spool_once(self):
+        assert command_flush.main(["config.ini", "--once"]) == 0
+        assert len(self.mailer.outbox) == 1
+
+    def test_flushes_the_spool_periodically_until_interrupted(self):
+        with mock.patch(
+            "kinto_emailer.command_flush.time.sleep", side_effect=[None, KeyboardInterrupt]
+        ) as sleep:
+            assert command_flush.main(["config.ini", "--interval", "5"]) == 0
+        sleep.assert_called_with(5)
+        assert sleep.call_count == 2
+        assert len(self.mailer.outbox) == 1
+
+
+class SpoolSetupTest(EmailerTest):
+    @classmethod
+    def get_app_settings(cls, extras=None):
+        settings = super().get_app_settings(extras)
+        cls.tmpdir = tempfile.TemporaryDirectory()
+        settings["emailer.delivery"] = "spool"
+        settings["emailer.spool.path"] = os.path.join(cls.tmpdir.name, "spool.db")
+        return settings
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        cls.tmpdir.cleanup()
+
+    def setUp(self):
+        self.headers = dict(self.headers, **get_user_headers("nous"))
+        self.metrics = MemoryMetricsService()
+        self.app.app.registry.registerUtility(self.metrics, IMetricsService)
+
+    def test_messages_are_spooled_after_commit(self):
+        bucket = {
+            "kinto-emailer": {
+                "hooks": [{"template": "Created {id}.", "recipients": ["me@you.com"]}]
+            }
+        }
+        self.app.put_json("/buckets/b", {"data": bucket}, headers=self.headers)
+        self.app.put_json("/buckets/b/collections/c1", headers=self.headers)
+        self.app.put_json("/buckets/b/collections/c2", headers=self.headers)
+
+        mailer = DummyMailer()
+        self.app.app.registry.emailer_spool.flush(mailer)
+        (message,) = mailer.outbox
+        assert message.body == "Created c1.\nCreated c2."
+        labels = (("bucket_id", "b"), ("status", "queued"))
+        assert self.metrics.counts[("emailer.messages", labels)] == 2
+
+    def test_spool_failures_are_counted(self):
+        bucket = {
+            "kinto-emailer": {
+                "hooks": [{"template": "Created {id}.", "recipients": ["me@you.com"]}]
+            }
+        }
+        self.app.put_json("/buckets/b", {"data": bucket}, headers=self.headers)
+        with mock.patch.object(Spool, "add", side_effect=OSError):
+            self.app.put_json("/buckets/b/collections/c3", headers=self.headers)
+        labels = (("bucket_id", "b"), ("status", "failed"))
+        assert self.metrics.counts[("emailer.messages", labels)] == 1